@@ -0,0 +1,78 @@
+'''
+Micro-benchmark: build result rows as dict-backed DataRow objects (the way
+QuerySet._fetch_data used to) versus the tuple-backed Row classes.
+
+Usage: python benchmarks/row_construction.py [number_of_rows]
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from datetime import datetime
+from monsql import MonSQL, DB_TYPES
+from monsql.queryset import DataRow, row_class
+
+FIELDS = ['id', 'name', 'number', 'created', 'score']
+
+
+def build_data_rows(fields, data_list):
+    result_list = []
+    for data in data_list:
+        result = {}
+        for i in range(len(data)):
+            result[fields[i]] = data[i]
+        result_list.append(DataRow(result))
+    return result_list
+
+
+def build_rows(fields, data_list):
+    return map(row_class(fields), data_list)
+
+
+def data_row_size(row):
+    return sys.getsizeof(row) + sys.getsizeof(row.__dict__) + sys.getsizeof(row.data)
+
+
+def row_size(row):
+    return sys.getsizeof(row)
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def main(row_count):
+    db = MonSQL(dbtype=DB_TYPES.SQLITE3)
+    db.create_table('bench', ['id INT', 'name VARCHAR(50)', 'number INT', 'created TIMESTAMP', 'score DOUBLE'])
+    table = db.get('bench')
+    now = datetime.now()
+    table.insert([{'id': i, 'name': 'name%d' % i, 'number': i % 100, 'created': now, 'score': i * 0.5}
+                  for i in xrange(row_count)], batch_size=100)
+    db.commit()
+
+    db.cursor.execute('SELECT %s FROM bench' % ','.join(FIELDS))
+    data_list = db.cursor.fetchall()
+
+    print 'Building %d rows from %d columns' % (row_count, len(FIELDS))
+    for name, build, size in (('DataRow', build_data_rows, data_row_size), ('Row', build_rows, row_size)):
+        rows, build_time = timed(build, FIELDS, data_list)
+        start = time.time()
+        for row in rows:
+            row.name
+        access_time = time.time() - start
+        sample = rows[:1000]
+        bytes_per_row = sum([size(row) for row in sample]) / float(len(sample))
+        print '%-8s build %7.3fs  attribute access %7.3fs  %6.1f bytes/row (excluding values)' % \
+            (name, build_time, access_time, bytes_per_row)
+        del rows, sample
+
+    db.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,404 @@
+'''
+Benchmark suite of the compile and fetch hot paths, run against an in-memory SQLite3
+database so that results are reproducible and mostly measure MonSQL itself.
+
+Each benchmark reports operations per second (the best of several repeats) and how
+much the peak memory grew while it ran. Peak memory never goes down in a process, so
+each benchmark runs in a process forked once the fixture is built: the growth is the
+memory this benchmark needed above what the fixture holds, whatever ran before it.
+Where fork is not available, benchmarks run in the same process and only report the
+memory they needed beyond what the benchmarks run before them did.
+
+Usage:
+
+    python benchmarks/suite.py                          # run all benchmarks
+    python benchmarks/suite.py compile fetch            # the benchmarks whose name contains one of these
+    python benchmarks/suite.py --save baseline.json     # keep the results
+    python benchmarks/suite.py --compare baseline.json  # compare with them, exit with 1 on a regression
+'''
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from monsql import MonSQL, DB_TYPES, ASCENDING, DESCENDING
+from monsql.query import QueryCondition
+from monsql.sql import build_select, build_insert_many
+from monsql.queryset import row_class
+from monsql.cache import LRUCache
+
+WIDE_COLUMNS = 20
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """
+    Register a benchmark. The decorated function receives the Fixture and returns a
+    tuple (function, operations): function is timed, and does operations operations
+    per call
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+class Fixture(object):
+    """
+    The database the benchmarks run on: a narrow table (id, number) and a wide one
+    (id and WIDE_COLUMNS more columns), both with rows rows
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.db = MonSQL(dbtype=DB_TYPES.SQLITE3)
+
+        self.db.create_table('narrow', ['id INTEGER PRIMARY KEY', 'number INT'])
+        self.narrow = self.db.get('narrow')
+        self.narrow.insert([{'id': i, 'number': i % 100} for i in xrange(rows)])
+
+        columns = ['c%d' % i for i in range(WIDE_COLUMNS)]
+        self.db.create_table('wide', ['id INTEGER PRIMARY KEY'] + ['%s VARCHAR(20)' % column for column in columns])
+        self.wide = self.db.get('wide')
+        self.wide.insert([dict([('id', i)] + [(column, '%s-%d' % (column, i)) for column in columns])
+                          for i in xrange(rows)])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class NullFile(object):
+    """
+    A file discarding what is written to it
+    """
+
+    def write(self, data):
+        pass
+
+
+def nested_filter(depth):
+    """
+    A filter nesting $and and $or depth times, each level with a few comparisons
+    """
+    condition = {'number': {'$gte': 1, '$lt': 50}, 'id': {'$in': [1, 2, 3]}}
+    for level in range(depth):
+        operator = '$and' if level % 2 else '$or'
+        condition = {operator: [condition, {'number': level}, {'id': {'$gt': level}}]}
+    return condition
+
+
+def compile_condition(depth):
+    condition = nested_filter(depth)
+
+    def run():
+        for i in xrange(100):
+            QueryCondition(condition).to_sql()
+    return run, 100
+
+
+for _depth in (1, 4, 16):
+    benchmark('compile_condition_depth_%d' % _depth)(lambda fixture, depth=_depth: compile_condition(depth))
+
+
+@benchmark('compile_select')
+def compile_select(fixture):
+    query = fixture.narrow.find(nested_filter(4), sort=[('id', DESCENDING)], limit=10).query
+
+    def run():
+        for i in xrange(100):
+            build_select(query)
+    return run, 100
+
+
+@benchmark('compile_select_cached')
+def compile_select_cached(fixture):
+    query = fixture.narrow.find(nested_filter(4), sort=[('id', DESCENDING)], limit=10).query
+    cache = LRUCache(16)
+
+    def run():
+        for i in xrange(100):
+            build_select(query, cache=cache)
+    return run, 100
+
+
+@benchmark('chain_query_set')
+def chain_query_set(fixture):
+    def run():
+        for i in xrange(100):
+            query_set = fixture.narrow.find({'number': {'$gte': 10}})
+            for j in range(10):
+                query_set = query_set.filter({'id': {'$gt': j}})
+            query_set.sort('id', ASCENDING).skip(5).limit(10).only('id')._compile()
+    return run, 100
+
+
+@benchmark('build_insert_many')
+def compile_insert(fixture):
+    columns = ['c%d' % i for i in range(WIDE_COLUMNS)]
+    rows = [['value'] * WIDE_COLUMNS for i in range(100)]
+
+    def run():
+        for i in xrange(10):
+            build_insert_many('wide', columns, rows)
+    return run, 1000
+
+
+@benchmark('insert_one_by_one')
+def insert_one_by_one(fixture):
+    def run():
+        for i in xrange(100):
+            fixture.narrow.insert({'number': i, 'id': fixture.rows + i})
+        fixture.db.rollback()
+    return run, 100
+
+
+@benchmark('insert_batch')
+def insert_batch(fixture):
+    rows = [{'id': fixture.rows + i, 'number': i} for i in xrange(1000)]
+
+    def run():
+        fixture.narrow.insert(rows)
+        fixture.db.rollback()
+    return run, 1000
+
+
+@benchmark('load')
+def load(fixture):
+    rows = [(fixture.rows + i, i) for i in xrange(10000)]
+
+    def run():
+        fixture.narrow.load(iter(rows), columns=['id', 'number'])
+        fixture.narrow.remove({'id': {'$gte': fixture.rows}})
+        fixture.db.commit()
+    return run, 10000
+
+
+@benchmark('row_construction')
+def row_construction(fixture):
+    fields = ['id'] + ['c%d' % i for i in range(WIDE_COLUMNS)]
+    data = [tuple(range(len(fields)))] * 10000
+
+    def run():
+        map(row_class(fields), data)
+    return run, 10000
+
+
+@benchmark('fetch_narrow')
+def fetch_narrow(fixture):
+    def run():
+        list(fixture.narrow.find(fields=['id']))
+    return run, fixture.rows
+
+
+@benchmark('fetch_narrow_values_list')
+def fetch_narrow_values_list(fixture):
+    def run():
+        fixture.narrow.find().values_list('id', flat=True)
+    return run, fixture.rows
+
+
+@benchmark('fetch_narrow_columns')
+def fetch_narrow_columns(fixture):
+    def run():
+        fixture.narrow.find().to_columns()
+    return run, fixture.rows
+
+
+@benchmark('export_wide_csv')
+def export_wide_csv(fixture):
+    def run():
+        fixture.wide.find().export(NullFile(), format='csv')
+    return run, fixture.rows
+
+
+@benchmark('export_wide_jsonl')
+def export_wide_jsonl(fixture):
+    def run():
+        fixture.wide.find().export(NullFile(), format='jsonl')
+    return run, fixture.rows
+
+
+@benchmark('fetch_one')
+def fetch_one(fixture):
+    def run():
+        for i in xrange(100):
+            fixture.narrow.find_one({'id': i})
+    return run, 100
+
+
+@benchmark('fetch_wide')
+def fetch_wide(fixture):
+    def run():
+        list(fixture.wide.find())
+    return run, fixture.rows
+
+
+@benchmark('fetch_large_in')
+def fetch_large_in(fixture):
+    ids = range(0, fixture.rows, 2)
+
+    def run():
+        list(fixture.narrow.find({'id': {'$in': ids}}))
+    return run, len(ids)
+
+
+@benchmark('count_large_in')
+def count_large_in(fixture):
+    ids = range(0, fixture.rows, 2)
+
+    def run():
+        fixture.narrow.count({'id': {'$in': ids}})
+    return run, 1
+
+
+def peak_memory_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # In bytes on OS X, in kilobytes elsewhere
+        peak /= 1024
+    return peak
+
+
+def measure(function, operations, repeat, min_time):
+    """
+    :Return: the best operations per second over repeat runs of at least min_time
+      seconds each
+    """
+    function()
+    best = 0.0
+    for r in range(repeat):
+        calls = 0
+        start = time.time()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.time() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, calls * operations / elapsed)
+    return best
+
+
+def run_benchmark(fixture, setup, repeat, min_time):
+    """
+    :Return: a dict {'ops_per_sec': ..., 'peak_memory_kb': ...} for one benchmark
+    """
+    memory = peak_memory_kb()
+    function, operations = setup(fixture)
+    ops_per_sec = measure(function, operations, repeat, min_time)
+    return {'ops_per_sec': ops_per_sec, 'peak_memory_kb': peak_memory_kb() - memory}
+
+
+def run_forked(fixture, setup, repeat, min_time):
+    """
+    run_benchmark in a child process, starting with the memory the fixture holds and
+    leaving the fixture of this process unchanged
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_end)
+            with os.fdopen(write_end, 'w') as pipe:
+                json.dump(run_benchmark(fixture, setup, repeat, min_time), pipe)
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        output = pipe.read()
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError('the benchmark process failed')
+    return json.loads(output)
+
+
+def run(names, rows, repeat, min_time):
+    """
+    :Return: a dict of benchmark name to {'ops_per_sec': ..., 'peak_memory_kb': ...}
+    """
+    fixture = Fixture(rows)
+    run_one = run_forked if hasattr(os, 'fork') else run_benchmark
+    results = {}
+    try:
+        for name, setup in BENCHMARKS:
+            if names and not any([pattern in name for pattern in names]):
+                continue
+            results[name] = run_one(fixture, setup, repeat, min_time)
+            ops_per_sec = results[name]['ops_per_sec']
+            print '%-32s %14.1f ops/s %10d KB' % (name, ops_per_sec, results[name]['peak_memory_kb'])
+            sys.stdout.flush()
+    finally:
+        fixture.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change of each benchmark from the baseline, in operations per second and
+    in peak memory
+
+    :Return: the names of the benchmarks slower than the baseline by more than
+      threshold (a fraction)
+    """
+    regressions = []
+    print
+    print '%-32s %14s %14s %9s %21s' % ('benchmark', 'baseline', 'current', 'change', 'memory KB')
+    for name, setup in BENCHMARKS:
+        if name not in results or name not in baseline:
+            continue
+        before = baseline[name]['ops_per_sec']
+        after = results[name]['ops_per_sec']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change < -threshold:
+            flag = '  SLOWER'
+            regressions.append(name)
+        elif change > threshold:
+            flag = '  faster'
+        memory = '%d -> %d' % (baseline[name]['peak_memory_kb'], results[name]['peak_memory_kb'])
+        print '%-32s %14.1f %14.1f %+8.1f%% %21s%s' % (name, before, after, change * 100, memory, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MonSQL on an in-memory SQLite3 database')
+    parser.add_argument('names', nargs='*', help='run only the benchmarks whose name contains one of these')
+    parser.add_argument('--rows', type=int, default=10000, help='rows of the tables fetched from')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each benchmark, the best is kept')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds of one run')
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved with --save')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown from the baseline counted as a regression (default 0.1, 10%%)')
+    args = parser.parse_args()
+
+    results = run(args.names, args.rows, args.repeat, args.min_time)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'rows': args.rows, 'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['rows'] != args.rows:
+            print 'Warning: the baseline was measured with %d rows' % baseline['rows']
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,24 +17,39 @@ from wrapper_mysql import MySQLDatabase
 from wrapper_sqlite3 import SQLite3Database
 from wrapper_postgresql import PostgreSQLDatabase
 from exception import MonSQLException
+from pool import ConnectionPool
+from asynchronous import AsyncDatabase
+from routing import RoutingDatabase, ROUTING_POLICY
+from profiling import QueryProfiler, LoggingHook
+from bulk import InsertOne, Upsert, UpdateMany, DeleteMany
 
 class DB_TYPES:
 	MYSQL = 'MySQL'
 	SQLITE3 = 'SQLite3'
 	POSTGRESQL = 'PostgreSQL'
 
-def MonSQL(host=None, port=None, username=None, password=None, dbname=None, dbpath=None, dbtype=None):
+def MonSQL(host=None, port=None, username=None, password=None, dbname=None, dbpath=None, dbtype=None,
+		   pool_size=None, pool_min_size=1, pool_timeout=30, mode=TRANSACTION_MODE.DEFAULT):
 	"""
 	Initialize and return a Database instance
+
+	mode is the TRANSACTION_MODE: whether writes are committed by commit() (MANUAL), after
+	every statement (AUTO) or in groups (GROUP, see Database.set_group_commit).
+
+	If pool_size is given, the database uses a pool of at most pool_size connections
+	(at least pool_min_size are kept open) and each thread works on its own connection.
+	A thread waits at most pool_timeout seconds for a free connection.
 	"""
 	if dbtype is None:
 		raise MonSQLException('Database type must be specified')
 
+	options = dict(pool_size=pool_size, pool_min_size=pool_min_size, pool_timeout=pool_timeout, mode=mode)
+
 	if dbtype == DB_TYPES.MYSQL:
-		return MySQLDatabase(host, port, username, password, dbname)
+		return MySQLDatabase(host, port, username, password, dbname, **options)
 	elif dbtype == DB_TYPES.SQLITE3:
-		return SQLite3Database(dbpath)
+		return SQLite3Database(dbpath, **options)
 	elif dbtype == DB_TYPES.POSTGRESQL:
-		return PostgreSQLDatabase(host, port, username, password, dbname)
+		return PostgreSQLDatabase(host, port, username, password, dbname, **options)
 	else:
 		raise MonSQLException('Database type %s not supported' %dbtype)
\ No newline at end of file
@@ -0,0 +1,310 @@
+# coding=utf-8
+"""
+Compile a MongoDB style aggregation pipeline into one SELECT statement.
+
+Supported stages:
+
+{'$match': condition}                   -> WHERE, with the operators of find
+{'$group': {'_id': '$a', 'total': {'$sum': '$b'}}}
+                                        -> SELECT a AS _id, SUM(b) AS total ... GROUP BY a
+{'$sort': {'total': -1}}                -> ORDER BY total DESC
+{'$sort': [('a', 1), ('b', -1)]}        -> ORDER BY a ASC, b DESC (or an OrderedDict)
+{'$skip': 10}, {'$limit': 5}            -> LIMIT 5 OFFSET 10
+{'$project': {'name': 1, 'n': '$total'}}-> SELECT name, total AS n
+
+The _id of $group is a field ('$a'), a dict of fields ({'a': '$a', 'b': '$b'}), which
+gives one output column per key instead of a nested document, or None to aggregate all
+rows at once. The accumulators are $sum (of a field, or of a number: {'$sum': 1} counts
+the rows), $avg, $min, $max and $count ({'$count': {}} counts the rows).
+
+Stages are merged into one SELECT where SQL allows it. A stage which cannot be merged,
+like a $match on the output of $group, selects from the statement built so far used as
+a subquery, so the whole pipeline is still one statement.
+"""
+
+import re
+from collections import OrderedDict
+from exception import MonSQLException
+from query import QueryCondition, bind_in_arrays, condition_columns
+from config import ASCENDING, DESCENDING
+
+FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+ACCUMULATORS = {u'$sum': u'SUM', u'$avg': u'AVG', u'$min': u'MIN', u'$max': u'MAX'}
+
+# The largest LIMIT, used when there is an OFFSET but no LIMIT
+NO_LIMIT = 9223372036854775807
+
+
+class AggregateQuery(object):
+    """
+    One SELECT statement being built from the stages of a pipeline. fields are the
+    output columns in order, and expressions the sql computing each of them
+    """
+
+    def __init__(self, source, fields, placeholder=u'%s', in_array=None, params=None, depth=0):
+        self.source = source
+        self.source_params = params or []
+        self.fields = list(fields)
+        self.expressions = dict([(field, field) for field in fields])
+        self.placeholder = placeholder
+        self.in_array = in_array
+        self.depth = depth
+        self.conditions = []
+        self.group_by = None
+        self.order = None
+        self.skip = 0
+        self.limit = None
+
+    def add_stage(self, stage):
+        """
+        Add a stage to the query, and return the query the next stages are added to:
+        either self, or a query selecting from self
+        """
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise MonSQLException('A PIPELINE STAGE MUST BE A DICT WITH ONE KEY: %r' %(stage, ))
+
+        operator, argument = stage.items()[0]
+        if operator == u'$match':
+            return self.match(argument)
+        if operator == u'$group':
+            return self.group(argument)
+        if operator == u'$sort':
+            return self.sort(argument)
+        if operator == u'$skip':
+            return self.add_skip(argument)
+        if operator == u'$limit':
+            return self.add_limit(argument)
+        if operator == u'$project':
+            return self.project(argument)
+        raise MonSQLException('UNSUPPORTED PIPELINE STAGE %s' %(operator))
+
+    def is_plain(self):
+        """
+        Whether the output columns are columns of the source, as they are, with no
+        grouping or slicing yet: conditions on them can go in the WHERE clause
+        """
+        return self.group_by is None and self.limit is None and not self.skip and \
+            all([self.expressions[field] == field for field in self.fields])
+
+    def match(self, condition):
+        query = self if self.is_plain() else self.subquery()
+        for field in condition_columns(condition):
+            query.expression(field)
+        query.conditions.append(condition)
+        return query
+
+    def group(self, specification):
+        query = self if self.is_plain() else self.subquery()
+        # The order of the rows before grouping does not matter
+        query.order = None
+
+        if u'_id' not in specification:
+            raise MonSQLException('$group REQUIRES AN _id')
+
+        key = specification[u'_id']
+        if key is None:
+            keys = []
+        elif isinstance(key, dict):
+            keys = [(name, query.reference(value)) for name, value in sorted(key.items())]
+        else:
+            keys = [(u'_id', query.reference(key))]
+
+        fields = []
+        expressions = {}
+        for name, expression in keys:
+            fields.append(check_field_name(name))
+            expressions[name] = expression
+
+        for name in sorted([name for name in specification.keys() if name != u'_id']):
+            fields.append(check_field_name(name))
+            expressions[name] = query.accumulator(specification[name])
+
+        query.group_by = [expression for name, expression in keys]
+        query.fields = fields
+        query.expressions = expressions
+        return query
+
+    def sort(self, sort):
+        query = self if self.limit is None and not self.skip else self.subquery()
+        # {'field': 1 or -1}, or like find, a list of (field, ASCENDING or DESCENDING).
+        # The keys of a plain dict have no order, so several fields need an OrderedDict
+        # or a list
+        if isinstance(sort, dict):
+            if len(sort) > 1 and not isinstance(sort, OrderedDict):
+                raise MonSQLException('$sort ON SEVERAL FIELDS REQUIRES AN OrderedDict OR A LIST OF PAIRS')
+            items = sort.items()
+        else:
+            items = sort
+
+        order = []
+        for field, direction in items:
+            if direction == ASCENDING:
+                direction = u'ASC'
+            elif direction in (-1, DESCENDING):
+                direction = u'DESC'
+            else:
+                raise MonSQLException('INVALID SORT DIRECTION %r FOR %s' %(direction, field))
+            order.append((query.expression(field), direction))
+
+        # A later sort takes precedence over the previous one
+        query.order = order + [item for item in (query.order or []) if item[0] not in dict(order)]
+        return query
+
+    def add_skip(self, n):
+        n = check_count('$skip', n)
+        if self.limit is not None:
+            self.limit = max(self.limit - n, 0)
+        self.skip += n
+        return self
+
+    def add_limit(self, n):
+        n = check_count('$limit', n)
+        if self.limit is None or n < self.limit:
+            self.limit = n
+        return self
+
+    def project(self, specification):
+        included = [field for field, value in specification.items() if value not in (0, False)]
+        excluded = [field for field, value in specification.items() if value in (0, False)]
+        if included and excluded:
+            raise MonSQLException('$project CANNOT MIX INCLUDED AND EXCLUDED FIELDS')
+
+        if excluded:
+            for field in excluded:
+                self.expression(field)
+                del self.expressions[field]
+            self.fields = [field for field in self.fields if field not in excluded]
+            return self
+
+        # The fields kept stay in their order, the new ones follow
+        fields = []
+        expressions = {}
+        for field in [field for field in self.fields if field in included] + \
+                sorted([field for field in included if field not in self.fields]):
+            value = specification[field]
+            if value in (1, True):
+                expression = self.expression(field)
+            else:
+                expression = self.reference(value)
+            fields.append(check_field_name(field))
+            expressions[field] = expression
+        self.fields = fields
+        self.expressions = expressions
+        return self
+
+    def expression(self, field):
+        """
+        The sql of an output column
+        """
+        if field not in self.expressions:
+            raise MonSQLException('UNKNOWN FIELD %s IN PIPELINE' %(field))
+        return self.expressions[field]
+
+    def reference(self, value):
+        """
+        The sql of a field reference like '$name'
+        """
+        if not isinstance(value, basestring) or not value.startswith(u'$'):
+            raise MonSQLException('EXPECTED A FIELD REFERENCE LIKE "$name", GOT %r' %(value, ))
+        return self.expression(value[1:])
+
+    def accumulator(self, specification):
+        if not isinstance(specification, dict) or len(specification) != 1:
+            raise MonSQLException('INVALID ACCUMULATOR %r' %(specification, ))
+
+        operator, argument = specification.items()[0]
+        if operator == u'$count':
+            return u'COUNT(*)'
+        if operator not in ACCUMULATORS:
+            raise MonSQLException('UNSUPPORTED ACCUMULATOR %s' %(operator))
+
+        if operator == u'$sum' and argument == 1:
+            return u'COUNT(*)'
+        if isinstance(argument, (int, long, float)) and not isinstance(argument, bool):
+            return u'%s(%r)' %(ACCUMULATORS[operator], argument)
+        return u'%s(%s)' %(ACCUMULATORS[operator], self.reference(argument))
+
+    def subquery(self):
+        """
+        Return a new query selecting from this one
+        """
+        # Without LIMIT and OFFSET, the order only matters to the outer query, where it
+        # is kept as long as it is by output columns
+        sliced = self.limit is not None or bool(self.skip)
+        sql, params = self.to_sql(ordered=sliced)
+        query = AggregateQuery(u'(%s) AS monsql_stage_%d' %(sql, self.depth), self.fields,
+                               placeholder=self.placeholder, in_array=self.in_array, params=params,
+                               depth=self.depth + 1)
+
+        order = []
+        for expression, direction in self.order or []:
+            names = [field for field in self.fields if self.expressions[field] == expression]
+            if not names:
+                break
+            order.append((names[0], direction))
+        query.order = order or None
+        return query
+
+    def to_sql(self, ordered=True):
+        """
+        :Return: a tuple (sql, params)
+        """
+        columns = []
+        for field in self.fields:
+            expression = self.expressions[field]
+            if expression == field:
+                columns.append(field)
+            else:
+                columns.append(u'%s AS %s' %(expression, field))
+        if not columns:
+            raise MonSQLException('THE PIPELINE SELECTS NO FIELD')
+
+        sql = u'SELECT %s FROM %s' %(u','.join(columns), self.source)
+        params = list(self.source_params)
+
+        if self.conditions:
+            condition = self.conditions[0] if len(self.conditions) == 1 else {u'$and': self.conditions}
+            query_str, query_params = QueryCondition(bind_in_arrays(condition, self.in_array),
+                                                     placeholder=self.placeholder).to_sql()
+            if query_str:
+                sql += u' WHERE ' + query_str
+                params.extend(query_params)
+
+        if self.group_by:
+            sql += u' GROUP BY ' + u','.join(self.group_by)
+
+        if self.order and ordered:
+            sql += u' ORDER BY ' + u','.join([u'%s %s' %(expression, direction)
+                                              for expression, direction in self.order])
+
+        if self.limit is not None or self.skip:
+            sql += u' LIMIT %s OFFSET %s' %(self.placeholder, self.placeholder)
+            params.extend([NO_LIMIT if self.limit is None else self.limit, self.skip])
+
+        return sql, params
+
+
+def build_aggregate(table_name, columns, pipeline, placeholder=u'%s', in_array=None):
+    """
+    Compile pipeline, a list of stages, on the table with the given columns
+
+    :Return: a tuple (sql, params, fields), fields being the output column names
+    """
+    query = AggregateQuery(table_name, columns, placeholder=placeholder, in_array=in_array)
+    for stage in pipeline:
+        query = query.add_stage(stage)
+    sql, params = query.to_sql()
+    return sql, params, query.fields
+
+
+def check_field_name(name):
+    if not isinstance(name, basestring) or not FIELD_NAME.match(name):
+        raise MonSQLException('INVALID FIELD NAME %r IN PIPELINE' %(name, ))
+    return name
+
+
+def check_count(stage, n):
+    if not isinstance(n, (int, long)) or isinstance(n, bool) or n < 0:
+        raise MonSQLException('%s EXPECTS A NON-NEGATIVE INTEGER, GOT %r' %(stage, n))
+    return n
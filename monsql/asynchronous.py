@@ -0,0 +1,136 @@
+# coding=utf-8
+"""
+Non-blocking access to a pooled Database.
+
+Operations are submitted to a bounded pool of worker threads, each working on
+its own connection from the database's ConnectionPool, and return immediately
+with a multiprocessing.pool.AsyncResult. Call .get() on it to wait for the
+value (exceptions are re-raised there), or pass a callback.
+
+:Examples:
+
+>>> db = MonSQL(host, port, username, password, dbname, dbtype=DB_TYPES.MYSQL, pool_size=8)
+>>> async_db = AsyncDatabase(db)
+>>> users = async_db.get('user')
+>>> pending = [users.find({'group': g}) for g in groups] # run concurrently
+>>> results = [p.get() for p in pending]
+
+Every call is a transaction of its own: writes are committed when they succeed,
+and everything else is rolled back afterwards. Use run() to execute several
+statements in one transaction.
+"""
+
+from multiprocessing.pool import ThreadPool
+from exception import MonSQLException
+
+class AsyncDatabase(object):
+
+    def __init__(self, database, workers=None):
+        """
+        :Parameters:
+
+        - database: a pooled Database (constructed with pool_size)
+        - workers: the number of worker threads, by default the maximum size of the
+          connection pool
+        """
+        if database.pool is None:
+            raise MonSQLException('ASYNCHRONOUS ACCESS REQUIRES A POOLED DATABASE')
+
+        self.database = database
+        self.workers = workers or database.pool.max_size
+        # From now on the work happens on the workers' connections
+        database.release()
+        self.__executor = ThreadPool(self.workers)
+        self.__tables = {}
+
+    def get(self, name):
+        """
+        Return an AsyncTable for the table
+        """
+        if name not in self.__tables:
+            self.__tables[name] = AsyncTable(self, self.database.get(name))
+        return self.__tables[name]
+
+    def run(self, function, *args, **kwargs):
+        """
+        Call function(database, *args, **kwargs) on a worker thread. All statements
+        it runs use the same connection and are committed when it returns, or rolled
+        back if it raises
+
+        :Return: an AsyncResult for the return value of function
+        """
+        return self.submit(function, (self.database, ) + args, kwargs, write=True)
+
+    def raw(self, sql, params=None):
+        """
+        Asynchronous Database.raw. The statement is committed
+        """
+        return self.submit(self.database.raw, (sql, params), write=True)
+
+    def submit(self, function, args=(), kwargs=None, write=False, callback=None):
+        """
+        Call function(*args, **kwargs) on a worker thread, then commit if write is
+        True, otherwise roll back
+
+        :Return: an AsyncResult
+        """
+        return self.__executor.apply_async(self.__call, (function, args, kwargs or {}, write),
+                                           callback=callback)
+
+    def close(self):
+        """
+        Wait for the submitted operations to finish, then stop the workers and close the database
+        """
+        self.__executor.close()
+        self.__executor.join()
+        self.database.close()
+
+    def __call(self, function, args, kwargs, write):
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self.database.rollback()
+            raise
+
+        if write:
+            self.database.commit()
+        else:
+            self.database.rollback()
+        return result
+
+
+class AsyncTable(object):
+    """
+    Asynchronous counterpart of Table. Methods take the same parameters as the Table
+    methods and return AsyncResult objects. find returns the rows as a list, since
+    a lazy QuerySet cannot leave its worker's connection
+    """
+
+    def __init__(self, async_database, table):
+        self.async_database = async_database
+        self.table = table
+        self.name = table.name
+
+    def find(self, *args, **kwargs):
+        return self.__read(lambda: list(self.table.find(*args, **kwargs)))
+
+    def find_one(self, *args, **kwargs):
+        return self.__read(lambda: self.table.find_one(*args, **kwargs))
+
+    def count(self, *args, **kwargs):
+        return self.__read(lambda: self.table.count(*args, **kwargs))
+
+    def insert(self, *args, **kwargs):
+        return self.__write(self.table.insert, args, kwargs)
+
+    def update(self, *args, **kwargs):
+        return self.__write(self.table.update, args, kwargs)
+
+    def remove(self, *args, **kwargs):
+        return self.__write(self.table.remove, args, kwargs)
+
+    def __read(self, function):
+        return self.async_database.submit(function)
+
+    def __write(self, function, args, kwargs):
+        return self.async_database.submit(function, args, kwargs, write=True)
@@ -0,0 +1,285 @@
+# coding=utf-8
+"""
+Bulk writes: a list of insert, upsert, update and delete operations run with as
+few statements as possible.
+
+Consecutive operations of the same kind on the same table are batched together:
+inserts with the same columns become one multi-row INSERT, upserts one upsert
+statement, deletes one DELETE whose condition joins theirs with OR, and updates
+setting the same columns one UPDATE (see sql.build_update_many).
+
+:Examples:
+
+>>> result = user_table.bulk_write([InsertOne({'name': 'Jude'}),
+>>>                                 UpdateMany({'id': 5}, {'state': 2}),
+>>>                                 DeleteMany({'state': 0})])
+>>> result.inserted_count, result.updated_count, result.deleted_count, result.errors
+>>> db.commit()
+"""
+
+from sql import build_insert_many, build_update, build_update_many, build_delete
+from query import condition_columns, bind_in_arrays
+from config import TRANSACTION_MODE
+
+
+class WriteOperation(object):
+    """
+    Base class of the bulk operations
+    """
+
+    def batch_key(self):
+        """
+        Consecutive operations on the same table with equal batch keys are run with
+        one statement. None means the operation always runs alone
+        """
+        return None
+
+    def batch_size(self, table):
+        """
+        The maximum number of operations batched with this one on table
+        """
+        return table.INSERT_BATCH_SIZE
+
+    def execute(self, table, operations, result):
+        """
+        Run operations (self and the operations batched with it) on table and add
+        their counts to result
+        """
+        raise NotImplementedError()
+
+
+class InsertOne(WriteOperation):
+
+    def __init__(self, document):
+        self.document = document
+
+    def batch_key(self):
+        return ('insert', tuple(sorted(self.document.keys())))
+
+    def batch_size(self, table):
+        return table.rows_per_statement(len(self.document))
+
+    def execute(self, table, operations, result):
+        columns = sorted(self.document.keys())
+        rows = [[operation.document[column] for column in columns] for operation in operations]
+        sql, params = build_insert_many(table.name, columns, rows, table.PLACEHOLDER)
+        table.database.execute(table.cursor, sql, params, write=table.name)
+
+        if len(rows) == 1:
+            result.inserted_ids.append(table.cursor.lastrowid)
+        else:
+            result.inserted_ids.extend(table.batch_inserted_ids(columns, rows))
+        result.inserted_count += len(rows)
+
+    def __repr__(self):
+        return 'InsertOne(%r)' %(self.document)
+
+
+class Upsert(WriteOperation):
+    """
+    Table.upsert of one document. See Table.upsert for conflict_keys and update_fields
+    """
+
+    def __init__(self, document, conflict_keys=None, update_fields=None):
+        self.document = document
+        self.conflict_keys = conflict_keys
+        self.update_fields = update_fields
+
+    def batch_key(self):
+        return ('upsert', tuple(sorted(self.document.keys())),
+                None if self.conflict_keys is None else tuple(self.conflict_keys),
+                None if self.update_fields is None else tuple(self.update_fields))
+
+    def execute(self, table, operations, result):
+        result.upserted_count += table.upsert([operation.document for operation in operations],
+                                              conflict_keys=self.conflict_keys,
+                                              update_fields=self.update_fields,
+                                              batch_size=len(operations))
+
+    def __repr__(self):
+        return 'Upsert(%r)' %(self.document)
+
+
+class UpdateMany(WriteOperation):
+    """
+    Table.update without upsert: set attributes on all rows matching filter
+    """
+
+    def __init__(self, filter, attributes):
+        self.filter = filter
+        self.attributes = attributes
+
+    def batch_key(self):
+        # Updates can only share a statement if their conditions are not affected
+        # by the values the other updates set
+        if not self.filter or condition_columns(self.filter) & set(self.attributes.keys()):
+            return None
+        return ('update', tuple(sorted(self.attributes.keys())))
+
+    def execute(self, table, operations, result):
+        if len(operations) == 1:
+            sql, params = build_update(table.name, bind_in_arrays(self.filter, table.IN_ARRAY), self.attributes,
+                                       table.PLACEHOLDER)
+        else:
+            sql, params = build_update_many(table.name, [bind_in_arrays(operation.filter, table.IN_ARRAY)
+                                                         for operation in operations],
+                                            [operation.attributes for operation in operations],
+                                            table.PLACEHOLDER)
+        table.database.execute(table.cursor, sql, params, write=table.name)
+        result.updated_count += max(table.cursor.rowcount, 0)
+
+    def __repr__(self):
+        return 'UpdateMany(%r, %r)' %(self.filter, self.attributes)
+
+
+class DeleteMany(WriteOperation):
+    """
+    Table.remove: delete all rows matching filter, or all rows if it is empty
+    """
+
+    def __init__(self, filter=None):
+        self.filter = filter
+
+    def batch_key(self):
+        return ('delete', )
+
+    def execute(self, table, operations, result):
+        filters = [operation.filter for operation in operations]
+        if len(filters) == 1:
+            condition = filters[0]
+        elif not all(filters):
+            condition = None
+        else:
+            condition = {'$or': filters}
+        sql, params = build_delete(table.name, bind_in_arrays(condition, table.IN_ARRAY), table.PLACEHOLDER)
+        table.database.execute(table.cursor, sql, params, write=table.name)
+        result.deleted_count += max(table.cursor.rowcount, 0)
+
+    def __repr__(self):
+        return 'DeleteMany(%r)' %(self.filter)
+
+
+class BulkWriteError(object):
+    """
+    The failure of one operation of a bulk write: its index in the list of
+    operations, the operation and the exception it raised
+    """
+
+    def __init__(self, index, operation, error):
+        self.index = index
+        self.operation = operation
+        self.error = error
+
+    def __repr__(self):
+        return 'BulkWriteError(%d, %r, %r)' %(self.index, self.operation, self.error)
+
+
+class BulkWriteResult(object):
+    """
+    The counts of a bulk write. Rows matched by several batched updates or deletes are
+    counted once, and MySQL only counts the rows whose values actually changed.
+    inserted_ids are the ids of the inserted rows, None where the database cannot tell
+    """
+
+    def __init__(self):
+        self.inserted_count = 0
+        self.upserted_count = 0
+        self.updated_count = 0
+        self.deleted_count = 0
+        self.inserted_ids = []
+        self.errors = []
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return 'BulkWriteResult(inserted=%d, upserted=%d, updated=%d, deleted=%d, errors=%d)' \
+            %(self.inserted_count, self.upserted_count, self.updated_count, self.deleted_count, len(self.errors))
+
+
+def bulk_write(database, requests, ordered=True):
+    """
+    Run requests, a list of (table, operation) pairs, in the current transaction of
+    database. Nothing is committed: commit to make the writes permanent, or roll back
+    to discard them.
+
+    When a batch fails, its operations are run again one by one to find the failing
+    ones. With ordered, the bulk write stops at the first failing operation; otherwise
+    all the other operations are still run. Failures are reported in result.errors.
+
+    In AUTO and GROUP transaction modes, the bulk write is one transaction block,
+    committed when it ends.
+
+    :Return: a BulkWriteResult
+    """
+    if database.mode == TRANSACTION_MODE.MANUAL:
+        return run_bulk_write(database, requests, ordered)
+    with database.transaction():
+        return run_bulk_write(database, requests, ordered)
+
+
+def run_bulk_write(database, requests, ordered):
+    result = BulkWriteResult()
+    for table, batch in split_batches(requests):
+        database.invalidate_results(table.name)
+        operations = [operation for index, operation in batch]
+        try:
+            run_isolated(database, lambda: operations[0].execute(table, operations, result))
+            continue
+        except Exception as e:
+            if len(batch) == 1:
+                result.errors.append(BulkWriteError(batch[0][0], batch[0][1], e))
+                if ordered:
+                    return result
+                continue
+
+        for index, operation in batch:
+            try:
+                run_isolated(database, lambda: operation.execute(table, [operation], result))
+            except Exception as e:
+                result.errors.append(BulkWriteError(index, operation, e))
+                if ordered:
+                    return result
+
+    return result
+
+
+def split_batches(requests):
+    """
+    Group consecutive requests on the same table with equal batch keys, at most
+    operation.batch_size(table) in one batch
+
+    :Return: a list of (table, [(index, operation), ...]) tuples
+    """
+    batches = []
+    last_key = None
+    for index, (table, operation) in enumerate(requests):
+        key = operation.batch_key()
+        if key is not None:
+            key = (table.name, key)
+        if key is None or key != last_key or len(batches[-1][1]) >= operation.batch_size(table):
+            batches.append((table, []))
+        batches[-1][1].append((index, operation))
+        last_key = key
+    return batches
+
+
+def run_isolated(database, function):
+    """
+    Call function so that, if it raises, the statements it ran are undone while the
+    rest of the transaction can go on. A failed statement is undone by the database
+    itself, but PostgreSQL also aborts the transaction, so a savepoint is used there
+    """
+    if not database.STATEMENT_ERROR_ABORTS_TRANSACTION:
+        return function()
+
+    cursor = database.cursor
+    database.execute(cursor, 'SAVEPOINT monsql_bulk')
+    try:
+        value = function()
+    except Exception:
+        database.execute(cursor, 'ROLLBACK TO SAVEPOINT monsql_bulk')
+        raise
+    database.execute(cursor, 'RELEASE SAVEPOINT monsql_bulk')
+    return value
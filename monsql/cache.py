@@ -0,0 +1,253 @@
+# coding=utf-8
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A thread-safe mapping which keeps at most max_size entries, evicting the least
+    recently used one when full. Hits, misses and evictions are counted so the
+    effectiveness of the cache can be observed.
+    """
+
+    def __init__(self, max_size):
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    @property
+    def max_size(self):
+        return self.__max_size
+
+    @max_size.setter
+    def max_size(self, value):
+        with self.__lock:
+            self.__max_size = value
+            self._evict()
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for key and mark it as recently used, or default
+        """
+        with self.__lock:
+            try:
+                value = self.__entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self.__entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = value
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            return self.__entries.pop(key, default)
+
+    def keys(self):
+        with self.__lock:
+            return self.__entries.keys()
+
+    def clear(self):
+        """
+        Remove all entries. Counters are kept
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict(self):
+        while len(self.__entries) > max(self.__max_size, 0):
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+
+class ResultCache(object):
+    """
+    Results of read queries keyed by their sql and params, each recorded with the
+    tables it reads so it can be dropped when one of them is written.
+
+    At most max_entries results totalling about max_bytes (see estimate_size) are kept,
+    the least recently used ones being evicted first, and results older than ttl
+    seconds (if not None) are not returned. Hits, misses, evictions (for lack of space
+    or by age) and invalidations are counted.
+
+    A result read while one of its tables is invalidated may be older than the
+    invalidation: take version(tables) before running the query and pass it to put,
+    which then drops the result if the tables were invalidated in between.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.__entries = OrderedDict()
+        self.__keys_by_table = {}
+        # Incremented by clear, and for each table by invalidate
+        self.__generation = 0
+        self.__table_versions = {}
+        self.__lock = threading.Lock()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def get(self, key):
+        """
+        :Return: a tuple (found, value)
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[3] > self.ttl:
+                self.__remove(key)
+                self.evictions += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            del self.__entries[key]
+            self.__entries[key] = entry
+            self.hits += 1
+            return True, entry[0]
+
+    def version(self, tables):
+        """
+        A token changing every time one of tables is invalidated, to pass to put
+        """
+        tables = [table.lower() for table in tables]
+        with self.__lock:
+            return self.__version(tables)
+
+    def __version(self, tables):
+        return (self.__generation, tuple([self.__table_versions.get(table, 0) for table in tables]))
+
+    def put(self, key, value, tables, version=None):
+        """
+        Store the value of key, read from tables. If version is given and one of tables
+        was invalidated since it was taken, the value may be stale and is not stored
+        """
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        tables = tuple([table.lower() for table in tables])
+        with self.__lock:
+            if version is not None and self.__version(tables) != version:
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (value, tables, size, time.time())
+            self.bytes += size
+            for table in tables:
+                self.__keys_by_table.setdefault(table, set()).add(key)
+
+            while self.__entries and (len(self.__entries) > self.max_entries or self.bytes > self.max_bytes):
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def invalidate(self, table):
+        """
+        Drop the results read from table
+        """
+        with self.__lock:
+            table = table.lower()
+            self.__table_versions[table] = self.__table_versions.get(table, 0) + 1
+            keys = self.__keys_by_table.pop(table, ())
+            for key in list(keys):
+                self.__remove(key)
+            self.invalidations += len(keys)
+
+    def clear(self):
+        """
+        Drop all results. Counters are kept
+        """
+        with self.__lock:
+            self.__generation += 1
+            self.invalidations += len(self.__entries)
+            self.__entries.clear()
+            self.__keys_by_table.clear()
+            self.bytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __remove(self, key):
+        value, tables, size, stored_at = self.__entries.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self.__keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__keys_by_table[table]
+
+
+def estimate_size(value):
+    """
+    Approximate memory used by a result: the list, its rows and their values
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, list):
+        for row in value:
+            size += sys.getsizeof(row)
+            if isinstance(row, tuple):
+                for v in row:
+                    size += sys.getsizeof(v)
+    return size
+
+
+def result_key(sql, params):
+    """
+    The key of a result in a ResultCache, or None if the params cannot be part of a key
+    """
+    key = []
+    for param in params or ():
+        if isinstance(param, list):
+            param = tuple(param)
+        try:
+            hash(param)
+        except TypeError:
+            return None
+        key.append(param)
+    return (sql, tuple(key))
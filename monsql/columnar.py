@@ -0,0 +1,150 @@
+# coding=utf-8
+"""
+Columnar results: the rows of a query as one buffer per column instead of one object
+per row, for code processing whole columns at a time.
+
+The buffers are typed from the declared types of the columns (see schema.TableSchema):
+
+- integer columns         -> array.array('l'), or a numpy int64 array
+- floating point, numeric -> array.array('d'), or a numpy float64 array
+- boolean columns         -> list, or a numpy bool array
+- other columns           -> list, or a numpy object array
+
+A column holding a value its buffer cannot store, like a NULL in an integer column or,
+with SQLite3, a value of another type than declared, falls back to a more general
+buffer: a list, or with numpy float64 (NULLs becoming NaN) then object.
+
+numpy is an optional dependency, only needed by to_numpy.
+"""
+
+import array
+import re
+from collections import OrderedDict
+from exception import MonSQLException
+
+INTEGER = 'integer'
+FLOAT = 'float'
+BOOLEAN = 'boolean'
+OBJECT = 'object'
+
+INTEGER_TYPE = re.compile(r'^(tiny|small|medium|big)?int(eger)?\d*\b|^(small|big)?serial\b')
+FLOAT_TYPE = re.compile(r'^(double|float|real|numeric|decimal)\b')
+BOOLEAN_TYPE = re.compile(r'^bool(ean)?\b')
+
+ARRAY_TYPECODES = {INTEGER: 'l', FLOAT: 'd'}
+
+
+def column_kind(declared_type):
+    """
+    The kind of buffer (INTEGER, FLOAT, BOOLEAN or OBJECT) for a column of the given
+    declared type, OBJECT if it is unknown
+    """
+    declared_type = (declared_type or '').strip().lower()
+    if INTEGER_TYPE.match(declared_type):
+        return INTEGER
+    if FLOAT_TYPE.match(declared_type):
+        return FLOAT
+    if BOOLEAN_TYPE.match(declared_type):
+        return BOOLEAN
+    return OBJECT
+
+
+def fill_arrays(fields, kinds, batches):
+    """
+    Build the columns of the rows of batches (an iterable of lists of tuples) into
+    array.array or list buffers
+
+    :Return: an OrderedDict of field to buffer
+    """
+    buffers = []
+    for kind in kinds:
+        typecode = ARRAY_TYPECODES.get(kind)
+        buffers.append(array.array(typecode) if typecode else [])
+
+    for data_list in batches:
+        for index, values in enumerate(zip(*data_list)):
+            buffer = buffers[index]
+            if isinstance(buffer, list):
+                buffer.extend(values)
+                continue
+            size = len(buffer)
+            try:
+                buffer.extend(values)
+            except (TypeError, OverflowError):
+                del buffer[size:]
+                buffers[index] = buffer.tolist() + list(values)
+
+    return OrderedDict(zip(fields, buffers))
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise MonSQLException('to_numpy() REQUIRES NUMPY, WHICH IS NOT INSTALLED')
+    return numpy
+
+
+def fill_numpy(fields, kinds, batches, capacity=0):
+    """
+    Build the columns of the rows of batches into numpy arrays, preallocated for
+    capacity rows and grown if there are more
+
+    :Return: an OrderedDict of field to array
+    """
+    numpy = import_numpy()
+    dtypes = {INTEGER: numpy.int64, FLOAT: numpy.float64, BOOLEAN: numpy.bool_, OBJECT: object}
+    buffers = [numpy.empty(capacity, dtype=dtypes[kind]) for kind in kinds]
+
+    size = 0
+    for data_list in batches:
+        end = size + len(data_list)
+        if end > capacity:
+            capacity = max(end, capacity * 2)
+            buffers = [_resized(numpy, buffer, size, capacity) for buffer in buffers]
+
+        for index, values in enumerate(zip(*data_list)):
+            buffer = buffers[index]
+            if buffer.dtype == numpy.bool_ and None in values:
+                # numpy would store NULLs as False
+                buffer = buffers[index] = _generalized(numpy, buffer, size)
+            while True:
+                try:
+                    buffer[size:end] = values
+                    break
+                except (TypeError, ValueError, OverflowError):
+                    buffer = buffers[index] = _generalized(numpy, buffer, size)
+        size = end
+
+    return OrderedDict([(field, _resized(numpy, buffer, size, size)) for field, buffer in zip(fields, buffers)])
+
+
+def to_records(numpy, columns):
+    """
+    A numpy record array of the columns returned by fill_numpy
+    """
+    return numpy.rec.fromarrays(columns.values(), names=[str(field) for field in columns.keys()])
+
+
+def _resized(numpy, buffer, size, capacity):
+    """
+    A buffer of the given capacity holding the first size values of buffer
+    """
+    if capacity == len(buffer):
+        return buffer
+    resized = numpy.empty(capacity, dtype=buffer.dtype)
+    resized[:size] = buffer[:size]
+    return resized
+
+
+def _generalized(numpy, buffer, size):
+    """
+    The first size values of buffer in a buffer of a more general type
+    """
+    if buffer.dtype == numpy.int64:
+        dtype = numpy.float64
+    else:
+        dtype = object
+    generalized = numpy.empty(len(buffer), dtype=dtype)
+    generalized[:size] = buffer[:size]
+    return generalized
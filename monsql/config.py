@@ -5,6 +5,12 @@ DESCENDING = 2
 
 
 class TRANSACTION_MODE:
+    # Commit after every write statement
     AUTO = "auto"
+    # Commit only when Database.commit is called
     MANUAL = "manual"
+    # Commit every Database.GROUP_COMMIT_WRITES writes, or with the first write made
+    # GROUP_COMMIT_MILLISECONDS after the first uncommitted one. There is no timer: the
+    # last writes stay uncommitted until another write, commit, release or close
+    GROUP = "group"
     DEFAULT = "manual"
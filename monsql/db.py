@@ -3,34 +3,429 @@
 from config import TRANSACTION_MODE
 from exception import MonSQLException
 from table import Table
-from queryset import DataRow
+from queryset import DataRow, row_class
+from cache import LRUCache, ResultCache, result_key
+from pool import ConnectionPool
+from schema import SchemaCache
+from profiling import Statement
+from bulk import bulk_write
+from contextlib import contextmanager
 import abc
+import threading
+import time
 
 class Database:
     """
     Database wrapper for interaction with specific database
     """
+
+    # Maximum number of compiled SELECT statements kept by default
+    QUERY_CACHE_SIZE = 256
+
+    # Whether a failed statement aborts the whole transaction, instead of only itself
+    STATEMENT_ERROR_ABORTS_TRANSACTION = False
+
+    # When to commit in TRANSACTION_MODE.GROUP, see set_group_commit
+    GROUP_COMMIT_WRITES = 100
+    GROUP_COMMIT_MILLISECONDS = 50
+
     def __init__(self, db, mode=TRANSACTION_MODE.DEFAULT):
-        self.__db = db
-        self.__cursor = self.__db.cursor()
+        """
+        db: a DB-API connection, or a ConnectionPool. With a pool each thread
+        works on its own connection, checked out when the thread first needs one
+        """
+        if mode not in (TRANSACTION_MODE.AUTO, TRANSACTION_MODE.MANUAL, TRANSACTION_MODE.GROUP):
+            raise MonSQLException('UNKNOWN TRANSACTION MODE %s' %(mode))
+
+        if isinstance(db, ConnectionPool):
+            self.__pool = db
+            self.__db = None
+            self.__cursor = None
+        else:
+            self.__pool = None
+            self.__db = db
+            self.__cursor = self.__db.cursor()
+        self.__transaction_state = _TransactionState()
+        self.group_commit_writes = self.GROUP_COMMIT_WRITES
+        self.group_commit_milliseconds = self.GROUP_COMMIT_MILLISECONDS
+        self.__local = threading.local()
         self.__table_map = {}
         self.__mode = mode
+        self.__query_cache = LRUCache(self.QUERY_CACHE_SIZE)
+        self.__schema = SchemaCache(self.load_schema)
+        self.__hooks = ()
+        self.__result_cache = None
 
     """
     Properties for accessibility to subclasses
     """
     @property
     def cursor(self):
-        return self.__cursor
+        if self.__pool is None:
+            return self.__cursor
+        return self.__binding().cursor
 
     @property
     def db(self):
-        return self.__db
+        if self.__pool is None:
+            return self.__db
+        return self.__binding().connection
+
+    @property
+    def pool(self):
+        """
+        The ConnectionPool, or None if this database uses a single connection
+        """
+        return self.__pool
 
     @property
     def mode(self):
         return self.__mode
 
+    @property
+    def query_cache(self):
+        """
+        The cache of compiled SELECT statements, keyed on the shape of the query
+        (an LRUCache). None when the cache is disabled
+        """
+        if self.__query_cache.max_size <= 0:
+            return None
+        return self.__query_cache
+
+    @property
+    def query_cache_hits(self):
+        return self.__query_cache.hits
+
+    @property
+    def query_cache_misses(self):
+        return self.__query_cache.misses
+
+    def set_query_cache_size(self, size):
+        """
+        Set the maximum number of compiled SELECT statements to keep. 0 disables the cache
+        """
+        self.__query_cache.max_size = size
+
+    @property
+    def result_cache(self):
+        """
+        The ResultCache of read queries, or None if it is not enabled
+        """
+        return self.__result_cache
+
+    def enable_result_cache(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=None):
+        """
+        Cache the results of the queries of find, find_one, count and aggregate, keyed
+        by their sql and params. The results read from a table are dropped when it is
+        written through MonSQL (insert, update, upsert, remove, bulk_write, truncate).
+        Changes made by other programs or with raw sql are not seen until ttl seconds
+        (if not None) have passed or the cache is cleared. While the calling thread has
+        uncommitted writes, its queries bypass the cache.
+
+        See monsql.cache.ResultCache for the parameters and the statistics
+
+        :Return: the ResultCache
+        """
+        self.__result_cache = ResultCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
+        return self.__result_cache
+
+    def disable_result_cache(self):
+        self.__result_cache = None
+
+    def read(self, cursor, sql, params, fetch, tables, compile_time=0.0):
+        """
+        Execute a query reading tables, like execute with fetch, through the result
+        cache when it is enabled
+        """
+        cache = self.__result_cache
+        key = None
+        if cache is not None and not self.__transaction().dirty:
+            key = result_key(sql, params)
+        if key is None:
+            return self.execute(cursor, sql, params, fetch=fetch, compile_time=compile_time)
+
+        found, value = cache.get(key)
+        if found:
+            return list(value) if isinstance(value, list) else value
+
+        # A write committed by another thread while the query runs invalidates the
+        # tables after the query may have read the old rows, which are then not cached
+        version = cache.version(tables)
+        value = self.execute(cursor, sql, params, fetch=fetch, compile_time=compile_time)
+        cache.put(key, list(value) if isinstance(value, list) else value, tables, version)
+        return value
+
+    def invalidate_results(self, table=None):
+        """
+        Drop the cached results read from table, or all of them if table is None. Called
+        after writing to table: since other connections may read and cache the old rows
+        until the write is committed, they are dropped again when it is committed or
+        rolled back
+        """
+        cache = self.__result_cache
+        if cache is None:
+            return
+        self.__transaction().written.add(table)
+        self.__drop_results(cache, [table])
+
+    def __drop_results(self, cache, tables):
+        if None in tables:
+            cache.clear()
+        else:
+            for table in tables:
+                cache.invalidate(table)
+
+    def __end_transaction(self, state):
+        cache = self.__result_cache
+        if cache is not None and state.written:
+            self.__drop_results(cache, state.written)
+        state.reset()
+
+    def add_hook(self, hook):
+        """
+        Register an execution hook: an object with before_execute(statement) and
+        after_execute(statement) methods (see monsql.profiling), called around every
+        statement run through this database
+        """
+        self.__hooks = self.__hooks + (hook, )
+
+    def remove_hook(self, hook):
+        self.__hooks = tuple([h for h in self.__hooks if h is not hook])
+
+    def execute(self, cursor, sql, params=None, fetch=None, compile_time=0.0, write=False, run=None):
+        """
+        Execute sql on cursor, then, if fetch is given, call fetch(cursor) to read the
+        result. All statements MonSQL runs on the connections of a database go through
+        this method, which reports them to the registered hooks (the health checks of
+        the connection pool, run on connections checked in, are not reported). If write
+        is given, the statement modifies data and is committed according to the
+        transaction mode (see after_write). write is then the name of the table written
+        to, or True if it is unknown, for the cached results to be invalidated.
+
+        run(cursor, sql, params) executes statements which are not run with
+        cursor.execute, like executemany or the COPY of psycopg2
+
+        :Return: the result of fetch, or of the execution if fetch is None or returns None
+        """
+        result = self.__execute(cursor, sql, params, fetch, compile_time, run)
+        if write:
+            self.invalidate_results(None if write is True else write)
+            self.after_write()
+        return result
+
+    def __execute(self, cursor, sql, params, fetch, compile_time, run):
+        hooks = self.__hooks
+        if not hooks:
+            if run is not None:
+                result = run(cursor, sql, params)
+            elif params is None:
+                result = cursor.execute(sql)
+            else:
+                result = cursor.execute(sql, params)
+            if fetch is not None:
+                rows = fetch(cursor)
+                if rows is not None:
+                    return rows
+            return result
+
+        statement = Statement(sql, params, compile_time)
+        for hook in hooks:
+            hook.before_execute(statement)
+
+        try:
+            start = time.time()
+            if run is not None:
+                result = run(cursor, sql, params)
+            elif params is None:
+                result = cursor.execute(sql)
+            else:
+                result = cursor.execute(sql, params)
+            statement.execute_time = time.time() - start
+
+            if fetch is not None:
+                start = time.time()
+                rows = fetch(cursor)
+                statement.fetch_time = time.time() - start
+                if rows is not None:
+                    result = rows
+
+            if isinstance(result, list):
+                statement.row_count = len(result)
+            elif cursor.rowcount is not None and cursor.rowcount >= 0:
+                statement.row_count = cursor.rowcount
+        except Exception as e:
+            statement.error = e
+            raise
+        finally:
+            for hook in hooks:
+                hook.after_execute(statement)
+
+        return result
+
+    def set_group_commit(self, writes=None, milliseconds=None):
+        """
+        Set when TRANSACTION_MODE.GROUP commits: after the given number of writes, or
+        with the first write made the given number of milliseconds after the first
+        uncommitted one. There is no timer: the milliseconds are checked when a write is
+        made, so pending writes stay uncommitted, however old, until the next write, or
+        until commit, release or close, which commit them
+        """
+        if writes is not None:
+            self.group_commit_writes = writes
+        if milliseconds is not None:
+            self.group_commit_milliseconds = milliseconds
+
+    def after_write(self):
+        """
+        Called after every write statement: commit it in AUTO mode, or if it completes a
+        group in GROUP mode. Nothing is committed inside a transaction block
+        """
+        state = self.__transaction()
+        state.dirty = True
+        if state.depth > 0 or self.__mode == TRANSACTION_MODE.MANUAL:
+            return
+
+        if self.__mode == TRANSACTION_MODE.AUTO:
+            self.commit()
+            return
+
+        now = time.time()
+        if state.pending_writes == 0:
+            state.first_write_at = now
+        state.pending_writes += 1
+        if state.pending_writes >= self.group_commit_writes or \
+                (now - state.first_write_at) * 1000 >= self.group_commit_milliseconds:
+            self.commit()
+
+    @property
+    def in_transaction(self):
+        """
+        Whether the calling thread is inside a transaction block
+        """
+        return self.__transaction().depth > 0
+
+    @property
+    def has_uncommitted_writes(self):
+        """
+        Whether the calling thread wrote data which is not committed yet
+        """
+        return self.__transaction().dirty
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager running the block in a transaction, committed at the end of the
+        block, or rolled back if the block raises. Nested blocks use savepoints: an
+        exception leaving a nested block only undoes the statements of that block.
+
+        >>> with db.transaction():
+        >>>     users.insert({'name': 'Jude'})
+        >>>     try:
+        >>>         with db.transaction():
+        >>>             logs.insert({'message': ...})
+        >>>     except Exception:
+        >>>         pass # the user is still inserted
+
+        Whatever the transaction mode, nothing is committed inside a block, and commit
+        cannot be called there. Changes left uncommitted before the block are committed
+        when the outermost block starts, on every database, so that they are kept even
+        if the block is rolled back
+        """
+        state = self.__transaction()
+        schema_version = self.schema_version
+        if state.depth == 0:
+            if state.dirty:
+                self.commit()
+            state.token = self.begin_transaction()
+            savepoint = None
+        else:
+            savepoint = 'monsql_savepoint_%d' %(state.depth)
+            self.execute(self.cursor, 'SAVEPOINT %s' %(savepoint))
+
+        state.depth += 1
+        try:
+            yield self
+        except:
+            state.depth -= 1
+            if savepoint is None:
+                token, state.token = state.token, None
+                self.__end_transaction(state)
+                self.rollback_transaction(token)
+            else:
+                self.execute(self.cursor, 'ROLLBACK TO SAVEPOINT %s' %(savepoint))
+                self.execute(self.cursor, 'RELEASE SAVEPOINT %s' %(savepoint))
+            if self.schema_version != schema_version:
+                # The schema changes of the block were undone too
+                self.refresh_schema()
+            raise
+
+        state.depth -= 1
+        if savepoint is None:
+            token, state.token = state.token, None
+            try:
+                self.commit_transaction(token)
+            finally:
+                self.__end_transaction(state)
+        else:
+            self.execute(self.cursor, 'RELEASE SAVEPOINT %s' %(savepoint))
+
+    def begin_transaction(self):
+        """
+        Start the transaction of an outermost transaction block. The DB-API drivers
+        start transactions implicitly, so this does nothing by default. The return
+        value is passed to commit_transaction or rollback_transaction
+        """
+        return None
+
+    def commit_transaction(self, token):
+        self.db.commit()
+
+    def rollback_transaction(self, token):
+        self.db.rollback()
+
+    def __transaction(self):
+        if self.__pool is None:
+            return self.__transaction_state
+        return self.__binding().transaction
+
+    def __binding(self):
+        binding = getattr(self.__local, 'binding', None)
+        if binding is None:
+            binding = _PooledConnection(self.__pool)
+            self.__local.binding = binding
+        return binding
+
+    def release(self):
+        """
+        Give the connection bound to the calling thread back to the pool. Writes pending
+        in GROUP mode are committed first, like close does; other uncommitted changes (in
+        MANUAL mode, or of an unfinished transaction block) are rolled back. The thread
+        checks out a connection again when it next needs one. Does nothing if the
+        database is not pooled.
+        """
+        binding = getattr(self.__local, 'binding', None)
+        if binding is not None:
+            self.__local.binding = None
+            if binding.transaction.pending_writes and binding.transaction.depth == 0:
+                binding.connection.commit()
+                self.__end_transaction(binding.transaction)
+            binding.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager binding a pooled connection to the calling thread for the
+        duration of the block, e.g. one request of a threaded web server:
+
+        >>> with db.connection():
+        >>>     db.get('user').insert({'name': 'Jude'})
+        >>>     db.commit()
+        """
+        try:
+            yield self.db
+        finally:
+            self.release()
+
     def __ensure_table_obj(self, name):
         if not self.__table_map.has_key(name):
             self.__table_map[name] = self.get_table_obj(name)
@@ -41,6 +436,15 @@ class Database:
         Implemented by subclasses, because different database may use different table class"""
         pass
 
+    @abc.abstractmethod
+    def load_schema(self):
+        """
+        Return a dict mapping each lower case table name (as returned by list_tables) to
+        its TableSchema, read from the catalog of the database with as few queries as
+        possible. Implemented by subclasses
+        """
+        pass
+
     @abc.abstractmethod
     def list_tables(self):
         """
@@ -56,11 +460,30 @@ class Database:
         to subclasses. For those don't support truncate, 'delete from ...' is used """
         pass
 
+    def copy_to_csv(self, sql, params, fileobj, header=True):
+        """
+        Have the database write the result of a query to fileobj as CSV itself, like
+        COPY TO STDOUT on PostgreSQL. Databases which cannot return None, and the rows
+        are written by MonSQL instead (see QuerySet.export)
+
+        :Return: the number of rows written, or None
+        """
+        return None
+
+    def server_side_cursor(self):
+        """
+        Return a new cursor which fetches rows from the server as they are requested
+        instead of all at once. Databases with dedicated server side cursors override this;
+        by default a new regular cursor is returned. The caller is responsible for closing it
+        """
+        return self.db.cursor()
+
     def get(self, name):
         """
         Return a Table object to perform operations on this table. 
 
-        Note that all tables returned by the samle Database instance shared the same connection.
+        Note that all tables returned by the samle Database instance shared the same connection
+        (with a connection pool: the connection bound to the calling thread).
 
         :Parameters:
 
@@ -75,36 +498,84 @@ class Database:
         """
         Close the connection to the server
         """
-        self.__db.close()
+        if self.__pool is None:
+            if self.__transaction_state.pending_writes and self.__transaction_state.depth == 0:
+                self.__db.commit()
+            self.__db.close()
+        else:
+            self.release()
+            self.__pool.close()
         self.__table_map = {}
 
     def commit(self):
         """
         Commit the current session
         """
-        self.__db.commit()
+        state = self.__transaction()
+        if state.depth > 0:
+            raise MonSQLException('CANNOT COMMIT INSIDE A TRANSACTION BLOCK')
+        self.db.commit()
+        self.__end_transaction(state)
+
+    def rollback(self):
+        """
+        Roll back the current session
+        """
+        state = self.__transaction()
+        if state.depth > 0:
+            raise MonSQLException('CANNOT ROLL BACK INSIDE A TRANSACTION BLOCK, RAISE AN EXCEPTION INSTEAD')
+        self.db.rollback()
+        self.__end_transaction(state)
     
+    def bulk_write(self, requests, ordered=True):
+        """
+        Table.bulk_write across tables. requests is a list of (table_name, operation)
+        pairs; consecutive operations on the same table are batched together
+
+        :Return: a BulkWriteResult
+        """
+        return bulk_write(self, [(self.get(name), operation) for name, operation in requests], ordered)
+
     def set_foreign_key_check(self, to_check):
         """
         Enable/disable foreign key check. Disabling this is especially useful when
         deleting from a table with foreign key pointing to itself
         """
         if to_check:
-            self.__db.cursor().execute('SET foreign_key_checks = 1;')
+            self.execute(self.cursor, 'SET foreign_key_checks = 1;')
         else:
-            self.__db.cursor().execute('SET foreign_key_checks = 0;')
+            self.execute(self.cursor, 'SET foreign_key_checks = 0;')
+
+    def table_schema(self, tablename):
+        """
+        Return the TableSchema of the given table, or None if it does not exist.
+
+        The metadata of all tables is loaded with one catalog query when first needed and
+        cached until create_table, drop_table or truncate_table is called, or raw runs
+        a CREATE/ALTER/DROP/RENAME/TRUNCATE statement. Tables missing from it are looked
+        up again in the catalog, so tables created by other connections are found; call
+        refresh_schema after altering or dropping tables in other ways
+        """
+        return self.__schema.get(tablename)
+
+    def refresh_schema(self):
+        """
+        Discard the cached table metadata. It is reloaded when next needed
+        """
+        self.__schema.invalidate()
+
+    @property
+    def schema_version(self):
+        """
+        A number incremented every time the cached table metadata is discarded
+        """
+        return self.__schema.version
 
     def is_table_existed(self, tablename):
         """
         Check whether the given table name exists in this database. Return boolean.
         """
-        all_tablenames = self.list_tables()
-        tablename = tablename.lower()
-
-        if tablename in all_tablenames:
-            return True
-        else:
-            return False
+        return self.table_schema(tablename) is not None
 
     def create_table(self, tablename, columns, primary_key=None, force_recreate=False):
         """
@@ -132,8 +603,10 @@ class Database:
             columns_specs += ',PRIMARY KEY(%s)' %(','.join(primary_key))
 
         sql = 'CREATE TABLE %s(%s)' %(tablename, columns_specs)
-        self.__cursor.execute(sql)
-        self.__db.commit()
+        self.execute(self.cursor, sql)
+        self.commit_schema_change()
+        self.invalidate_results(tablename)
+        self.refresh_schema()
 
     def drop_table(self, tablename, silent=False):
         """
@@ -151,39 +624,99 @@ class Database:
         if not silent and not self.is_table_existed(tablename):
             raise MonSQLException('TABLE %s DOES NOT EXIST' %tablename)
 
-        self.__cursor.execute('DROP TABLE IF EXISTS %s' %(tablename))
-        self.__db.commit()
+        self.execute(self.cursor, 'DROP TABLE IF EXISTS %s' %(tablename))
+        self.commit_schema_change()
+        self.invalidate_results(tablename)
+        self.refresh_schema()
+
+    def commit_schema_change(self):
+        """
+        Schema changes are committed right away, except inside a transaction block
+        (where the databases with transactional DDL can still roll them back)
+        """
+        if not self.in_transaction:
+            self.commit()
 
 
-    def raw(self, sql):
+    def raw(self, sql, params=None):
         """
         Execute raw sql
         :Parameters:
 
         - sql: string, sql to be executed
+        - params: optional list of values for the placeholders in sql,
+          written in the paramstyle of the database driver
 
         :Return: the result of this execution
 
-        If it's a select, return a list with each element be a DataRow instance
+        If it's a select, return a list with each element be a Row instance
 
         Otherwise return raw result from the cursor (Should be insert or update or delete)
 
         """
-        res = self.cursor.execute(sql)
-        if self.cursor.description is None:
-            return res
+        def fetch(cursor):
+            if cursor.description is None:
+                return None
+            columns = [d[0] for d in cursor.description]
+            return map(row_class(columns), cursor.fetchall())
 
-        rows = self.cursor.fetchall()
-        columns = [d[0] for d in self.cursor.description]
+        cursor = self.cursor
+        result = self.execute(cursor, sql, params, fetch=fetch)
+        if cursor.description is None:
+            # Not a query, so it is committed according to the transaction mode. The
+            # tables it changed are unknown, so all cached results are dropped
+            self.invalidate_results()
+            self.after_write()
+        if is_schema_change(sql):
+            self.refresh_schema()
+        return result
 
-        structured_rows = []
-        for row in rows:
-            data = {}
-            for val, col in zip(row, columns):
-                data[col] = val
-            structured_rows.append(DataRow(data))
 
-        return structured_rows
+SCHEMA_CHANGING_STATEMENTS = ('CREATE', 'ALTER', 'DROP', 'RENAME', 'TRUNCATE')
 
-    
+def is_schema_change(sql):
+    words = sql.split(None, 1)
+    return len(words) > 0 and words[0].upper() in SCHEMA_CHANGING_STATEMENTS
+
+
+class _PooledConnection(object):
+    """
+    A connection checked out from a pool for one thread, with the thread's cursor.
+    If the thread ends without releasing it, the connection goes back to the pool
+    when this object is garbage collected
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = None
+        self.connection = pool.checkout()
+        self.cursor = self.connection.cursor()
+        self.transaction = _TransactionState()
+
+    def release(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            self.pool.checkin(connection)
+
+    def __del__(self):
+        self.release()
+
+
+class _TransactionState(object):
+    """
+    The transaction of one connection: the depth of the transaction blocks it is in,
+    the writes not committed yet in GROUP mode and the tables they changed
+    """
 
+    def __init__(self):
+        self.depth = 0
+        self.token = None
+        self.reset()
+
+    def reset(self):
+        self.pending_writes = 0
+        self.first_write_at = None
+        # Whether there are uncommitted writes
+        self.dirty = False
+        # The names of the tables written to, None standing for all tables
+        self.written = set()
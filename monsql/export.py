@@ -0,0 +1,86 @@
+# coding=utf-8
+"""
+Streaming export of query results to CSV or JSON Lines, used by QuerySet.export.
+
+Rows are written from the tuples fetched by the cursor, one batch at a time, so the
+memory used depends on the batch size, not on the size of the result. Values are
+written as they are passed to the database (see query.value_to_sql_param): dates and
+datetimes as '2015-01-02' and '2015-01-02 10:00:00'. CSV is written in UTF-8, with NULL
+as an empty value. In JSON Lines, each row is an object with the fields in their order,
+and non-ASCII characters are escaped.
+"""
+
+import csv
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from query import value_to_sql_param
+from exception import MonSQLException
+
+FORMATS = ('csv', 'jsonl')
+
+
+def check_format(format):
+    if format not in FORMATS:
+        raise MonSQLException('UNKNOWN EXPORT FORMAT %r, EXPECTED ONE OF %s' %(format, ', '.join(FORMATS)))
+    return format
+
+
+def export_rows(fileobj, format, fields, batches, header=True):
+    """
+    Write the rows of batches (an iterable of lists of tuples ordered as fields) to
+    fileobj in format
+
+    :Return: the number of rows written
+    """
+    if check_format(format) == 'csv':
+        return export_csv(fileobj, fields, batches, header)
+    return export_jsonl(fileobj, fields, batches)
+
+
+def export_csv(fileobj, fields, batches, header=True):
+    writer = csv.writer(fileobj)
+    if header:
+        writer.writerow([csv_value(field) for field in fields])
+
+    count = 0
+    for data_list in batches:
+        writer.writerows([[csv_value(value) for value in row] for row in data_list])
+        count += len(data_list)
+    return count
+
+
+def csv_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (datetime, date)):
+        return value_to_sql_param(value)
+    return value
+
+
+def export_jsonl(fileobj, fields, batches):
+    # With ensure_ascii, the encoded values are ASCII str whatever the type of the text
+    encode = json.JSONEncoder(default=json_default, separators=(',', ':')).encode
+    # The encoded '"field":' of each field
+    keys = [encode(field) + ':' for field in fields]
+
+    count = 0
+    for data_list in batches:
+        lines = []
+        for row in data_list:
+            lines.append('{%s}\n' %(','.join([key + encode(value) for key, value in zip(keys, row)])))
+        fileobj.write(''.join(lines))
+        count += len(data_list)
+    return count
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value_to_sql_param(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (buffer, bytearray)):
+        return str(value).encode('base64')
+    raise TypeError('%r is not JSON serializable' %(value, ))
@@ -0,0 +1,216 @@
+# coding=utf-8
+"""
+Bulk loading: Table.load streams rows into a table through the fastest path of each
+database, reading them from an iterable (a generator for instance) as they are sent,
+so that memory use does not depend on the number of rows.
+
+- PostgreSQL: COPY ... FROM STDIN, the rows being encoded as CSV while psycopg2 reads them
+- MySQL: LOAD DATA LOCAL INFILE, spooling the rows to a temporary file at a time
+  (the database must be created with local_infile=True, otherwise rows are inserted
+  with executemany like below). Rows it skips or values it truncates with a warning
+  fail the load, as they would fail an INSERT
+- SQLite3, and any other database: executemany of one INSERT statement on batches of
+  rows. SQLite3 also sets synchronous=OFF while loading
+
+The load is one transaction (a savepoint inside a transaction block), committed when
+all rows are loaded.
+
+:Examples:
+
+>>> def rows():
+>>>     for line in open('users.tsv'):
+>>>         yield line.rstrip('\\n').split('\\t')
+>>> def report(progress):
+>>>     print '%d rows, %.0f rows/s' %(progress.rows, progress.rows_per_second)
+>>> user_table.load(rows(), columns=['name', 'email'], progress=report)
+LoadProgress(rows=1000000, seconds=4.21, rows_per_second=237529)
+"""
+
+import time
+from datetime import datetime, date
+from itertools import chain, islice
+from query import value_to_sql_param
+from exception import MonSQLException
+
+
+class LoadProgress(object):
+    """
+    How far a load is: the number of rows read so far and the seconds elapsed since it
+    started. Passed to the progress callback, and returned by Table.load when done
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.seconds = 0.0
+        self.started_at = time.time()
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.rows / self.seconds
+
+    def __repr__(self):
+        return 'LoadProgress(rows=%d, seconds=%.2f, rows_per_second=%.0f)' %(self.rows, self.seconds,
+                                                                             self.rows_per_second)
+
+
+class RowReader(object):
+    """
+    Iterate over rows (dicts or sequences of values ordered as columns) as tuples of
+    the values of columns, calling progress(LoadProgress) every progress_every rows
+    """
+
+    def __init__(self, rows, columns, progress=None, progress_every=100000):
+        self.rows = rows
+        self.columns = columns
+        self.progress = LoadProgress()
+        self.callback = progress
+        self.progress_every = progress_every
+
+    def __iter__(self):
+        columns = self.columns
+        progress = self.progress
+        next_report = self.progress_every
+        for row in self.rows:
+            if isinstance(row, dict):
+                values = tuple([row.get(column) for column in columns])
+            else:
+                values = tuple(row)
+                if len(values) != len(columns):
+                    raise MonSQLException('EXPECTED %d VALUES IN ROW %d, GOT %d' %(len(columns), progress.rows,
+                                                                                   len(values)))
+            yield values
+
+            progress.rows += 1
+            if self.callback is not None and progress.rows >= next_report:
+                next_report += self.progress_every
+                progress.seconds = time.time() - progress.started_at
+                self.callback(progress)
+
+    def batches(self, size):
+        """
+        Iterate over the rows in lists of at most size rows
+        """
+        rows = iter(self)
+        while True:
+            batch = list(islice(rows, size))
+            if not batch:
+                return
+            yield batch
+
+    def finish(self):
+        progress = self.progress
+        progress.seconds = time.time() - progress.started_at
+        if self.callback is not None:
+            self.callback(progress)
+        return progress
+
+
+def load_columns(table, rows, columns):
+    """
+    The columns loaded when none are given: the columns of the table, or for dicts, the
+    keys of the first one. Since rows may be a generator, the rows are returned too
+
+    :Return: a tuple (columns, rows)
+    """
+    if columns is not None:
+        return list(columns), rows
+
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return list(table.columns), []
+
+    if isinstance(first, dict):
+        columns = [column for column in table.columns if column in first]
+        columns += sorted([key for key in first.keys() if key not in columns])
+    else:
+        columns = list(table.columns)
+    return columns, chain([first], rows)
+
+
+def copy_csv_line(values):
+    """
+    A line of the CSV format of PostgreSQL's COPY, where NULL is an empty unquoted value
+    """
+    return ','.join([copy_csv_value(value) for value in values]) + '\n'
+
+
+def copy_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (datetime, date)):
+        return value_to_sql_param(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return '"%s"' %(value.replace('"', '""'))
+
+
+def tsv_line(values):
+    """
+    A line of the default format of MySQL's LOAD DATA: tab separated, with special
+    characters escaped with a backslash and NULL written \\N
+    """
+    return '\t'.join([tsv_value(value) for value in values]) + '\n'
+
+
+TSV_ESCAPES = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'), ('\0', '\\0')]
+
+
+def tsv_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (datetime, date)):
+        return value_to_sql_param(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    for character, escaped in TSV_ESCAPES:
+        value = value.replace(character, escaped)
+    return value
+
+
+class LineStream(object):
+    """
+    A read-only file whose content is the lines produced by an iterator, produced as
+    they are read
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                break
+            parts.append(line)
+            length += len(line)
+
+        data = ''.join(parts)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""
+Parallel scans: the rows of a query split into ranges of a key column (the primary key
+by default), scanned concurrently by worker threads, each on its own connection of a
+pooled database. The database drivers release the GIL while waiting for the server, so
+the partitions are read in parallel by as many server processes.
+
+Integer keys are split into ranges of equal width between their MIN and MAX, which
+suits auto-incremented ids. Other keys are split at quantiles of the key, found with one
+ORDER BY key LIMIT 1 OFFSET n query per boundary, which gives partitions of the same
+number of rows however the values are distributed. When the key is not the primary key,
+the rows where it is NULL are one more partition.
+
+:Examples:
+
+>>> db = MonSQL(host, port, username, password, dbname, dbtype=DB_TYPES.POSTGRESQL, pool_size=9)
+>>> def process(partition, rows):
+>>>     ... # called by the worker threads with each batch of rows
+>>> counts = db.get('event').parallel_scan({'state': 2}, callback=process, partitions=16)
+"""
+
+from multiprocessing.pool import ThreadPool
+from query import and_conditions
+from config import ASCENDING
+from exception import MonSQLException
+
+
+def parallel_scan(table, filter=None, fields=None, partitions=None, workers=None, callback=None,
+                  batch_size=1000, key=None):
+    """
+    See Table.parallel_scan
+    """
+    database = table.database
+    if database is None or database.pool is None:
+        raise MonSQLException('PARALLEL SCANS REQUIRE A POOLED DATABASE')
+
+    if workers is None:
+        # One connection is left for the calling thread
+        workers = max(database.pool.max_size - 1, 1)
+    if partitions is None:
+        partitions = workers
+    if workers < 1 or partitions < 1:
+        raise MonSQLException('PARALLEL SCANS NEED AT LEAST ONE WORKER AND ONE PARTITION')
+
+    if key is None:
+        primary_key = table.schema.primary_key
+        if len(primary_key) != 1:
+            raise MonSQLException('TABLE %s HAS NO SINGLE COLUMN PRIMARY KEY, A KEY MUST BE GIVEN' %(table.name))
+        key = primary_key[0]
+
+    conditions = [filter if condition is None else and_conditions(filter, {key: condition})
+                  for condition in key_ranges(table, key, filter, partitions)]
+
+    def scan(index, condition):
+        with database.connection():
+            try:
+                query_set = table.find(condition or {}, fields=fields)
+                if callback is None:
+                    return list(query_set)
+                count = 0
+                for rows in query_set.iter_batches(batch_size):
+                    callback(index, rows)
+                    count += len(rows)
+                return count
+            finally:
+                database.rollback()
+
+    executor = ThreadPool(min(workers, len(conditions)) or 1)
+    try:
+        pending = [executor.apply_async(scan, (index, condition)) for index, condition in enumerate(conditions)]
+        results = [result.get() for result in pending]
+    except:
+        executor.terminate()
+        raise
+    executor.close()
+    executor.join()
+    return results
+
+
+def key_ranges(table, key, filter, partitions):
+    """
+    Split the values of key in the rows of table matching filter into at most
+    partitions ranges, covering all values together
+
+    :Return: a list of conditions on key ({'$gte': ..., '$lt': ...}, or {'$eq': None}
+      for the NULL values of a key which is not the primary key), None standing for all
+      values, or an empty list if no row matches
+    """
+    if list(table.schema.primary_key) == [key]:
+        nulls = []
+    else:
+        nulls = [{'$eq': None}]
+
+    pipeline = [{'$group': {'_id': None, 'low': {'$min': '$' + key}, 'high': {'$max': '$' + key}}}]
+    if filter:
+        pipeline.insert(0, {'$match': filter})
+    bounds = table.aggregate(pipeline)[0]
+    low, high = bounds.low, bounds.high
+    if low is None:
+        # No row, or only NULL keys
+        return nulls
+    if partitions == 1 or low == high:
+        return [None]
+
+    if isinstance(low, (int, long)) and isinstance(high, (int, long)) and not isinstance(low, bool):
+        width = max((high - low + partitions) // partitions, 1)
+        boundaries = range(low + width, high + 1, width)
+    else:
+        count = table.count(filter)
+        boundaries = []
+        for index in range(1, partitions):
+            values = table.find(filter or {}, fields=[key], sort=[(key, ASCENDING)], skip=index * count // partitions,
+                                limit=1).values_list(key, flat=True)
+            if values and values[0] != low and (not boundaries or values[0] != boundaries[-1]):
+                boundaries.append(values[0])
+
+    if not boundaries:
+        return [None]
+    ranges = [{'$lt': boundaries[0]}]
+    for start, end in zip(boundaries, boundaries[1:]):
+        ranges.append({'$gte': start, '$lt': end})
+    ranges.append({'$gte': boundaries[-1]})
+    return ranges + nulls
@@ -0,0 +1,150 @@
+# coding=utf-8
+
+import threading
+import time
+from collections import deque
+from exception import MonSQLException
+
+class ConnectionPool(object):
+    """
+    A pool of DB-API connections shared by several threads.
+
+    Connections are created by calling connect(). At least min_size connections
+    are kept open and at most max_size exist at the same time; a checkout waits up
+    to timeout seconds for a connection to be returned before failing. Idle
+    connections are health-checked when they are checked out, and replaced if the
+    check fails.
+
+    A Database constructed with a pool binds one connection to each thread; see
+    Database.release and Database.connection
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30, health_check=None):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise MonSQLException('INVALID POOL SIZE: min_size=%s, max_size=%s' %(min_size, max_size))
+
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check = health_check or ping
+        self.__idle = deque()
+        self.__size = 0
+        self.__closed = False
+        self.__condition = threading.Condition(threading.RLock())
+
+        for i in range(min_size):
+            self.__idle.append(self.connect())
+            self.__size += 1
+
+    @property
+    def size(self):
+        """
+        The number of open connections, idle or checked out
+        """
+        return self.__size
+
+    @property
+    def idle_count(self):
+        return len(self.__idle)
+
+    def checkout(self):
+        """
+        Return a connection for the exclusive use of the caller, who must give it
+        back with checkin
+        """
+        deadline = time.time() + self.timeout
+        with self.__condition:
+            while True:
+                if self.__closed:
+                    raise MonSQLException('CONNECTION POOL IS CLOSED')
+
+                if self.__idle:
+                    connection = self.__idle.popleft()
+                    if self.__is_healthy(connection):
+                        return connection
+                    self.__discard(connection)
+                    continue
+
+                if self.__size < self.max_size:
+                    # Reserve the slot before connecting, so the lock is not held while connecting
+                    self.__size += 1
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise MonSQLException('NO CONNECTION AVAILABLE IN %s SECONDS' %(self.timeout))
+                self.__condition.wait(remaining)
+
+        try:
+            return self.connect()
+        except:
+            with self.__condition:
+                self.__size -= 1
+                self.__condition.notify()
+            raise
+
+    def checkin(self, connection):
+        """
+        Return a connection to the pool. Uncommitted changes are rolled back
+        """
+        try:
+            connection.rollback()
+        except Exception:
+            with self.__condition:
+                self.__discard(connection)
+                self.__condition.notify()
+            return
+
+        with self.__condition:
+            if self.__closed:
+                self.__discard(connection)
+            else:
+                self.__idle.append(connection)
+            self.__condition.notify()
+
+    def close(self):
+        """
+        Close all idle connections. Connections checked out are closed when they are returned
+        """
+        with self.__condition:
+            self.__closed = True
+            while self.__idle:
+                self.__discard(self.__idle.popleft())
+            self.__condition.notify_all()
+
+    def __is_healthy(self, connection):
+        try:
+            return self.health_check(connection) is not False
+        except Exception:
+            return False
+
+    def __discard(self, connection):
+        self.__size -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def ping(connection):
+    """
+    The default health check: run a trivial query
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def connect_or_pool(connect, pool_size=None, pool_min_size=1, pool_timeout=30):
+    """
+    Used by the Database subclasses: return a single connection if pool_size is None,
+    otherwise a ConnectionPool of at most pool_size connections
+    """
+    if pool_size is None:
+        return connect()
+    return ConnectionPool(connect, min_size=min(pool_min_size, pool_size), max_size=pool_size,
+                          timeout=pool_timeout)
@@ -0,0 +1,154 @@
+# coding=utf-8
+"""
+Instrumentation of the statements run by MonSQL.
+
+Hooks are objects with before_execute(statement) and after_execute(statement)
+methods, registered with Database.add_hook. They receive a Statement describing
+the compiled sql, its params and how long each phase took.
+
+:Examples:
+
+>>> profiler = QueryProfiler()
+>>> db.add_hook(profiler)
+>>> ... # run the application
+>>> print profiler.format_report(top=10)
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+class Statement(object):
+    """
+    One execution of a sql statement. Times are in seconds:
+
+    - compile_time: building the sql from the query (0 for raw sql)
+    - execute_time: cursor.execute
+    - fetch_time: reading the result and building the row objects
+
+    row_count is the number of rows fetched, or the number of rows affected for
+    statements returning no rows (None if the driver does not tell). error is the
+    exception raised, if any. All times are None until after_execute.
+    """
+
+    def __init__(self, sql, params=None, compile_time=0.0):
+        self.sql = sql
+        self.params = params
+        self.compile_time = compile_time
+        self.execute_time = None
+        self.fetch_time = None
+        self.row_count = None
+        self.error = None
+        self.started_at = time.time()
+
+    @property
+    def total_time(self):
+        return (self.compile_time or 0.0) + (self.execute_time or 0.0) + (self.fetch_time or 0.0)
+
+    def __repr__(self):
+        return 'Statement(%r, %r)' %(self.sql, self.params)
+
+
+class ExecutionHook(object):
+    """
+    Base class for hooks. Both methods do nothing by default
+    """
+
+    def before_execute(self, statement):
+        pass
+
+    def after_execute(self, statement):
+        pass
+
+
+class LoggingHook(ExecutionHook):
+    """
+    Log every statement, its params and timings to a logger ('monsql' by default)
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('monsql')
+        self.level = level
+
+    def after_execute(self, statement):
+        self.logger.log(self.level, '%.2fms (compile %.2fms, execute %.2fms, fetch %.2fms) rows=%s: %s %r',
+                        statement.total_time * 1000, (statement.compile_time or 0) * 1000,
+                        (statement.execute_time or 0) * 1000, (statement.fetch_time or 0) * 1000,
+                        statement.row_count, statement.sql, statement.params)
+
+
+class StatementSummary(object):
+    """
+    Aggregated timings of all executions of one sql statement
+    """
+
+    def __init__(self, sql, count, total_time, rows, errors, samples):
+        self.sql = sql
+        self.count = count
+        self.total_time = total_time
+        self.rows = rows
+        self.errors = errors
+        samples = sorted(samples)
+        self.p50 = percentile(samples, 0.5)
+        self.p99 = percentile(samples, 0.99)
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return 'StatementSummary(%r, count=%d, total=%.4fs, p50=%.4fs, p99=%.4fs)' \
+            %(self.sql, self.count, self.total_time, self.p50, self.p99)
+
+
+class QueryProfiler(ExecutionHook):
+    """
+    A hook aggregating the executions by sql text. Since values are passed as
+    params, all executions of the same query shape are aggregated together.
+    Percentiles are computed over the last max_samples executions of each statement
+    """
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__stats = {}
+
+    def after_execute(self, statement):
+        with self.__lock:
+            stats = self.__stats.get(statement.sql)
+            if stats is None:
+                stats = self.__stats[statement.sql] = [0, 0.0, 0, 0, deque(maxlen=self.max_samples)]
+            stats[0] += 1
+            stats[1] += statement.total_time
+            stats[2] += statement.row_count if statement.row_count > 0 else 0
+            stats[3] += 1 if statement.error is not None else 0
+            stats[4].append(statement.total_time)
+
+    def report(self, top=10):
+        """
+        Return the StatementSummary of the top statements by total time
+        """
+        with self.__lock:
+            summaries = [StatementSummary(sql, count, total_time, rows, errors, samples)
+                         for sql, (count, total_time, rows, errors, samples) in self.__stats.items()]
+        summaries.sort(key=lambda summary: summary.total_time, reverse=True)
+        return summaries[:top]
+
+    def format_report(self, top=10):
+        lines = ['%10s %8s %10s %10s %10s %10s  %s' %('total(ms)', 'count', 'mean(ms)', 'p50(ms)', 'p99(ms)', 'rows', 'sql')]
+        for summary in self.report(top):
+            lines.append('%10.2f %8d %10.3f %10.3f %10.3f %10d  %s' %(summary.total_time * 1000, summary.count,
+                         summary.mean_time * 1000, summary.p50 * 1000, summary.p99 * 1000, summary.rows,
+                         ' '.join(summary.sql.split())))
+        return '\n'.join(lines)
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[int(round((len(sorted_samples) - 1) * fraction))]
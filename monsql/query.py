@@ -3,6 +3,7 @@
 import copy, types
 from datetime import datetime, date
 from exception import MonSQLException
+from config import ASCENDING, DESCENDING
 
 
 class Query:
@@ -31,23 +32,38 @@ class Query:
         self.alias = alias
 
     def clone(self):
-        return Query(source=copy.deepcopy(self.source), 
-                 filter=copy.deepcopy(self.filter), 
-                 fields=copy.deepcopy(self.fields), 
-                 skip=self.skip, 
-                 limit=self.limit,
-                 sort=copy.deepcopy(self.sort),
-                 distinct=self.distinct,
-                 alias=copy.deepcopy(self.alias))   
+        """
+        A copy sharing filter, fields and sort with this query. They are never modified
+        in place, only replaced, so a chain of query sets does not copy them at each step
+        """
+        return copy.copy(self)
 
     def add_filter(self, obj):
         """
         Add a filter condition. Return self
         """
-        self.filter = {'$and': [obj, self.filter]}
+        self.filter = and_conditions(self.filter, obj)
         return self
 
 
+def and_conditions(condition, other):
+    """
+    Return a new condition true when both are. The $and lists of both are flattened
+    into one, so chaining filters does not nest the condition deeper each time
+    """
+    if not condition:
+        return other
+    if not other:
+        return condition
+    return {u'$and': _and_operands(condition) + _and_operands(other)}
+
+
+def _and_operands(condition):
+    if condition.keys() == [u'$and']:
+        return list(condition[u'$and'])
+    return [condition]
+
+
 def value_to_sql_str(v):
     """
     transform a python variable to the appropriate representation in SQL
@@ -70,24 +86,46 @@ def value_to_sql_str(v):
     return str(v)
 
 
+def value_to_sql_param(v):
+    """
+    transform a python variable to the value passed to the database driver as a
+    parameter. Dates and datetimes are formatted the same way as value_to_sql_str does,
+    so the stored values do not depend on whether a value is inlined or bound
+    """
+    if isinstance(v, datetime):
+        return v.strftime("%Y-%m-%d %H:%M:%S")
+
+    if isinstance(v, date):
+        return v.strftime("%Y-%m-%d")
+
+    return v
+
+
 class QueryCondition:
 
     MYSQL_RESERVE_WORDS                 = (u'index', )
     COMPLEX_QUERY_INDICATOR             = (u'$not', u'$and', u'$or')
+    COMPARISON_OPERATORS                = {u'$eq': u'=', u'$gte': u'>=', u'$gt': u'>', u'$lt': u'<', u'$lte': u'<='}
 
 
-    def __init__(self, condition):
+    def __init__(self, condition, placeholder=u'%s'):
         """
         condition: a dictionary, example: {'id': 1} => id == 1
+        placeholder: the parameter marker of the database driver, '%s' or '?'
         """
         self.condition = condition
+        self.placeholder = placeholder
 
     def to_sql(self):
         """
-        This function build a sql condition string (those used in the 'WHERE' clause) based on given condition
+        This function build a sql condition string (those used in the 'WHERE' clause) based on given condition.
+        Values are not written into the sql. Instead a placeholder is used for each of them, and
+        the values are returned separately so they can be passed to cursor.execute
+
         Supported match pattern:
 
         {a: 1}                              -> a == 1
+        {a: None}, {a: {$eq: None}}         -> a IS NULL
         {a: {$gt: 1}}                       -> a > 1
         {a: {$gte: 1}}                      -> a >= 1
         {a: {$lt: 1}}                       -> a < 1
@@ -101,18 +139,21 @@ class QueryCondition:
         {$and: [condition1, condition2]}    -> condition1 and condition2
         {$or: [condition1, condition2]}     -> condition1 or condition2
 
+        :Return: a tuple (sql, params). sql is None when there is no condition
+
         """
         condition = self.condition
         if condition:
             # If the condition is not None nor empty
             if len(condition.keys()) > 1:
                 
-                # If in the form of {'a': 1, 'b': 2}, simplify to {'$and': [{'a': 1, 'b': 2}]}
+                # If in the form of {'a': 1, 'b': 2}, simplify to {'$and': [{'a': 1}, {'b': 2}]}
+                # Keys are sorted so that the order of params does not depend on the dict
                 split_conditions = []
-                for key in condition.keys():
+                for key in sorted(condition.keys()):
                     split_conditions.append({key: condition[key]})
 
-                return QueryCondition({'$and': split_conditions}).to_sql()
+                return self.__sub_condition({'$and': split_conditions})
 
             else:
                 query_field, query_value = condition.items()[0]
@@ -121,11 +162,11 @@ class QueryCondition:
                     # This is a composite query
 
                     if u'$not' == query_field:
-                        not_condition = QueryCondition(query_value).to_sql()
+                        not_condition, params = self.__sub_condition(query_value)
                         if not_condition is not None:
-                            return 'NOT (%s)' %(not_condition)
+                            return 'NOT (%s)' %(not_condition), params
                         else:
-                            return None
+                            return None, []
 
                     if query_field in (u'$or', u'$and', ):
                         conditions = query_value
@@ -133,17 +174,22 @@ class QueryCondition:
                             raise MonSQLException('QUERY VALUE FOR KEY %s MUST BE LIST WITH LENGTH BEING AT LEAST 2' %(query_field))
 
                         # compute sub conditions recursively
-                        conditions = map(lambda c: QueryCondition(c).to_sql(), conditions)
-                        conditions = filter(lambda c: c is not None, conditions)
+                        sql_list = []
+                        params = []
+                        for c in conditions:
+                            sub_sql, sub_params = self.__sub_condition(c)
+                            if sub_sql is not None:
+                                sql_list.append(sub_sql)
+                                params.extend(sub_params)
 
                         # join them together
-                        if len(conditions) > 0:
+                        if len(sql_list) > 0:
                             if query_field == u'$or':
-                                return ' OR '.join(conditions)
+                                return '(%s)' %(' OR '.join(sql_list)), params
                             elif query_field == u'$and':
-                                return ' AND '.join(conditions)
+                                return '(%s)' %(' AND '.join(sql_list)), params
                         else:
-                            return None
+                            return None, []
                     else:
                         raise MonSQLException('Unsupport query_field')
                 else:
@@ -160,34 +206,277 @@ class QueryCondition:
                         # Deal with situation like a: {'$gt': 1, '$lt': 10}
                         # Split into {$and: [a: {'$gt': 1}, a: {'$lt': 10}]}
                         split_conditions = []
-                        for key in query_value.keys():
-                            split_conditions.append(QueryCondition({query_field: {key: query_value[key]}}))
+                        for key in sorted(query_value.keys()):
+                            split_conditions.append({query_field: {key: query_value[key]}})
 
-                        return QueryCondition({'$and': split_conditions}).to_sql()
+                        return self.__sub_condition({'$and': split_conditions})
                     else:
                         # The simple case of {a: {$complex_operator: 1}}
                         complex_operator = query_value.keys()[0] # the complex operator
                         target_value = query_value[complex_operator]
+                        placeholder = self.placeholder
 
                         query_str = None
+                        params = []
                         if u"$contains" == complex_operator:
-                            query_str = u"LIKE " + value_to_sql_str('%' + target_value + '%')
+                            query_str = u"LIKE " + placeholder
+                            params.append('%' + target_value + '%')
+
+                        elif u'$eq' == complex_operator and target_value is None:
+                            query_str = u"IS NULL"
 
-                        elif complex_operator in ('$eq', '$gte', '$gt', '$lt', '$lte'):
-                            map_dic = {'$eq': '=', '$gte': '>=', '$gt': '>', '$lt': '<', '$lte': '<='}
-                            query_str = map_dic[complex_operator] + value_to_sql_str(target_value)
+                        elif complex_operator in QueryCondition.COMPARISON_OPERATORS:
+                            query_str = QueryCondition.COMPARISON_OPERATORS[complex_operator] + placeholder
+                            params.append(value_to_sql_param(target_value))
 
                         elif u'$in' == complex_operator:
-                            if len(target_value) == 0:
+                            if isinstance(target_value, InArrayValues):
+                                query_str = target_value.in_array.sql %(placeholder) + u" "
+                                params.append(target_value.param())
+                            elif len(target_value) == 0:
                                 query_str = u"IN (null) "
                             else:
-                                query_str = u"IN (" + u','.join([str(_v_) for _v_ in target_value]) + u") "
+                                params.extend([value_to_sql_param(_v_) for _v_ in pad_in_list(target_value)])
+                                query_str = u"IN (" + u','.join([placeholder] * len(params)) + u") "
                         else:
                             raise MonSQLException(u"Unsupport complex query: %s" %(complex_operator))
 
-                        return query_field + ' ' + query_str
+                        return query_field + ' ' + query_str, params
         else:
-            return None
+            return None, []
 
         # For testing
         assert False
+
+    def __sub_condition(self, condition):
+        return QueryCondition(condition, placeholder=self.placeholder).to_sql()
+
+
+def in_list_size(n):
+    """
+    The number of placeholders used for an $in list of n values: n rounded up to a
+    power of two, so lists of similar length compile to the same sql. The list is
+    padded by repeating its last value, which does not change the result of IN
+    """
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+
+def pad_in_list(values):
+    values = list(values)
+    return values + values[-1:] * (in_list_size(len(values)) - len(values))
+
+
+class InArray(object):
+    """
+    How a database tests whether a value is in a list passed as one param. It is used
+    for $in lists of more than threshold values instead of one placeholder per value,
+    which makes statements slow to parse and can exceed the maximum number of params.
+    sql is the condition with %s standing for the placeholder (e.g. u'= ANY(%s)'), and
+    to_param converts the list of values into the param. If convert is True, the values
+    are first converted with value_to_sql_param (dates to strings); drivers which adapt
+    lists of dates themselves get them as they are, so the array has their type
+    """
+
+    def __init__(self, sql, threshold, to_param=list, convert=True):
+        self.sql = sql
+        self.threshold = threshold
+        self.to_param = to_param
+        self.convert = convert
+
+
+class InArrayValues(object):
+    """
+    An $in list to pass as one param according to an InArray, see bind_in_arrays
+    """
+
+    __slots__ = ('in_array', 'values')
+
+    def __init__(self, in_array, values):
+        self.in_array = in_array
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def param(self):
+        if not self.in_array.convert:
+            return self.in_array.to_param(self.values)
+        return self.in_array.to_param([value_to_sql_param(v) for v in self.values])
+
+
+def bind_in_arrays(condition, in_array):
+    """
+    Return condition with its $in lists of more than in_array.threshold values wrapped
+    in InArrayValues, so they compile to in_array.sql. condition itself is returned if
+    there is no such list (or in_array is None)
+    """
+    if in_array is None or not condition:
+        return condition
+
+    bound = None
+    for query_field, query_value in condition.items():
+        if query_field == u'$not':
+            value = bind_in_arrays(query_value, in_array)
+        elif query_field in (u'$or', u'$and'):
+            value = [bind_in_arrays(c, in_array) for c in query_value]
+            if all([v is c for v, c in zip(value, query_value)]):
+                value = query_value
+        elif isinstance(query_value, dict) and isinstance(query_value.get(u'$in'), (list, tuple)) \
+                and len(query_value[u'$in']) > in_array.threshold:
+            value = dict(query_value)
+            value[u'$in'] = InArrayValues(in_array, query_value[u'$in'])
+        else:
+            continue
+
+        if value is not query_value:
+            if bound is None:
+                bound = dict(condition)
+            bound[query_field] = value
+
+    return condition if bound is None else bound
+
+
+def split_in_condition(condition, chunk_size):
+    """
+    If condition requires a column to be in a list of more than chunk_size values (an
+    $in which is not under $or or $not), return the conditions obtained by splitting the
+    distinct values of the list in chunks of chunk_size. Each row matching condition
+    matches exactly one of them. Otherwise return None
+    """
+    if not condition:
+        return None
+
+    for query_field in sorted(condition.keys()):
+        query_value = condition[query_field]
+        if query_field == u'$and':
+            for index, c in enumerate(query_value):
+                split = split_in_condition(c, chunk_size)
+                if split is not None:
+                    return [_replace(condition, query_field, query_value[:index] + [s] + query_value[index + 1:])
+                            for s in split]
+
+        elif not query_field.startswith(u'$') and isinstance(query_value, dict) \
+                and isinstance(query_value.get(u'$in'), (list, tuple)) and len(query_value[u'$in']) > chunk_size:
+            values = []
+            seen = set()
+            for v in query_value[u'$in']:
+                if v not in seen:
+                    seen.add(v)
+                    values.append(v)
+            return [_replace(condition, query_field, _replace(query_value, u'$in', values[i:i + chunk_size]))
+                    for i in range(0, len(values), chunk_size)]
+
+    return None
+
+
+def _replace(dictionary, key, value):
+    dictionary = dict(dictionary)
+    dictionary[key] = value
+    return dictionary
+
+
+def condition_shape(condition):
+    """
+    Return a tuple (shape, params) for a filter condition. shape is a hashable
+    description of everything that determines the sql produced by QueryCondition.to_sql
+    (fields, operators, nesting, $in list sizes) but none of the values, and params are
+    the values in the order to_sql places them. Two conditions with the same shape
+    compile to the same sql, so the sql can be cached by shape.
+    """
+    if not condition:
+        return None, []
+
+    if len(condition) > 1:
+        return condition_shape({'$and': [{key: condition[key]} for key in sorted(condition.keys())]})
+
+    query_field, query_value = condition.items()[0]
+
+    if query_field == u'$not':
+        shape, params = condition_shape(query_value)
+        return (u'$not', shape), params
+
+    if query_field in (u'$or', u'$and'):
+        if not isinstance(query_value, list) or len(query_value) < 2:
+            raise MonSQLException('QUERY VALUE FOR KEY %s MUST BE LIST WITH LENGTH BEING AT LEAST 2' %(query_field))
+
+        shapes = []
+        params = []
+        for c in query_value:
+            sub_shape, sub_params = condition_shape(c)
+            shapes.append(sub_shape)
+            params.extend(sub_params)
+        return (query_field, tuple(shapes)), params
+
+    if not type(query_value) is types.DictType:
+        query_value = {u'$eq': query_value}
+
+    if len(query_value) > 1:
+        return condition_shape({'$and': [{query_field: {key: query_value[key]}} for key in sorted(query_value.keys())]})
+
+    complex_operator, target_value = query_value.items()[0]
+    if complex_operator == u'$contains':
+        return (query_field, complex_operator), ['%' + target_value + '%']
+
+    if complex_operator == u'$eq' and target_value is None:
+        return (query_field, complex_operator, None), []
+
+    if complex_operator in QueryCondition.COMPARISON_OPERATORS:
+        return (query_field, complex_operator), [value_to_sql_param(target_value)]
+
+    if complex_operator == u'$in':
+        if isinstance(target_value, InArrayValues):
+            return (query_field, complex_operator, target_value.in_array.sql), [target_value.param()]
+        if len(target_value) == 0:
+            return (query_field, complex_operator, 0), []
+        params = [value_to_sql_param(_v_) for _v_ in pad_in_list(target_value)]
+        return (query_field, complex_operator, len(params)), params
+
+    raise MonSQLException(u"Unsupport complex query: %s" %(complex_operator))
+
+
+def condition_columns(condition):
+    """
+    Return the set of column names a filter condition refers to
+    """
+    columns = set()
+    if not condition:
+        return columns
+
+    for query_field, query_value in condition.items():
+        if query_field == u'$not':
+            columns.update(condition_columns(query_value))
+        elif query_field in (u'$or', u'$and'):
+            for c in query_value:
+                columns.update(condition_columns(c))
+        else:
+            columns.add(query_field)
+    return columns
+
+
+def keyset_condition(sort, values):
+    """
+    Return a filter condition selecting the rows after the row with the given values
+    for the sort columns, in the order defined by sort (a list of (column, ASCENDING or
+    DESCENDING) tuples), e.g. for [('a', ASCENDING), ('b', DESCENDING)] and values (1, 2):
+
+    {$and: [{a: {$gte: 1}}, {$or: [{a: {$gt: 1}}, {$and: [{a: 1}, {b: {$lt: 2}}]}]}]}
+
+    The leading bound on the first column is redundant, but lets the database use an
+    index on it. Rows with NULL in a sort column are never selected
+    """
+    conditions = []
+    for index, (column, direction) in enumerate(sort):
+        operator = u'$gt' if direction == ASCENDING else u'$lt'
+        parts = [{c: {u'$eq': v}} for (c, d), v in zip(sort[:index], values[:index])]
+        parts.append({column: {operator: values[index]}})
+        conditions.append(parts[0] if len(parts) == 1 else {u'$and': parts})
+
+    if len(conditions) == 1:
+        return conditions[0]
+
+    first_column, first_direction = sort[0]
+    bound = {first_column: {u'$gte' if first_direction == ASCENDING else u'$lte': values[0]}}
+    return {u'$and': [bound, {u'$or': conditions}]}
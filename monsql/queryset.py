@@ -1,10 +1,21 @@
 # coding=utf-8
 
-from query import Query
-from sql import build_select
+import copy
+import time
+from operator import itemgetter
+from query import Query, keyset_condition, bind_in_arrays, split_in_condition
+from config import ASCENDING, DESCENDING
+from sql import build_select, build_count, build_exists
 from exception import MonSQLException
+from cache import LRUCache
+from columnar import column_kind, fill_arrays, fill_numpy, import_numpy, to_records
+from export import check_format, export_rows
 
 class DataRow:
+    """
+    A row backed by a dict. Rows returned by queries are Row objects now, which
+    support the same access; this class is kept for code constructing rows itself
+    """
 
     def __init__(self, keyvalue_map):
         self.__data = keyvalue_map
@@ -21,16 +32,118 @@ class DataRow:
         return self.__data
 
 
+class Row(tuple):
+    """
+    A compact, read-only row: a tuple of the column values. Every result set shares
+    one generated subclass (see row_class) which maps each column name to its position,
+    so row.column and row.data work as with DataRow without a dict per row.
+
+    A column named like a tuple method (count, index) hides it: row.index is the value
+    of the column. Call tuple.index(row, value) for the method.
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    @property
+    def data(self):
+        """
+        A new dict mapping column names to the values of this row
+        """
+        return dict(zip(self._fields, self))
+
+    def __reduce__(self):
+        return (_rebuild_row, (self._fields, tuple(self)))
+
+    def __repr__(self):
+        # A str, so that repr and print work with non ASCII column names
+        fields = [field.encode('utf-8') if isinstance(field, unicode) else field for field in self._fields]
+        return 'Row(%s)' %(', '.join(['%s=%r' %(field, value) for field, value in zip(fields, self)]))
+
+
+# Names which must keep their meaning on Row subclasses
+_ROW_RESERVED_NAMES = ('data', '_fields')
+
+_row_classes = LRUCache(1024)
+
+def row_class(fields):
+    """
+    Return the Row subclass for results with the given column names, creating it the
+    first time. Each column becomes a property reading the value at its position.
+    """
+    fields = tuple(fields)
+    cls = _row_classes.get(fields)
+    if cls is None:
+        attributes = {'__slots__': (), '_fields': fields}
+        for index, field in enumerate(fields):
+            if field in _ROW_RESERVED_NAMES or field.startswith('__'):
+                continue
+            attributes[field] = property(itemgetter(index))
+        cls = type('Row', (Row,), attributes)
+        _row_classes.put(fields, cls)
+    return cls
+
+def project_fields(fields, projection):
+    """
+    Apply a MongoDB style projection dict to a list of fields: either the fields
+    marked 1 (in the order of fields), or all the fields but those marked 0
+    """
+    if not projection:
+        raise MonSQLException('A PROJECTION NEEDS AT LEAST ONE FIELD')
+
+    included = [field for field, value in projection.items() if value]
+    excluded = [field for field, value in projection.items() if not value]
+    if included and excluded:
+        raise MonSQLException('A PROJECTION CANNOT MIX INCLUDED AND EXCLUDED FIELDS')
+
+    for field in projection.keys():
+        if field not in fields:
+            raise MonSQLException('FIELD %s IS NOT SELECTED' %(field))
+
+    if included:
+        return [field for field in fields if field in included]
+
+    fields = [field for field in fields if field not in excluded]
+    if not fields:
+        raise MonSQLException('THE PROJECTION EXCLUDES ALL FIELDS')
+    return fields
+
+
+def _rebuild_row(fields, values):
+    return row_class(fields)(values)
+
+
 class QuerySet:
     """
-    Lazy load data
+    Lazy load data. filter, sort, skip, limit, distinct, only, exclude and project
+    return new query sets and leave this one unchanged, so they can be chained, and
+    a query set can be shared and refined in several ways. Nothing is compiled nor
+    run until the rows are needed
     """
 
-    def __init__(self, cursor, query):
-        self.cursor = cursor
+    def __init__(self, cursor, query, placeholder=u'%s', database=None, in_array=None, in_chunk_size=None):
+        """
+        in_array and in_chunk_size tell how the table handles long $in lists: passed as
+        one param (see monsql.query.InArray), or split into several queries on chunks of
+        in_chunk_size values whose results are merged
+        """
+        self._cursor = cursor
         self.query = query
+        self.placeholder = placeholder
+        self.database = database
+        self.in_array = in_array
+        self.in_chunk_size = in_chunk_size
         self._data = None
         self._need_to_refetch_data = False
+        # (sql, params) of the query by build function: the query of a query set is
+        # not changed once it is run, so it is compiled at most once per statement kind
+        self._compiled = {}
+
+    @property
+    def cursor(self):
+        if self.database is not None:
+            return self.database.cursor
+        return self._cursor
 
     """
     Python magic functions
@@ -39,41 +152,186 @@ class QuerySet:
         return self.count
 
     def __iter__(self):
-        if not self._data or self._need_to_refetch_data:
+        if not self._is_fetched():
             self._fetch_data()
         return iter(self._data)
 
     def __getitem__(self, k):
-        if not self._data or self._need_to_refetch_data:
+        if not self._is_fetched():
             self._fetch_data()
         return self._data[k]
 
 
     @property
     def count(self):
-        if not self._data or self._need_to_refetch_data:
-            self._fetch_data()
-        return len(self._data)
+        """
+        The number of rows. Unless the rows are already loaded, they are counted
+        by the database with SELECT COUNT(*) instead of being fetched
+        """
+        if self._is_fetched():
+            return len(self._data)
+
+        chunks = self._chunk_query_sets()
+        if chunks is not None:
+            count = max(sum([query_set.count for query_set in chunks]) - (self.query.skip or 0), 0)
+            if self.query.limit is not None:
+                count = min(count, self.query.limit)
+            return count
+
+        return self._run(build_count, lambda cursor: cursor.fetchone()[0])
+
+    def _is_fetched(self):
+        return self._data is not None and not self._need_to_refetch_data
+
+    def _compile(self, build=build_select):
+        compiled = self._compiled.get(build)
+        if compiled is None:
+            compiled = self._compiled[build] = self.__compile(build)
+        return compiled
+
+    def __compile(self, build):
+        query_cache = None
+        if self.database is not None:
+            query_cache = self.database.query_cache
+        query = self.query
+        filter = bind_in_arrays(query.filter, self.in_array)
+        if filter is not query.filter:
+            query = copy.copy(query)
+            query.filter = filter
+        return build(query, self.placeholder, cache=query_cache)
+
+    def _chunk_query_sets(self):
+        """
+        When the filter has an $in list longer than in_chunk_size, return query sets on
+        chunks of the list (see split_in_condition) without skip and limit: the rows of
+        the query are theirs put together. None if the query is not split, which is also
+        the case if it is sorted or distinct, since that cannot be merged
+        """
+        query = self.query
+        if not self.in_chunk_size or query.sort or query.distinct:
+            return None
+
+        filters = split_in_condition(query.filter, self.in_chunk_size)
+        if filters is None:
+            return None
+
+        query_sets = []
+        for filter in filters:
+            chunk_query = copy.copy(query)
+            chunk_query.filter = filter
+            chunk_query.skip = 0
+            chunk_query.limit = None
+            query_sets.append(QuerySet(cursor=self._cursor, query=chunk_query, placeholder=self.placeholder,
+                                       database=self.database, in_array=self.in_array))
+        return query_sets
+
+    def _run(self, build, fetch, cursor=None):
+        """
+        Compile the query with build, execute it on cursor (by default self.cursor)
+        and return the result read by fetch(cursor). Queries on the default cursor go
+        through the result cache of the database, if it is enabled
+        """
+        cached = cursor is None
+        if cursor is None:
+            cursor = self.cursor
+        start = time.time()
+        sql, params = self._compile(build)
+        compile_time = time.time() - start
+
+        if self.database is None:
+            cursor.execute(sql, params)
+            return fetch(cursor) if fetch is not None else None
+        if cached and fetch is not None:
+            return self.database.read(cursor, sql, params, fetch, [self.query.source], compile_time=compile_time)
+        return self.database.execute(cursor, sql, params, fetch=fetch, compile_time=compile_time)
+
+    def _to_rows(self, data_list):
+        if data_list:
+            assert(len(data_list[0]) == len(self.query.fields))
+        return map(row_class(self.query.fields), data_list)
 
     def _fetch_data(self):
-
-        sql = build_select(self.query)
-        # print sql
-        self.cursor.execute(sql)
-
-        data_list = self.cursor.fetchall()
-        values = self.query.fields
-        result_list = []
-        for data in data_list:
-            assert(len(data) == len(values))
-            result = {}
-            for i in range(len(data)):
-                result[values[i]] = data[i]
-            result_list.append(DataRow(result))
-
-        self._data = result_list
+        self._data = self._select(self._to_rows)
         self._need_to_refetch_data = False
 
+    def _select(self, convert):
+        """
+        Run the query and return convert(rows), rows being the list of tuples fetched
+        """
+        chunks = self._chunk_query_sets()
+        if chunks is None:
+            return self._run(build_select, lambda cursor: convert(cursor.fetchall()))
+
+        skip = self.query.skip or 0
+        end = None if self.query.limit is None else skip + self.query.limit
+        rows = []
+        for query_set in chunks:
+            if end is not None:
+                if len(rows) >= end:
+                    break
+                query_set.query.limit = end - len(rows)
+            rows.extend(query_set._select(convert))
+        return rows[skip:end]
+
+    def iter_batches(self, batch_size=1000):
+        """
+        Execute the query and yield the rows in lists of at most batch_size rows,
+        fetching one batch from the database at a time. Nothing is cached in the
+        query set, so memory usage stays bounded by the batch size.
+
+        A server side cursor is used where the database supports one (a named
+        cursor on PostgreSQL, SSCursor on MySQL). On MySQL no other query can be
+        run on the same connection until the iteration is finished.
+
+        :Parameters:
+        - batch_size: the number of rows fetched per round trip
+        """
+        for data_list in self._iter_tuples(batch_size):
+            yield self._to_rows(data_list)
+
+    def _iter_tuples(self, batch_size):
+        """
+        iter_batches yielding the rows as they are fetched, without building row objects
+        """
+        chunks = None
+        if self.query.limit is None and not self.query.skip:
+            chunks = self._chunk_query_sets()
+        if chunks is not None:
+            for query_set in chunks:
+                for data_list in query_set._iter_tuples(batch_size):
+                    yield data_list
+            return
+
+        if self.database is not None:
+            cursor = self.database.server_side_cursor()
+        else:
+            cursor = self.cursor
+
+        try:
+            self._run(build_select, None, cursor=cursor)
+            while True:
+                data_list = cursor.fetchmany(batch_size)
+                if not data_list:
+                    break
+                yield data_list
+        finally:
+            if cursor is not self.cursor:
+                cursor.close()
+
+    def stream(self, batch_size=1000):
+        """
+        Iterate over the rows one by one like iter(query_set), but without loading
+        the whole result into memory. See iter_batches
+
+        :Examples:
+
+        >>> for row in table.find({'state': 2}).stream(batch_size=5000):
+        >>>     export(row)
+        """
+        for rows in self.iter_batches(batch_size):
+            for row in rows:
+                yield row
+
     def filter(self, filter):
         """
         Add new filter to the query set. Note that since QuerySet is lazy, it would
@@ -102,11 +360,99 @@ class QuerySet:
 
         new_query_set = self.clone()
         new_query_set.query.limit = n
-        new_query_set.query.skip = skip
+        if skip is not None:
+            new_query_set.query.skip = skip
 
         return new_query_set
 
 
+    def skip(self, n):
+        """
+        Skip the first n rows, replacing the previous skip. The rows are skipped before
+        the limit applies, whatever the order skip and limit are called in
+        :Return: a new QuerySet object
+        """
+        if not isinstance(n, (int, long)) or n < 0:
+            raise MonSQLException('INVALID SKIP %r' %(n, ))
+
+        new_query_set = self.clone()
+        new_query_set.query.skip = n
+        return new_query_set
+
+
+    def paginate(self, after=None, sort=None, page_size=1000):
+        """
+        Return a query set for one page of rows using keyset (seek) pagination: instead
+        of skipping the rows of the previous pages, which gets slower the further the
+        pages are, the rows are selected by comparing the sort columns with the values
+        of the last row of the previous page.
+
+        :Examples:
+
+        >>> page = table.find({'state': 2}).paginate(sort=[('id', ASCENDING)], page_size=1000)
+        >>> next_page = table.find({'state': 2}).paginate(after=page[-1], sort=[('id', ASCENDING)], page_size=1000)
+
+        :Parameters:
+        - after: the last row of the previous page (a row, a dict, or the values of the sort
+          columns in order), or None for the first page
+        - sort: a list of (column, monsql.ASCENDING or monsql.DESCENDING) tuples, which must
+          identify rows uniquely. Defaults to the sort of this query set, then to the primary key
+        - page_size: the maximum number of rows of the page
+
+        :Return: a new QuerySet object
+        """
+        if self.query.limit is not None:
+            raise MonSQLException('LIMIT already defined')
+
+        sort = self._keyset_sort(sort)
+        new_query_set = self.clone()
+        if after is not None:
+            new_query_set.query.add_filter(keyset_condition(sort, self._keyset_values(after, sort)))
+        new_query_set.query.sort = sort
+        new_query_set.query.limit = page_size
+        new_query_set.query.skip = 0
+
+        return new_query_set
+
+    def pages(self, sort=None, page_size=1000, after=None):
+        """
+        Iterate over all rows page by page with keyset pagination (see paginate), yielding
+        each page as a list of rows. The sort columns must be among the selected fields
+        """
+        sort = self._keyset_sort(sort)
+        for column, direction in sort:
+            if column not in self.query.fields:
+                raise MonSQLException('SORT COLUMN %s MUST BE SELECTED TO PAGINATE' %(column))
+
+        while True:
+            rows = list(self.paginate(after=after, sort=sort, page_size=page_size))
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            after = rows[-1]
+
+    def _keyset_sort(self, sort):
+        sort = sort or self.query.sort
+        if not sort and self.database is not None:
+            schema = self.database.table_schema(self.query.source)
+            if schema is not None:
+                sort = [(column, ASCENDING) for column in schema.primary_key]
+        if not sort:
+            raise MonSQLException('A SORT IS REQUIRED FOR KEYSET PAGINATION')
+        return [tuple(item) for item in sort]
+
+    def _keyset_values(self, after, sort):
+        if isinstance(after, dict):
+            return [after[column] for column, direction in sort]
+        if isinstance(after, (Row, DataRow)):
+            data = after.data
+            return [data[column] for column, direction in sort]
+        if len(after) != len(sort):
+            raise MonSQLException('EXPECTED %d VALUES TO PAGINATE AFTER' %(len(sort)))
+        return list(after)
+
+
     def distinct(self):
         """
         Only return distinct row. 
@@ -118,18 +464,186 @@ class QuerySet:
 
 
     def clone(self):
-        return QuerySet(cursor=self.cursor, query=self.query.clone())
+        return QuerySet(cursor=self._cursor, query=self.query.clone(), placeholder=self.placeholder,
+                        database=self.database, in_array=self.in_array, in_chunk_size=self.in_chunk_size)
 
 
     def exists(self):
-        return len(self) > 0
+        """
+        Whether the query selects any row. Unless the rows are already loaded, at
+        most one row is fetched
+        """
+        if self._is_fetched():
+            return len(self._data) > 0
+
+        chunks = self._chunk_query_sets()
+        if chunks is not None:
+            if self.query.skip or self.query.limit is not None:
+                return self.count > 0
+            return any(query_set.exists() for query_set in chunks)
+
+        return len(self._run(build_exists, lambda cursor: cursor.fetchall())) > 0
+
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        """
+        Sort the rows, replacing the previous sort. Like in pymongo, either a column and
+        its direction, or a list of (column, monsql.ASCENDING or monsql.DESCENDING)
+
+        :Examples:
+
+        >>> users.find({'state': 2}).sort('age', DESCENDING).limit(10)
+        >>> users.find().sort([('age', DESCENDING), ('name', ASCENDING)])
+
+        :Return: a new QuerySet object
+        """
+        if isinstance(key_or_list, basestring):
+            sort = [(key_or_list, direction)]
+        else:
+            sort = [tuple(item) for item in key_or_list]
+
+        for column, column_direction in sort:
+            if column_direction not in (ASCENDING, DESCENDING):
+                raise MonSQLException('INVALID SORT DIRECTION %r FOR %s' %(column_direction, column))
+
+        new_query_set = self.clone()
+        new_query_set.query.sort = sort or None
+        return new_query_set
+
+
+    def only(self, *fields):
+        """
+        Select only the given fields, in this order, among those selected so far
+        :Return: a new QuerySet object
+        """
+        if not fields:
+            raise MonSQLException('only() NEEDS AT LEAST ONE FIELD')
+        for field in fields:
+            if field not in self.query.fields:
+                raise MonSQLException('FIELD %s IS NOT SELECTED' %(field))
+
+        new_query_set = self.clone()
+        new_query_set.query.fields = list(fields)
+        return new_query_set
 
 
-    def sort(self, sort):
-        self._need_to_refetch_data = True
-        raise Exception('NOT IMPLEMENTED')
+    def exclude(self, *fields):
+        """
+        Select all the fields selected so far but the given ones
+        :Return: a new QuerySet object
+        """
+        return self.project(dict([(field, 0) for field in fields]))
+
+
+    def project(self, projection):
+        """
+        Narrow the selected fields with a MongoDB style projection: {'name': 1, 'age': 1}
+        keeps only name and age, {'bio': 0} keeps all fields but bio. Nothing is fetched
+        until the query set is evaluated
+        :Return: a new QuerySet object
+        """
+        new_query_set = self.clone()
+        new_query_set.query.fields = project_fields(self.query.fields, projection)
+        return new_query_set
 
 
     def values(self):
         return [v.data for v in self]
 
+
+    def to_columns(self, batch_size=10000):
+        """
+        Return the rows as columns: an OrderedDict of field to an array.array of the
+        values for integer and floating point columns, or a list for the others. Rows
+        are fetched batch_size at a time and no row object is built. See monsql.columnar
+
+        :Examples:
+
+        >>> columns = orders.find({'state': 2}, fields=['id', 'amount']).to_columns()
+        >>> total = sum(columns['amount'])
+        """
+        return fill_arrays(self.query.fields, self._column_kinds(), self._tuple_batches(batch_size))
+
+
+    def to_numpy(self, records=False, batch_size=10000):
+        """
+        Like to_columns, with numpy arrays typed from the declared column types. The
+        arrays are allocated once for the number of rows counted beforehand. With
+        records=True, return a numpy record array instead. Requires numpy
+        """
+        numpy = import_numpy()
+        capacity = self.count
+        columns = fill_numpy(self.query.fields, self._column_kinds(), self._tuple_batches(batch_size),
+                             capacity=capacity)
+        if records:
+            return to_records(numpy, columns)
+        return columns
+
+    def export(self, fileobj, format='csv', header=True, batch_size=10000, copy=False):
+        """
+        Write the rows to fileobj (opened in binary mode) as CSV, with a header line of
+        the fields unless header is False, or as JSON Lines ('jsonl'). Rows are fetched
+        batch_size at a time and written from the fetched tuples, so memory use stays
+        bounded whatever the size of the result. See monsql.export
+
+        With copy=True and format='csv', the database writes the CSV itself where it
+        can (COPY TO STDOUT on PostgreSQL), which is faster but formats some values
+        its own way, like timestamps with fractional seconds
+
+        :Examples:
+
+        >>> with open('users.jsonl', 'wb') as f:
+        >>>     users.find({'state': 2}).export(f, format='jsonl')
+
+        :Return: the number of rows written
+        """
+        check_format(format)
+        if copy and format == 'csv' and self.database is not None and not self._is_fetched() \
+                and self._chunk_query_sets() is None:
+            sql, params = self._compile(build_select)
+            count = self.database.copy_to_csv(sql, params, fileobj, header=header)
+            if count is not None:
+                return count
+        return export_rows(fileobj, format, self.query.fields, self._tuple_batches(batch_size), header=header)
+
+    def _column_kinds(self):
+        types = {}
+        if self.database is not None:
+            schema = self.database.table_schema(self.query.source)
+            if schema is not None:
+                types = schema.types
+        return [column_kind(types.get(field)) for field in self.query.fields]
+
+    def _tuple_batches(self, batch_size):
+        if self._is_fetched():
+            return [self._data] if self._data else []
+        return self._iter_tuples(batch_size)
+
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Return the rows as plain tuples of the given fields (by default all the selected
+        fields), without building row objects. With flat=True and a single field,
+        return the list of its values
+
+        :Examples:
+
+        >>> user_ids = users.find({'state': 2}).values_list('id', flat=True)
+        """
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('values_list() got unexpected keyword arguments %s' %(', '.join(kwargs.keys())))
+        if flat and len(fields) != 1:
+            raise MonSQLException('values_list(flat=True) REQUIRES EXACTLY ONE FIELD')
+
+        query_set = self.only(*fields) if fields else self
+        if self._is_fetched():
+            positions = [self.query.fields.index(field) for field in query_set.query.fields]
+            rows = [tuple([row[position] for position in positions]) for row in self._data]
+        else:
+            rows = query_set._select(list)
+
+        if flat:
+            return [row[0] for row in rows]
+        return [tuple(row) for row in rows]
+
@@ -0,0 +1,249 @@
+# coding=utf-8
+"""
+Read/write splitting: a primary database, which all writes go to, and replicas of it
+which serve the reads.
+
+find, find_one, count, aggregate, parallel_scan and raw SELECT statements are sent to
+a replica, chosen in turn (ROUND_ROBIN) or as the one running the fewest statements at
+the moment (LEAST_BUSY, ties taken in turn). They go to the primary instead when the
+calling thread:
+
+- is inside a transaction block, or has uncommitted writes
+- wrote through the RoutingDatabase less than sticky_seconds ago, so that it reads its
+  own writes although the replicas have not received them yet
+
+Everything else (writes, schema changes, commit, ...) goes to the primary.
+
+:Examples:
+
+>>> primary = MonSQL(host, port, username, password, dbname, dbtype=DB_TYPES.MYSQL, pool_size=10)
+>>> replicas = [MonSQL(replica_host, port, username, password, dbname, dbtype=DB_TYPES.MYSQL, pool_size=10)
+>>>             for replica_host in replica_hosts]
+>>> db = RoutingDatabase(primary, replicas, policy=ROUTING_POLICY.LEAST_BUSY, sticky_seconds=2)
+>>> users = db.get('user')
+>>> users.insert({'name': 'Jude'})  # primary
+>>> db.commit()
+>>> users.find_one({'name': 'Jude'}) # primary, for the next 2 seconds
+>>> users.count()                    # a replica, after that
+"""
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+from profiling import ExecutionHook
+from exception import MonSQLException
+
+
+class ROUTING_POLICY:
+    ROUND_ROBIN = 'round_robin'
+    LEAST_BUSY = 'least_busy'
+
+
+# SELECT statements which lock rows or create tables are writes
+READ_STATEMENT = re.compile(r'^\s*\(?\s*SELECT\b', re.IGNORECASE)
+WRITING_SELECT = re.compile(r'\bFOR\s+(UPDATE|SHARE)\b|\bINTO\b', re.IGNORECASE)
+
+def is_read_statement(sql):
+    return READ_STATEMENT.match(sql) is not None and WRITING_SELECT.search(sql) is None
+
+
+class ActiveStatements(ExecutionHook):
+    """
+    Count the statements running on a database
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.__lock = threading.Lock()
+
+    def before_execute(self, statement):
+        with self.__lock:
+            self.active += 1
+
+    def after_execute(self, statement):
+        with self.__lock:
+            self.active -= 1
+
+
+class RoutingDatabase(object):
+
+    # Seconds after a write during which the writing thread reads from the primary
+    STICKY_SECONDS = 1.0
+
+    def __init__(self, primary, replicas, policy=ROUTING_POLICY.ROUND_ROBIN, sticky_seconds=None):
+        """
+        :Parameters:
+
+        - primary: the Database written to
+        - replicas: a list of Databases replicating the primary, with the same tables
+        - policy: the ROUTING_POLICY choosing the replica of each read
+        - sticky_seconds: how long a thread reads from the primary after it wrote,
+          STICKY_SECONDS by default. 0 sends its reads to the replicas as soon as its
+          writes are committed
+        """
+        if policy not in (ROUTING_POLICY.ROUND_ROBIN, ROUTING_POLICY.LEAST_BUSY):
+            raise MonSQLException('UNKNOWN ROUTING POLICY %s' %(policy))
+
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.policy = policy
+        self.sticky_seconds = self.STICKY_SECONDS if sticky_seconds is None else sticky_seconds
+        self.active_statements = []
+        if policy == ROUTING_POLICY.LEAST_BUSY:
+            for replica in self.replicas:
+                hook = ActiveStatements()
+                replica.add_hook(hook)
+                self.active_statements.append(hook)
+
+        self.__next = 0
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__tables = {}
+
+    def __getattr__(self, name):
+        # Anything else is done on the primary
+        attribute = getattr(self.primary, name)
+        if name in ('bulk_write', 'create_table', 'drop_table', 'truncate_table'):
+            return self.writing(attribute)
+        return attribute
+
+    def get(self, name):
+        """
+        Return a RoutedTable for the table
+        """
+        if name not in self.__tables:
+            self.__tables[name] = RoutedTable(self, name)
+        return self.__tables[name]
+
+    def read_database(self):
+        """
+        The database the calling thread reads from now: the primary or a replica,
+        see the module documentation
+        """
+        primary = self.primary
+        if not self.replicas or primary.in_transaction or primary.has_uncommitted_writes:
+            return primary
+        last_write_at = getattr(self.__local, 'last_write_at', None)
+        if last_write_at is not None and time.time() - last_write_at < self.sticky_seconds:
+            return primary
+        return self.replicas[self.__choose_replica()]
+
+    def __choose_replica(self):
+        with self.__lock:
+            start = self.__next
+            self.__next = (start + 1) % len(self.replicas)
+        if self.policy == ROUTING_POLICY.ROUND_ROBIN:
+            return start
+
+        count = len(self.replicas)
+        return min([(start + offset) % count for offset in range(count)],
+                   key=lambda index: self.active_statements[index].active)
+
+    def record_write(self):
+        """
+        Start the sticky window of the calling thread
+        """
+        self.__local.last_write_at = time.time()
+
+    def writing(self, function):
+        """
+        Wrap function to record a write when it is called
+        """
+        def write(*args, **kwargs):
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record_write()
+        return write
+
+    def raw(self, sql, params=None):
+        """
+        Database.raw, on a replica if sql is a SELECT which can be read from one
+        """
+        if is_read_statement(sql):
+            return self.read_database().raw(sql, params)
+        return self.writing(self.primary.raw)(sql, params)
+
+    def commit(self):
+        written = self.primary.has_uncommitted_writes
+        self.primary.commit()
+        if written:
+            # The replicas receive the writes from now on
+            self.record_write()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Database.transaction on the primary. All statements of the block go to the primary
+        """
+        started_at = time.time()
+        with self.primary.transaction():
+            yield self
+        last_write_at = getattr(self.__local, 'last_write_at', None)
+        if not self.primary.in_transaction and last_write_at is not None and last_write_at >= started_at:
+            # The writes of the block are committed now
+            self.record_write()
+
+    def close(self):
+        """
+        Close the primary and the replicas
+        """
+        self.primary.close()
+        for replica in self.replicas:
+            replica.close()
+        self.__tables = {}
+
+
+class RoutedTable(object):
+    """
+    A table of a RoutingDatabase: reads go to the database chosen by read_database,
+    everything else to the table of the primary
+    """
+
+    def __init__(self, routing_database, name):
+        self.routing_database = routing_database
+        self.name = name
+
+    def __getattr__(self, name):
+        return getattr(self.routing_database.primary.get(self.name), name)
+
+    def __read_table(self):
+        return self.routing_database.read_database().get(self.name)
+
+    def __write(self, method, args, kwargs):
+        function = getattr(self.routing_database.primary.get(self.name), method)
+        return self.routing_database.writing(function)(*args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        return self.__read_table().find(*args, **kwargs)
+
+    def find_one(self, *args, **kwargs):
+        return self.__read_table().find_one(*args, **kwargs)
+
+    def count(self, *args, **kwargs):
+        return self.__read_table().count(*args, **kwargs)
+
+    def aggregate(self, *args, **kwargs):
+        return self.__read_table().aggregate(*args, **kwargs)
+
+    def parallel_scan(self, *args, **kwargs):
+        return self.__read_table().parallel_scan(*args, **kwargs)
+
+    def insert(self, *args, **kwargs):
+        return self.__write('insert', args, kwargs)
+
+    def update(self, *args, **kwargs):
+        return self.__write('update', args, kwargs)
+
+    def upsert(self, *args, **kwargs):
+        return self.__write('upsert', args, kwargs)
+
+    def remove(self, *args, **kwargs):
+        return self.__write('remove', args, kwargs)
+
+    def bulk_write(self, *args, **kwargs):
+        return self.__write('bulk_write', args, kwargs)
+
+    def load(self, *args, **kwargs):
+        return self.__write('load', args, kwargs)
@@ -0,0 +1,79 @@
+# coding=utf-8
+
+import threading
+
+class TableSchema(object):
+    """
+    The metadata of a table: column names in their order, the declared type of
+    each column (lower case) and the primary key columns
+    """
+
+    def __init__(self, name, columns=None, types=None, primary_key=None):
+        self.name = name
+        self.columns = columns or []
+        self.types = types or {}
+        self.primary_key = primary_key or []
+        self.__primary_key_positions = []
+
+    def add_column(self, column, type, primary_key_position=None):
+        """
+        Used by loaders. primary_key_position is the 1-based position of the column
+        in the primary key, or None if it is not part of it
+        """
+        self.columns.append(column)
+        self.types[column] = (type or '').lower()
+        if primary_key_position:
+            self.__primary_key_positions.append((primary_key_position, column))
+            self.__primary_key_positions.sort()
+            self.primary_key = [c for position, c in self.__primary_key_positions]
+
+    def __repr__(self):
+        return 'TableSchema(%s, %r)' %(self.name, self.columns)
+
+
+class SchemaCache(object):
+    """
+    Metadata of all tables of a database, loaded at once by load() (which returns a
+    dict of lower case table name to TableSchema) when first needed, and kept until
+    invalidate() is called or a table missing from it is looked up. version counts
+    the invalidations, so users can tell whether metadata they derived from it is
+    outdated
+    """
+
+    def __init__(self, load):
+        self.load = load
+        self.version = 0
+        self.__tables = None
+        self.__lock = threading.Lock()
+
+    def tables(self):
+        return self.__load()[0]
+
+    def __load(self):
+        tables = self.__tables
+        loaded = False
+        if tables is None:
+            with self.__lock:
+                if self.__tables is None:
+                    self.__tables = self.load()
+                    loaded = True
+                tables = self.__tables
+        return tables, loaded
+
+    def get(self, name):
+        """
+        The TableSchema of the table, or None if it does not exist. A table missing
+        from metadata loaded earlier may have been created since by another connection,
+        so the metadata is reloaded once before it is reported missing
+        """
+        name = name.lower()
+        tables, loaded = self.__load()
+        if name not in tables and not loaded:
+            self.invalidate()
+            tables = self.tables()
+        return tables.get(name)
+
+    def invalidate(self):
+        with self.__lock:
+            self.__tables = None
+            self.version += 1
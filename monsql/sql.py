@@ -1,20 +1,26 @@
 # coding=utf-8
 
-from query import Query, QueryCondition, value_to_sql_str
+from query import Query, QueryCondition, value_to_sql_str, value_to_sql_param, condition_shape
 from datetime import datetime, date
 import types
 from exception import MonSQLException
 import uuid
 from config import ASCENDING, DESCENDING
 
+DEFAULT_PLACEHOLDER = u'%s'
+
 def from_none_to_null(v):
     if v is not None: return v
     return u'null'
 
-def build_query(query):
-    return QueryCondition(query).to_sql()
+def build_query(query, placeholder=DEFAULT_PLACEHOLDER):
+    """
+    Return a tuple (condition_sql, params). condition_sql is None if there is no condition
+    """
+    return QueryCondition(query, placeholder=placeholder).to_sql()
 
-def build_select_query(table_name, values, query, sort=None, skip=0, limit=None, distinct=False):
+def build_select_query(table_name, values, query, sort=None, skip=0, limit=None, distinct=False,
+                       placeholder=DEFAULT_PLACEHOLDER):
 
     value_str = ""
     for index, field in enumerate(values):
@@ -27,7 +33,7 @@ def build_select_query(table_name, values, query, sort=None, skip=0, limit=None,
             value_str += u"," + field
 
     # Where clause
-    query_str = build_query(query)
+    query_str, params = build_query(query, placeholder)
     if query_str:
         query_str = u"WHERE " + query_str
     else:
@@ -54,58 +60,268 @@ def build_select_query(table_name, values, query, sort=None, skip=0, limit=None,
         sql = '''%s ORDER BY %s''' %(sql, ','.join(sort_strings))
 
     if limit is not None:
-        sql = '%s LIMIT %d OFFSET %d' %(sql, limit, skip)
+        sql = '%s LIMIT %s OFFSET %s' %(sql, placeholder, placeholder)
+        params.extend([limit, skip or 0])
+
+    return sql, params
+
 
-    return sql
+def build_select(query_obj, placeholder=DEFAULT_PLACEHOLDER, cache=None):
+    """
+    Given a Query obj, return the corresponding sql and its params
+
+    When cache (a monsql.cache.LRUCache) is given, the sql is looked up by the shape
+    of the query, so the filter only has to be walked to collect the params
+    """
+    return _build_cached(u'SELECT', query_obj, placeholder, cache, _compile_select)
 
 
-def build_select(query_obj):
+def build_count(query_obj, placeholder=DEFAULT_PLACEHOLDER, cache=None):
     """
-    Given a Query obj, return the corresponding sql
+    Given a Query obj, return the sql counting the rows it selects, and its params.
+    The rows are counted by the database and never fetched
     """
+    return _build_cached(u'COUNT', query_obj, placeholder, cache, _compile_count)
+
+
+def build_exists(query_obj, placeholder=DEFAULT_PLACEHOLDER, cache=None):
+    """
+    Given a Query obj, return a sql which selects at most one row, '1', if the
+    query selects any row, and its params
+    """
+    return _build_cached(u'EXISTS', query_obj, placeholder, cache, _compile_exists)
+
+
+def _compile_select(query_obj, placeholder, sort=True):
     return build_select_query(query_obj.source, query_obj.fields, query_obj.filter, skip=query_obj.skip, \
-                              limit=query_obj.limit, sort=query_obj.sort, distinct=query_obj.distinct)
+                              limit=query_obj.limit, sort=query_obj.sort if sort else None, \
+                              distinct=query_obj.distinct, placeholder=placeholder)
+
+
+def _needs_subquery(query_obj):
+    # DISTINCT and LIMIT change which rows are selected, so they have to be
+    # applied before the rows are counted
+    return query_obj.distinct or query_obj.limit is not None
+
+
+def _compile_count(query_obj, placeholder):
+    if _needs_subquery(query_obj):
+        sql, params = _compile_select(query_obj, placeholder, sort=False)
+        return u"SELECT COUNT(*) FROM (%s) AS monsql_count" %(sql), params
+
+    query_str, params = build_query(query_obj.filter, placeholder)
+    sql = u"SELECT COUNT(*) FROM %s" %(query_obj.source)
+    if query_str:
+        sql += u" WHERE " + query_str
+    return sql, params
+
+
+def _compile_exists(query_obj, placeholder):
+    if _needs_subquery(query_obj):
+        sql, params = _compile_select(query_obj, placeholder, sort=False)
+        return u"SELECT 1 FROM (%s) AS monsql_exists LIMIT 1" %(sql), params
+
+    query_str, params = build_query(query_obj.filter, placeholder)
+    sql = u"SELECT 1 FROM %s" %(query_obj.source)
+    if query_str:
+        sql += u" WHERE " + query_str
+    return sql + u" LIMIT 1", params
+
+
+def _build_cached(kind, query_obj, placeholder, cache, compile):
+    if cache is None:
+        return compile(query_obj, placeholder)
+
+    shape, params = condition_shape(query_obj.filter)
+    sort_key = None
+    if query_obj.sort:
+        sort_key = tuple([tuple(item) for item in query_obj.sort])
+    key = (kind, query_obj.source, tuple(query_obj.fields), shape, sort_key, query_obj.limit is not None,
+           bool(query_obj.distinct), placeholder)
+
+    sql = cache.get(key)
+    if sql is None:
+        sql, params = compile(query_obj, placeholder)
+        cache.put(key, sql)
+    elif query_obj.limit is not None:
+        params.extend([query_obj.limit, query_obj.skip or 0])
+
+    return sql, params
 
 
-def build_insert(table_name, attributes):
+def build_insert(table_name, attributes, placeholder=DEFAULT_PLACEHOLDER):
     """
-    Given the table_name and the data, return the sql to insert the data
+    Given the table_name and the data, return the sql to insert the data and its params
     """
-    sql = "INSERT INTO %s" %(table_name)
-    column_str = u""
-    value_str = u""
-    for index, (key, value) in enumerate(attributes.items()):
-        if index > 0:
-            column_str += u","
-            value_str += u","
-        column_str += key
-        value_str += value_to_sql_str(value)
-    sql = sql + u"(%s) VALUES(%s)" %(column_str, value_str)
-    return sql
+    columns = attributes.keys()
+    return build_insert_many(table_name, columns, [[attributes[key] for key in columns]], placeholder)
+
+
+def build_insert_many(table_name, columns, rows, placeholder=DEFAULT_PLACEHOLDER):
+    """
+    Given the table_name, the column names and a list of rows (each row being a
+    list of values in the same order as columns), return one multi-row insert sql
+    and its params
+    """
+    row_str = u"(%s)" %(u",".join([placeholder] * len(columns)))
+    params = []
+    for row in rows:
+        params.extend([value_to_sql_param(value) for value in row])
+
+    sql = u"INSERT INTO %s(%s) VALUES%s" %(table_name, u",".join(columns), u",".join([row_str] * len(rows)))
+    return sql, params
+
+
+def build_insert_template(table_name, columns, placeholder=DEFAULT_PLACEHOLDER):
+    """
+    The sql inserting one row of values of columns, to run with executemany
+    """
+    return u"INSERT INTO %s(%s) VALUES(%s)" %(table_name, u",".join(columns), u",".join([placeholder] * len(columns)))
+
+
+def group_rows_by_columns(data_list, batch_size, max_params=None):
+    """
+    Split a list of dicts into batches of rows that can share one INSERT statement.
+    Consecutive dicts with the same set of keys are grouped together (so the order of
+    the input is kept), and no batch contains more than batch_size rows, nor more than
+    max_params values (if not None) unless it has a single row.
+
+    :Return: a list of (columns, rows) tuples, rows being lists of values ordered as columns
+    """
+    batches = []
+    columns = None
+    rows = None
+    size = batch_size
+    for data in data_list:
+        data_columns = sorted(data.keys())
+        if data_columns != columns or len(rows) >= size:
+            columns = data_columns
+            size = rows_per_statement(len(columns), batch_size, max_params)
+            rows = []
+            batches.append((columns, rows))
+        rows.append([data[column] for column in columns])
+
+    return batches
+
+
+def rows_per_statement(column_count, batch_size, max_params=None):
+    """
+    The number of rows of column_count values one statement can hold: batch_size,
+    capped so that the statement has at most max_params params, but at least 1
+    """
+    if max_params is None or column_count == 0:
+        return batch_size
+    return max(min(batch_size, max_params // column_count), 1)
+
+
+def build_update_many(table_name, conditions, attributes_list, placeholder=DEFAULT_PLACEHOLDER):
+    """
+    One UPDATE applying several (condition, attributes) pairs that set the same columns:
+    the rows matching any condition are updated, each column with a CASE picking the
+    value of the last pair whose condition the row matches. The conditions must not
+    refer to the updated columns, so they see the same rows as separate statements would
+    """
+    compiled = [build_query(condition, placeholder) for condition in conditions]
+    pairs = list(reversed(zip(compiled, attributes_list)))
+
+    set_parts = []
+    params = []
+    for column in sorted(attributes_list[0].keys()):
+        whens = []
+        for (query_str, query_params), attributes in pairs:
+            whens.append(u"WHEN %s THEN %s" %(query_str, placeholder))
+            params.extend(query_params)
+            params.append(value_to_sql_param(attributes[column]))
+        set_parts.append(u"%s=CASE %s ELSE %s END" %(column, u" ".join(whens), column))
+
+    for query_str, query_params in compiled:
+        params.extend(query_params)
+    where_str = u" OR ".join([u"(%s)" %(query_str) for query_str, query_params in compiled])
+
+    sql = u"UPDATE %s SET %s WHERE %s" %(table_name, u",".join(set_parts), where_str)
+    return sql, params
+
+
+def build_upsert_on_conflict(table_name, columns, rows, conflict_keys, update_columns,
+                             placeholder=DEFAULT_PLACEHOLDER):
+    """
+    Multi-row INSERT ... ON CONFLICT (conflict_keys) DO UPDATE, the syntax of PostgreSQL
+    (9.5+) and SQLite (3.24+). Rows conflicting with an existing row get their
+    update_columns overwritten; with no update_columns they are left as they are
+    """
+    sql, params = build_insert_many(table_name, columns, rows, placeholder)
+    if update_columns:
+        action = u"DO UPDATE SET " + u",".join([u"%s=excluded.%s" %(column, column) for column in update_columns])
+    else:
+        action = u"DO NOTHING"
+    sql = u"%s ON CONFLICT (%s) %s" %(sql, u",".join(conflict_keys), action)
+    return sql, params
+
+
+def build_upsert_on_duplicate_key(table_name, columns, rows, update_columns,
+                                  placeholder=DEFAULT_PLACEHOLDER):
+    """
+    Multi-row INSERT ... ON DUPLICATE KEY UPDATE of MySQL, where conflicts are detected
+    on any unique key of the table
+    """
+    sql, params = build_insert_many(table_name, columns, rows, placeholder)
+    if update_columns:
+        set_str = u",".join([u"%s=VALUES(%s)" %(column, column) for column in update_columns])
+    else:
+        # Assigning a column to itself keeps the existing row unchanged
+        set_str = u"%s=%s" %(columns[0], columns[0])
+    sql = u"%s ON DUPLICATE KEY UPDATE %s" %(sql, set_str)
+    return sql, params
+
+
+def build_insert_or_replace(table_name, columns, rows, placeholder=DEFAULT_PLACEHOLDER):
+    """
+    Multi-row INSERT OR REPLACE of SQLite. Conflicting rows are deleted and replaced
+    as a whole, so the columns not given get their default values
+    """
+    sql, params = build_insert_many(table_name, columns, rows, placeholder)
+    return u"INSERT OR REPLACE" + sql[len(u"INSERT"):], params
+
+
+def unique_rows(columns, rows, keys):
+    """
+    Keep only the last of the rows having the same values for keys, since one upsert
+    statement cannot affect the same row twice on every database
+    """
+    positions = [columns.index(key) for key in keys]
+    last = {}
+    for index, row in enumerate(rows):
+        last[tuple([row[position] for position in positions])] = index
+    if len(last) == len(rows):
+        return rows
+    return [row for index, row in enumerate(rows) if last[tuple([row[position] for position in positions])] == index]
 
 
-def build_delete(table_name, condition):
-    query_str = build_query(condition)
+def build_delete(table_name, condition, placeholder=DEFAULT_PLACEHOLDER):
+    query_str, params = build_query(condition, placeholder)
     if not query_str:
         query_str = u""
     else:
         query_str = u"WHERE " + query_str
     sql = u"DELETE FROM %s %s" %(table_name, query_str)
-    return sql
+    return sql, params
 
 
-def build_update(table_name, condition, attributes):
+def build_update(table_name, condition, attributes, placeholder=DEFAULT_PLACEHOLDER):
     sql = u"UPDATE %s SET " %(table_name)    
     set_str = u""
+    params = []
     for index, (key, value) in enumerate(attributes.items()):
         if index > 0:
             set_str += u","
-        set_str += key + u"=" + value_to_sql_str(value)
+        set_str += key + u"=" + placeholder
+        params.append(value_to_sql_param(value))
 
-    query_str = build_query(condition)
+    query_str, query_params = build_query(condition, placeholder)
     if query_str:
         query_str = u" WHERE " + query_str
+        params.extend(query_params)
     else:
         query_str = u""
     sql = sql + set_str + query_str
-    return sql
+    return sql, params
@@ -1,10 +1,15 @@
 # coding=utf-8
-import abc
-from logging import Logger
 from config import TRANSACTION_MODE
-from query import Query
-from queryset import QuerySet
-from sql import build_query, build_select, build_update, build_delete, build_insert
+from query import Query, bind_in_arrays, split_in_condition, value_to_sql_param
+from queryset import QuerySet, row_class, project_fields
+from aggregate import build_aggregate
+from sql import build_query, build_select, build_update, build_delete, build_insert, \
+                build_insert_many, build_insert_template, group_rows_by_columns, build_upsert_on_conflict, \
+                unique_rows, rows_per_statement
+from exception import MonSQLException
+from bulk import bulk_write
+from load import RowReader, load_columns
+from parallel import parallel_scan
   
 
 class Table:
@@ -14,55 +19,92 @@ class Table:
     Database.get('table_name') to have a table returned.
     """
 
-    db = None
-    cursor = None
-    columns = None
     name = None
 
-    def __init__(self, db, name, mode=None):
-        self.db = db
-        self.cursor = db.cursor()
-        self.columns = None
+    # Maximum number of rows in one multi-row INSERT statement
+    INSERT_BATCH_SIZE = 500
+
+    # Maximum number of params in one statement, None if the database has no lower
+    # limit than the size of the statement. Multi-row statements hold fewer rows if needed
+    MAX_PARAMS = None
+
+    # Number of rows passed to one executemany by load
+    LOAD_BATCH_SIZE = 10000
+
+    # Whether build_upsert only updates the rows conflicting on conflict_keys, leaving
+    # their other columns unchanged. update(upsert=True) only uses it if so
+    NATIVE_UPSERT = True
+
+    # Parameter marker of the database driver (its DB-API paramstyle)
+    PLACEHOLDER = u'%s'
+
+    # How long $in lists are handled: passed as one param (a monsql.query.InArray), or
+    # split into queries on chunks of IN_CHUNK_SIZE values. By default they are not
+    IN_ARRAY = None
+    IN_CHUNK_SIZE = None
+
+    def __init__(self, db, name, mode=None, database=None):
+        """
+        database: the Database wrapper the table belongs to, which runs all its
+        statements. db is not used any more and kept for compatibility
+        """
+        if database is None:
+            raise MonSQLException('TABLE %s MUST BELONG TO A DATABASE, USE Database.get' %(name))
         self.name = name
+        self.database = database
 
         if mode:
             self.transaction_mode = mode
         else:
             self.transaction_mode = TRANSACTION_MODE.DEFAULT
 
-        self.logger = Logger("std")
 
+    @property
+    def db(self):
+        """
+        The connection used by this table. When the table belongs to a pooled
+        Database, this is the connection bound to the calling thread
+        """
+        return self.database.db
 
-    def columns():
-        doc = "The columns property."
-        def fget(self):
-            return self._columns
-        def fset(self, value):
-            self._columns = value
-        def fdel(self):
-            del self._columns
-        return locals()
+    @property
+    def cursor(self):
+        return self.database.cursor
 
-    columns = property(**columns())
 
+    @property
+    def schema(self):
+        """
+        The TableSchema (column names, types and primary key) of this table, from
+        the schema cache shared by all tables of the database
+        """
+        schema = self.database.table_schema(self.name)
+        if schema is None:
+            raise MonSQLException('TABLE %s DOES NOT EXIST' %self.name)
+        return schema
 
-    @abc.abstractmethod
-    def fetch_columns(self):
-        pass
+    @property
+    def columns(self):
+        """
+        The column names of the table
+        """
+        return self.schema.columns
 
 
-    def __ensure_columns(self):
-        if self.columns is not None:
-            return True
-        self.fetch_columns()
-        return True
+    def fetch_columns(self):
+        """
+        Reload the metadata of the database, e.g. after the table was altered
+        with raw sql, and return the column names of this table
+        """
+        self.database.refresh_schema()
+        return self.columns
 
 
     def commit(self):
         """
         Ends current transaction, making permanent any changes made.
         """
-        self.db.commit()
+        self.database.commit()
         return self
     
 
@@ -78,10 +120,18 @@ class Table:
           a column name used inside COUNT(). If none, '*' will be
           used.
 
+        Long $in lists are split like in find (see IN_CHUNK_SIZE) and the counts of the
+        chunks added up, except for distinct counts of some fields, which rows of
+        different chunks may share
+
         :Return: int, the number of rows
         """
+        if query is not None and (not distinct or distinct_fields is None):
+            conditions = self.__in_chunks(query)
+            if len(conditions) > 1:
+                return sum([self.count(condition, distinct, distinct_fields) for condition in conditions])
+
         if distinct_fields is None:
-            self.__ensure_columns()
             if distinct:
                 field = ','.join(self.columns)
             else:
@@ -97,14 +147,14 @@ class Table:
         count_str = 'COUNT(%s)' %(count_str)
 
         sql = 'SELECT %s FROM %s' %(count_str, self.name)
+        params = []
 
         if query is not None:
-            query_str = build_query(query)
+            query_str, params = build_query(bind_in_arrays(query, self.IN_ARRAY), self.PLACEHOLDER)
             if query_str:
                 sql = sql + ' WHERE ' + query_str
 
-        self.cursor.execute(sql)
-        count = self.cursor.fetchone()[0]
+        count = self.database.read(self.cursor, sql, params, lambda cursor: cursor.fetchone()[0], [self.name])
 
         return count
 
@@ -140,7 +190,8 @@ class Table:
         :Parameters: 
 
         - query(dict): specify the WHERE clause. One example is {"name": "...", "id": ...}    
-        - fields: specify what fields are needed
+        - fields: specify what fields are needed, as a list of column names or a MongoDB
+          style projection dict ({'name': 1, 'age': 1}, or {'bio': 0} for all columns but bio)
         - skip, limit: both integers, skip without defining limit is meaningless
         - sort: A list, each element is a two-item tuple, with the first item be the column name
           and the second item be either monsql.ASCENDING or monsql.DESCENDING
@@ -148,11 +199,13 @@ class Table:
         :Return: a QuerySet object
         """
         if not fields:
-            self.__ensure_columns()
             fields = self.columns
+        elif isinstance(fields, dict):
+            fields = project_fields(self.columns, fields)
 
         query_obj = Query(source=self.name, filter=filter, fields=fields, skip=skip, limit=limit, sort=sort)
-        return QuerySet(cursor=self.cursor, query=query_obj)
+        return QuerySet(cursor=self.cursor, query=query_obj, placeholder=self.PLACEHOLDER, database=self.database,
+                        in_array=self.IN_ARRAY, in_chunk_size=self.IN_CHUNK_SIZE)
     
 
     def find_one(self, filter=None, fields=None, skip=0, sort=None):
@@ -161,13 +214,35 @@ class Table:
         If no row matches, returns None
         """
         result = self.find(filter=filter, fields=fields, skip=skip, limit=1, sort=sort)
-        if len(result) > 0:
-            return result[0]
-        else:
-            return None
+        for row in result:
+            return row
+        return None
+
+
+    def aggregate(self, pipeline):
+        """
+        Run a MongoDB style aggregation pipeline, compiled into one SELECT statement so
+        that the rows are aggregated by the database.
+
+        :Examples:
+
+        >>> table.aggregate([{'$match': {'state': 2}},
+        >>>                  {'$group': {'_id': '$city', 'users': {'$sum': 1}, 'age': {'$avg': '$age'}}},
+        >>>                  {'$sort': {'users': -1}},
+        >>>                  {'$limit': 10}])
+        >>> [Row(_id=u'Paris', age=31.5, users=1200), ...]
+
+        Supported stages are $match, $group (with $sum, $avg, $min, $max and $count),
+        $sort, $skip, $limit and $project. See monsql.aggregate
+
+        :Return: a list of rows
+        """
+        sql, params, fields = build_aggregate(self.name, self.columns, pipeline, self.PLACEHOLDER, self.IN_ARRAY)
+        return self.database.read(self.cursor, sql, params,
+                                  lambda cursor: map(row_class(fields), cursor.fetchall()), [self.name])
 
 
-    def insert(self, data_or_list_of_data):
+    def insert(self, data_or_list_of_data, batch_size=None):
         """
         Insert data into the table.
         
@@ -176,36 +251,256 @@ class Table:
         >>> user_table.insert({'username': 'Jude'}) # Insert one row
         >>> user_table.insert([{'username': 'Andy'}, {'username': 'Julia'}, ...]) # Insert multiple rows
 
+        When a list is given, consecutive rows with the same columns are inserted together
+        with one multi-row INSERT statement instead of one statement per row.
+
         :Parameters:
 
         - data_or_list_of_data: Either a dict or a list of dict
-
-        :Return: id or list of ids of inserted row
+        - batch_size: the maximum number of rows in one INSERT statement when a list
+          is given. Defaults to INSERT_BATCH_SIZE. Use 1 to insert rows one by one.
+          Statements of wide rows hold fewer rows on databases limiting their params
+          (MAX_PARAMS), and rows are inserted one by one where the ids of rows inserted
+          together cannot be told (see can_insert_many)
+
+        :Return: id or list of ids of inserted row. Backends that cannot
+          provide the id return None for it
         """
-        result = None
-
-        def insert_data(data):
-            sql = build_insert(self.name, data)
-            row_count = self.cursor.execute(sql)
-
+        if not isinstance(data_or_list_of_data, list):
+            return self.__insert_one(data_or_list_of_data)
+
+        if batch_size is None:
+            batch_size = self.INSERT_BATCH_SIZE
+        if batch_size < 1:
+            raise MonSQLException('BATCH SIZE MUST BE AT LEAST 1')
+
+        result = []
+        for columns, rows in group_rows_by_columns(data_or_list_of_data, batch_size, self.MAX_PARAMS):
+            if len(rows) == 1 or not self.can_insert_many(columns):
+                result.extend([self.__insert_one(dict(zip(columns, row))) for row in rows])
+                continue
+
+            sql, params = build_insert_many(self.name, columns, rows, self.PLACEHOLDER)
+            row_count = self.database.execute(self.cursor, sql, params, write=self.name)
             if row_count:
-                return self.cursor.lastrowid
+                result.extend(self.batch_inserted_ids(columns, rows))
             else:
-                return None
+                result.extend([None] * len(rows))
+
+        return result
 
-        value_to_be_inserted = []
 
-        if isinstance(data_or_list_of_data, list):
-            result = []
-            for data in data_or_list_of_data:
-                r = insert_data(data)
-                result.append(r)
+    def __insert_one(self, data):
+        sql, params = build_insert(self.name, data, self.PLACEHOLDER)
+        row_count = self.database.execute(self.cursor, sql, params, write=self.name)
+
+        if row_count:
+            return self.cursor.lastrowid
         else:
-            result = insert_data(data_or_list_of_data)
-        
-        return result
+            return None
+
+
+    def rows_per_statement(self, column_count, batch_size=None):
+        """
+        The number of rows of column_count values that one multi-row statement holds:
+        batch_size (INSERT_BATCH_SIZE by default), fewer if MAX_PARAMS requires it
+        """
+        if batch_size is None:
+            batch_size = self.INSERT_BATCH_SIZE
+        return rows_per_statement(column_count, batch_size, self.MAX_PARAMS)
+
+
+    def batch_inserted_ids(self, columns, rows):
+        """
+        Return the ids of rows (lists of values ordered as columns), inserted by the
+        last multi-row INSERT statement: the values of the primary key if the rows
+        give it, otherwise the ids generated by the database (see generated_ids)
+        """
+        # Read first, since loading the schema runs statements on the cursor
+        ids = self.generated_ids(len(rows))
+        primary_key = self.schema.primary_key
+        if len(primary_key) == 1 and primary_key[0] in columns:
+            position = columns.index(primary_key[0])
+            return [row[position] for row in rows]
+        return ids
+
+
+    def generated_ids(self, count):
+        """
+        Return the ids generated for the count rows inserted by the last multi-row
+        INSERT statement. Subclasses override this according to how their database
+        reports generated ids; by default, or when they cannot be known for sure, the
+        ids are None.
+        """
+        return [None] * count
+
+
+    def can_insert_many(self, columns):
+        """
+        Whether insert can insert rows with the given columns with multi-row INSERT
+        statements. Subclasses return False when the ids of rows inserted together cannot
+        be told, but those of rows inserted one by one can
+        """
+        return True
     
 
+    def load(self, rows, columns=None, progress=None, progress_every=100000):
+        """
+        Load many rows as fast as the database allows (see monsql.load): COPY on
+        PostgreSQL, LOAD DATA on MySQL, executemany in one transaction otherwise. rows
+        are read as they are loaded, so a generator keeps memory use bounded.
+
+        :Parameters:
+
+        - rows: an iterable of dicts, or of sequences of values ordered as columns
+        - columns: the columns loaded, by default the columns of the table, or for dicts
+          the keys of the first one. Keys missing from a dict are loaded as NULL
+        - progress: called with a monsql.load.LoadProgress every progress_every rows,
+          and when the load is done
+
+        The load is one transaction, committed at its end whatever the transaction mode.
+        Inside a transaction block, it is part of the transaction of the block.
+
+        :Return: a LoadProgress with the number of rows loaded and the rows per second
+        """
+        columns, rows = load_columns(self, rows, columns)
+        reader = RowReader(rows, columns, progress=progress, progress_every=progress_every)
+        with self.database.transaction():
+            self.load_rows(reader)
+        return reader.finish()
+
+    def load_rows(self, reader):
+        """
+        Insert the rows of reader (a monsql.load.RowReader) in the current transaction.
+        Databases with a bulk loading statement override this
+        """
+        sql = build_insert_template(self.name, reader.columns, self.PLACEHOLDER)
+        run = lambda cursor, sql, rows: cursor.executemany(sql, rows)
+        for rows in reader.batches(self.LOAD_BATCH_SIZE):
+            rows = [[value_to_sql_param(value) for value in row] for row in rows]
+            self.database.execute(self.cursor, sql, rows, write=self.name, run=run)
+
+
+    def upsert(self, data_or_list_of_data, conflict_keys=None, update_fields=None, batch_size=None):
+        """
+        Insert rows, updating the existing rows they conflict with instead, with one
+        native statement per batch (ON CONFLICT, ON DUPLICATE KEY UPDATE or
+        INSERT OR REPLACE depending on the database).
+
+        :Examples:
+
+        >>> user_table.upsert({'id': 1, 'username': 'Jude'})
+        >>> user_table.upsert([{'email': ..., 'visits': 3}, ...], conflict_keys=['email'], update_fields=['visits'])
+
+        :Parameters:
+
+        - data_or_list_of_data: Either a dict or a list of dict. Like insert, consecutive
+          dicts with the same keys share one statement
+        - conflict_keys: the columns of the unique constraint identifying a row, by default
+          the primary key. Every dict must contain them. MySQL checks all unique keys
+          of the table whatever conflict_keys is
+        - update_fields: the columns to overwrite in conflicting rows, by default all the
+          given columns except conflict_keys. An empty list leaves conflicting rows unchanged
+        - batch_size: the maximum number of rows in one statement, by default INSERT_BATCH_SIZE
+
+        When a list contains several dicts with the same conflict keys in one batch, only
+        the last one is written.
+
+        :Return: the number of rows inserted or updated, as reported by the database:
+          rows left unchanged are not counted, and MySQL counts updated rows twice
+        """
+        if not isinstance(data_or_list_of_data, list):
+            data_or_list_of_data = [data_or_list_of_data]
+
+        if conflict_keys is None:
+            conflict_keys = self.schema.primary_key
+            if not conflict_keys:
+                raise MonSQLException('TABLE %s HAS NO PRIMARY KEY, CONFLICT KEYS MUST BE GIVEN' %self.name)
+
+        if batch_size is None:
+            batch_size = self.INSERT_BATCH_SIZE
+        if batch_size < 1:
+            raise MonSQLException('BATCH SIZE MUST BE AT LEAST 1')
+
+        count = 0
+        for columns, rows in group_rows_by_columns(data_or_list_of_data, batch_size, self.MAX_PARAMS):
+            missing = [key for key in conflict_keys if key not in columns]
+            if missing:
+                raise MonSQLException('UPSERTED ROWS MUST CONTAIN THE CONFLICT KEYS: %s' %(','.join(missing)))
+
+            if update_fields is None:
+                update_columns = [column for column in columns if column not in conflict_keys]
+            else:
+                update_columns = [column for column in update_fields if column in columns]
+
+            rows = unique_rows(columns, rows, conflict_keys)
+            sql, params = self.build_upsert(columns, rows, conflict_keys, update_columns)
+            self.database.execute(self.cursor, sql, params, write=self.name)
+            count += max(self.cursor.rowcount, 0)
+
+        return count
+
+
+    def parallel_scan(self, filter=None, fields=None, partitions=None, workers=None, callback=None,
+                      batch_size=1000, key=None):
+        """
+        Read the rows matching filter with several connections at once: the rows are
+        split into partitions by ranges of key, scanned concurrently by worker threads.
+        Requires a pooled database. See monsql.parallel
+
+        :Parameters:
+
+        - filter, fields: as for find
+        - partitions: the number of ranges, by default the number of workers
+        - workers: the number of threads, by default the size of the pool minus one,
+          left to the calling thread
+        - callback: if given, called as callback(partition, rows) with the rows of each
+          partition in lists of at most batch_size rows, from the worker threads: it must
+          be thread-safe. Rows are then not kept in memory
+        - key: the column the rows are split by, by default the primary key, which must
+          be a single column. With another column, the rows where it is NULL are read
+          as one more partition, the last one
+
+        :Return: for each partition in key order, its list of rows, or with callback, its
+          number of rows
+        """
+        return parallel_scan(self, filter=filter, fields=fields, partitions=partitions, workers=workers,
+                             callback=callback, batch_size=batch_size, key=key)
+
+
+    def bulk_write(self, operations, ordered=True):
+        """
+        Run a list of write operations with as few statements as possible: consecutive
+        operations of the same kind are batched together.
+
+        :Examples:
+
+        >>> from monsql import InsertOne, Upsert, UpdateMany, DeleteMany
+        >>> result = user_table.bulk_write([InsertOne({'username': 'Jude'}), UpdateMany({'id': 5}, {'state': 2})])
+        >>> result.inserted_count, result.updated_count, result.errors
+
+        :Parameters:
+
+        - operations: a list of InsertOne, Upsert, UpdateMany and DeleteMany
+        - ordered: if True, stop at the first failing operation. Otherwise run all the
+          operations that can be run
+
+        The writes are part of the current transaction, like those of insert and update.
+
+        :Return: a BulkWriteResult, whose errors list the failed operations
+        """
+        return bulk_write(self.database, [(self, operation) for operation in operations], ordered)
+
+
+    def build_upsert(self, columns, rows, conflict_keys, update_columns):
+        """
+        Return the sql and params of an upsert of rows (lists of values ordered as
+        columns). Subclasses override this according to the syntax of their database;
+        by default it is INSERT ... ON CONFLICT ... DO UPDATE
+        """
+        return build_upsert_on_conflict(self.name, columns, rows, conflict_keys, update_columns, self.PLACEHOLDER)
+
+
     def update(self, query, attributes, upsert=False):
         """
         Updates data in the table.
@@ -214,10 +509,21 @@ class Table:
 
         - query(dict), specify the WHERE clause
         - attributes(dict), specify the SET clause
-        - upsert: boolean. If True, then when there's no row matches the query, insert the values
+        - upsert: boolean. If True, then when there's no row matches the query, insert the values.
+          When the query gives exactly the primary key and the database has a NATIVE_UPSERT,
+          this is done with one upsert statement and the inserted row contains the query
+          values too
+
+        Long $in lists are split like in find (see IN_CHUNK_SIZE), with one UPDATE per
+        chunk. A row which the update makes match a later chunk is counted again.
 
         :Return: Number of rows updated or inserted
         """
+        if upsert and self.NATIVE_UPSERT and self.__is_primary_key_query(query, attributes):
+            document = dict(query)
+            document.update(attributes)
+            return self.upsert(document, conflict_keys=sorted(query.keys()), update_fields=attributes.keys())
+
         if upsert:
             found_result = self.find_one(query)
             if not found_result:
@@ -227,8 +533,29 @@ class Table:
                 else:
                     return 0
 
-        sql = build_update(self.name, query, attributes)
-        return self.cursor.execute(sql)
+        conditions = self.__in_chunks(query)
+        if len(conditions) > 1:
+            return self.__write_chunks(conditions, lambda condition:
+                                       build_update(self.name, condition, attributes, self.PLACEHOLDER))
+
+        sql, params = build_update(self.name, bind_in_arrays(query, self.IN_ARRAY), attributes, self.PLACEHOLDER)
+        return self.database.execute(self.cursor, sql, params, write=self.name)
+    
+    
+    def __is_primary_key_query(self, query, attributes):
+        """
+        Whether query is a plain equality match on the whole primary key, not changed
+        by attributes, so update(upsert=True) can run as a native upsert
+        """
+        if not isinstance(query, dict) or not query or not attributes:
+            return False
+        primary_key = self.schema.primary_key
+        if sorted(query.keys()) != sorted(primary_key):
+            return False
+        for key, value in query.items():
+            if isinstance(value, dict) or (key in attributes and attributes[key] != value):
+                return False
+        return True
     
     
     def remove(self, filter=None):
@@ -239,8 +566,51 @@ class Table:
 
         - query(dict), specify the WHERE clause
 
+        Long $in lists are split like in find (see IN_CHUNK_SIZE), with one DELETE per
+        chunk.
+
         :Return: Number of rows deleted
         """
-        sql = build_delete(table_name=self.name, condition=filter)
-        return self.cursor.execute(sql)
+        conditions = self.__in_chunks(filter)
+        if len(conditions) > 1:
+            return self.__write_chunks(conditions, lambda condition:
+                                       build_delete(self.name, condition, self.PLACEHOLDER))
+
+        sql, params = build_delete(table_name=self.name, condition=bind_in_arrays(filter, self.IN_ARRAY),
+                                   placeholder=self.PLACEHOLDER)
+        return self.database.execute(self.cursor, sql, params, write=self.name)
+
+
+    def __in_chunks(self, condition):
+        """
+        The conditions a statement on the rows matching condition runs with: condition
+        split on its long $in lists if the table has an IN_CHUNK_SIZE (see
+        split_in_condition), otherwise condition alone
+        """
+        if not self.IN_CHUNK_SIZE:
+            return [condition]
+        chunks = split_in_condition(condition, self.IN_CHUNK_SIZE)
+        if chunks is None:
+            return [condition]
+        return [c for chunk in chunks for c in self.__in_chunks(chunk)]
 
+
+    def __write_chunks(self, conditions, build):
+        """
+        Run the write statement build(condition) returns for each condition, in one
+        transaction block unless in MANUAL mode, like bulk_write
+
+        :Return: the number of rows written
+        """
+        def run():
+            count = 0
+            for condition in conditions:
+                sql, params = build(bind_in_arrays(condition, self.IN_ARRAY))
+                self.database.execute(self.cursor, sql, params, write=self.name)
+                count += max(self.cursor.rowcount, 0)
+            return count
+
+        if self.database.mode == TRANSACTION_MODE.MANUAL:
+            return run()
+        with self.database.transaction():
+            return run()
@@ -6,44 +6,188 @@ The World's "most" popular open source database
 
 
 import MySQLdb
+import MySQLdb.cursors
+import tempfile
+from itertools import islice
 from db import Database
 from table import Table
+from sql import build_upsert_on_duplicate_key
+from schema import TableSchema
 from config import TRANSACTION_MODE
+from pool import connect_or_pool
+from load import tsv_line
+from exception import MonSQLException
 
 class MySQLTable(Table):
-    
-    def fetch_columns(self):
-        sql = u"SHOW COLUMNS FROM %s" %(self.name)
-        self.cursor.execute(sql)
-        columns = []
-        for column in self.cursor.fetchall():
-            column = column[0]
-            columns.append(column)
-        self.columns = columns
+
+    # MySQL has no array params, so queries with long $in lists are split into
+    # several queries, each parsed much faster than one giant statement
+    IN_CHUNK_SIZE = 4096
+
+    # ON DUPLICATE KEY UPDATE fires on a conflict on any unique key, not only on
+    # conflict_keys: update(upsert=True) could overwrite another row than the one matched,
+    # so it finds, then inserts or updates instead
+    NATIVE_UPSERT = False
+
+    def generated_ids(self, count):
+        """
+        MySQL reports the id of the first row of a multi-row INSERT. The following ids
+        follow it every auto_increment_increment, unless innodb_autoinc_lock_mode is 2
+        (interleaved, the default since MySQL 8), in which case they are unknown
+        """
+        first_id = self.cursor.lastrowid
+        step = self.database.auto_increment_step
+        if not first_id or step is None:
+            return [None] * count
+        return range(first_id, first_id + count * step, step)
+
+    def can_insert_many(self, columns):
+        """
+        The ids of rows inserted together can only be told if the rows give their
+        primary key, or if the ids generated for them are evenly spaced
+        """
+        primary_key = self.schema.primary_key
+        if len(primary_key) == 1 and primary_key[0] in columns:
+            return True
+        return self.database.auto_increment_step is not None
+
+    def build_upsert(self, columns, rows, conflict_keys, update_columns):
+        """
+        Rows conflicting with an existing row on any unique key of the table update it,
+        whatever conflict_keys is
+        """
+        return build_upsert_on_duplicate_key(self.name, columns, rows, update_columns, self.PLACEHOLDER)
+
+    # Number of rows written to one temporary file loaded with LOAD DATA
+    LOAD_SPOOL_ROWS = 100000
+
+    def load_rows(self, reader):
+        """
+        Write the rows to temporary files of LOAD_SPOOL_ROWS rows, each loaded with LOAD
+        DATA LOCAL INFILE, which MySQLdb only reads from a file. Without local_infile,
+        fall back to executemany, which MySQLdb sends as multi-row INSERT statements.
+
+        LOAD DATA LOCAL skips duplicate rows and truncates values it cannot convert with
+        a warning instead of an error, so a file is checked to be loaded whole: if fewer
+        rows are loaded, or there are warnings, a MonSQLException is raised with the
+        first warnings, and the load is rolled back
+        """
+        if not self.database.local_infile:
+            return Table.load_rows(self, reader)
+
+        sql = "LOAD DATA LOCAL INFILE %%s INTO TABLE %s CHARACTER SET utf8mb4 (%s)" %(self.name,
+                                                                                     ','.join(reader.columns))
+        rows = iter(reader)
+        while True:
+            with tempfile.NamedTemporaryFile(prefix='monsql_', suffix='.tsv') as spool:
+                written = 0
+                for row in islice(rows, self.LOAD_SPOOL_ROWS):
+                    spool.write(tsv_line(row))
+                    written += 1
+                if written == 0:
+                    return
+                spool.flush()
+                self.database.execute(self.cursor, sql, [spool.name], write=self.name)
+                self.check_loaded(written)
+
+    # Number of warnings reported in the exception of a failed LOAD DATA
+    LOAD_WARNINGS_REPORTED = 5
+
+    def check_loaded(self, written):
+        """
+        Raise a MonSQLException if the last LOAD DATA did not load the written rows as
+        they are
+        """
+        cursor = self.cursor
+        loaded = cursor.rowcount
+        warnings = self.database.execute(cursor, 'SHOW WARNINGS LIMIT %d' %(self.LOAD_WARNINGS_REPORTED),
+                                         fetch=lambda cursor: cursor.fetchall())
+        if loaded != written or warnings:
+            raise MonSQLException('LOAD DATA INTO %s LOADED %d OF %d ROWS: %s' %(
+                self.name, loaded, written, '; '.join(['%s %s: %s' %(tuple(warning[:3])) for warning in warnings])))
 
 
 class MySQLDatabase(Database):
 
     def __init__(self, host='127.0.0.1', port=3306, username='', password='',
-                 dbname='test', mode=TRANSACTION_MODE.DEFAULT):
-        db = MySQLdb.Connect(host=host, port=port, user=username,
-                                    passwd=password, db=dbname)
-        Database.__init__(self, db)
+                 dbname='test', mode=TRANSACTION_MODE.DEFAULT,
+                 pool_size=None, pool_min_size=1, pool_timeout=30, local_infile=False):
+        """
+        local_infile allows LOAD DATA LOCAL INFILE, used by Table.load. It lets the
+        server read any file of the client, so only enable it for trusted servers
+        """
+        self.local_infile = local_infile
+
+        def connect():
+            if local_infile:
+                return MySQLdb.Connect(host=host, port=port, user=username,
+                                       passwd=password, db=dbname, local_infile=1)
+            return MySQLdb.Connect(host=host, port=port, user=username,
+                                   passwd=password, db=dbname)
+
+        db = connect_or_pool(connect, pool_size, pool_min_size, pool_timeout)
+        Database.__init__(self, db, mode)
+        self.__auto_increment_step = None
+        self.__auto_increment_step_read = False
+
+    @property
+    def auto_increment_step(self):
+        """
+        The difference between the consecutive ids generated by one multi-row INSERT:
+        the auto_increment_increment of the server, or None if the ids are not evenly
+        spaced because innodb_autoinc_lock_mode is 2. Read when first needed
+        """
+        if not self.__auto_increment_step_read:
+            lock_mode, increment = self.execute(self.cursor,
+                                                'SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment',
+                                                fetch=lambda cursor: cursor.fetchone())
+            if int(lock_mode) != 2:
+                self.__auto_increment_step = int(increment)
+            self.__auto_increment_step_read = True
+        return self.__auto_increment_step
+
+    def load_schema(self):
+        """
+        Read the columns of all tables of the current database from INFORMATION_SCHEMA
+        with one query, together with their position in the primary key
+        """
+        rows = self.execute(self.cursor, '''SELECT c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE, k.ORDINAL_POSITION
+                               FROM INFORMATION_SCHEMA.COLUMNS c
+                               LEFT JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE k
+                                 ON k.TABLE_SCHEMA = c.TABLE_SCHEMA AND k.TABLE_NAME = c.TABLE_NAME
+                                 AND k.COLUMN_NAME = c.COLUMN_NAME AND k.CONSTRAINT_NAME = 'PRIMARY'
+                               WHERE c.TABLE_SCHEMA = DATABASE()
+                               ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION''', fetch=lambda cursor: cursor.fetchall())
+        tables = {}
+        for tablename, column, type, pk in rows:
+            key = tablename.lower()
+            if key not in tables:
+                tables[key] = TableSchema(tablename)
+            tables[key].add_column(column, type, pk)
+        return tables
 
     def list_tables(self):
-        self.cursor.execute('show tables')
-        all_tablenames = [row[0].lower() for row in self.cursor.fetchall()]
+        rows = self.execute(self.cursor, 'show tables', fetch=lambda cursor: cursor.fetchall())
+        all_tablenames = [row[0].lower() for row in rows]
         return all_tablenames
 
+    def server_side_cursor(self):
+        """
+        Use SSCursor, which reads the result from the server row by row
+        """
+        return self.db.cursor(MySQLdb.cursors.SSCursor)
+
     def get_table_obj(self, name):
-        table = MySQLTable(db=self.db, name=name, mode=self.mode)
+        table = MySQLTable(db=None, name=name, mode=self.mode, database=self)
         return table
 
     def truncate_table(self, tablename):
         """
         Use 'TRUNCATE TABLE' to truncate the given table
         """
-        self.cursor.execute('TRUNCATE TABLE %s' %tablename)
-        self.db.commit()
+        self.execute(self.cursor, 'TRUNCATE TABLE %s' %tablename)
+        self.commit_schema_change()
+        self.invalidate_results(tablename)
+        self.refresh_schema()
 
         
\ No newline at end of file
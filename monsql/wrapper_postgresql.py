@@ -5,67 +5,129 @@ Postgres
 
 
 import psycopg2
+import uuid
 from db import Database
 from table import Table
+from query import InArray
+from schema import TableSchema
 from config import TRANSACTION_MODE
+from pool import connect_or_pool
+from load import LineStream, copy_csv_line
 
 class PostgreSQLTable(Table):
-    
-    def fetch_columns(self):
-        sql = u"select column_name, data_type, character_maximum_length \
-               from INFORMATION_SCHEMA.COLUMNS where table_name='%s';" %(self.name)
-        self.cursor.execute(sql)
-        columns = []
-        for column in self.cursor.fetchall():
-            column = column[0]
-            columns.append(column)
-        self.columns = columns
+
+    # Long $in lists are passed as one array param. psycopg2 adapts the values, so that
+    # an array of dates is a date[], which a text[] of formatted dates could not be
+    # compared with
+    IN_ARRAY = InArray(u'= ANY(%s)', 1024, convert=False)
+
+    def load_rows(self, reader):
+        """
+        Stream the rows with COPY FROM STDIN, encoded as CSV as psycopg2 reads them
+        """
+        sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' %(self.name, ','.join(reader.columns))
+        stream = LineStream(copy_csv_line(row) for row in reader)
+        self.database.execute(self.cursor, sql, stream, write=self.name,
+                              run=lambda cursor, sql, stream: cursor.copy_expert(sql, stream))
 
 
 class PostgreSQLDatabase(Database):
 
+    STATEMENT_ERROR_ABORTS_TRANSACTION = True
+
     def __init__(self, host=None, port=None, username='', password='',
-                 dbname='test', mode=TRANSACTION_MODE.DEFAULT):
+                 dbname='test', mode=TRANSACTION_MODE.DEFAULT,
+                 pool_size=None, pool_min_size=1, pool_timeout=30):
         if port is None:
             port = 5432
             
         if host is None:
             host = '127.0.0.1'
 
-        db = psycopg2.connect("host=%s port=%d user=%s password=%s dbname=%s"
-                              %(host, port, username, password, dbname))
+        def connect():
+            return psycopg2.connect("host=%s port=%d user=%s password=%s dbname=%s"
+                                    %(host, port, username, password, dbname))
+
+        db = connect_or_pool(connect, pool_size, pool_min_size, pool_timeout)
+        Database.__init__(self, db, mode)
 
-        Database.__init__(self, db)
+    def load_schema(self):
+        """
+        Read the columns of all user tables from information_schema with one query,
+        together with their position in the primary key. Tables outside the public
+        schema are named schema.table, as in list_tables. Types are the short names of
+        PostgreSQL (varchar, int4, float8, ...) rather than the standard names of
+        data_type (character varying, integer, ...), closer to those of other databases
+        """
+        rows = self.execute(self.cursor, '''SELECT c.table_schema, c.table_name, c.column_name, c.udt_name, k.ordinal_position
+                               FROM information_schema.columns c
+                               LEFT JOIN information_schema.table_constraints t
+                                 ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+                                 AND t.constraint_type = 'PRIMARY KEY'
+                               LEFT JOIN information_schema.key_column_usage k
+                                 ON k.constraint_schema = t.constraint_schema AND k.constraint_name = t.constraint_name
+                                 AND k.table_name = c.table_name AND k.column_name = c.column_name
+                               WHERE c.table_schema NOT IN ('pg_catalog', 'information_schema')
+                               ORDER BY c.table_schema, c.table_name, c.ordinal_position''',
+                            fetch=lambda cursor: cursor.fetchall())
+        tables = {}
+        for schema_name, tablename, column, type, pk in rows:
+            if schema_name != 'public':
+                tablename = '%s.%s' %(schema_name, tablename)
+            key = tablename.lower()
+            if key not in tables:
+                tables[key] = TableSchema(tablename)
+            tables[key].add_column(column, type, pk)
+        return tables
 
     def list_tables(self):
-        self.cursor.execute('SELECT table_schema, table_name \
-                             FROM information_schema.tables \
-                             ORDER BY table_name;')
+        rows = self.execute(self.cursor, 'SELECT table_schema, table_name \
+                                          FROM information_schema.tables \
+                                          ORDER BY table_name;', fetch=lambda cursor: cursor.fetchall())
         all_tablenames = map(lambda row: row[1].lower() if row[0] == 'public' \
-                             else "%s.%s" % (row[0], row[1]), self.cursor.fetchall())
+                             else "%s.%s" % (row[0], row[1]), rows)
         return all_tablenames
 
+    def server_side_cursor(self):
+        """
+        Use a named cursor, which keeps the result on the server and fetches it in batches
+        """
+        return self.db.cursor(name='monsql_%s' %(uuid.uuid4().hex))
+
+    def copy_to_csv(self, sql, params, fileobj, header=True):
+        """
+        COPY (query) TO STDOUT, the params being inlined by psycopg2 since COPY takes none
+        """
+        cursor = self.cursor
+        sql = 'COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER %s)' %(cursor.mogrify(sql, params),
+                                                                   'true' if header else 'false')
+        self.execute(cursor, sql, fileobj, run=lambda cursor, sql, fileobj: cursor.copy_expert(sql, fileobj))
+        return cursor.rowcount
+
     def get_table_obj(self, name):
-        table = PostgreSQLTable(db=self.db, name=name, mode=self.mode)
+        table = PostgreSQLTable(db=None, name=name, mode=self.mode, database=self)
         return table
 
     def truncate_table(self, tablename):
         """
         Use 'TRUNCATE TABLE' to truncate the given table
         """
-        self.cursor.execute('TRUNCATE TABLE %s' %tablename)
-        self.db.commit()
+        self.execute(self.cursor, 'TRUNCATE TABLE %s' %tablename)
+        self.commit_schema_change()
+        self.invalidate_results(tablename)
+        self.refresh_schema()
 
     def create_schema(self, schema_name):
         """
         Create schema. This method only implemented for this class
         """
         try:
-            self.cursor.execute('CREATE SCHEMA %s' % schema_name)
+            self.execute(self.cursor, 'CREATE SCHEMA %s' % schema_name)
         except Exception as e:
             raise e
         finally:
-            self.db.commit()
+            self.commit_schema_change()
+            self.refresh_schema()
 
     def drop_schema(self, schema_name, cascade=False):
         sql = 'DROP SCHEMA %s' %schema_name
@@ -73,9 +135,10 @@ class PostgreSQLDatabase(Database):
             sql += ' CASCADE'
 
         try:
-            self.cursor.execute(sql)
+            self.execute(self.cursor, sql)
         except Exception as e:
             raise e
         finally:
-            self.db.commit()
+            self.commit_schema_change()
+            self.refresh_schema()
         
\ No newline at end of file
@@ -6,36 +6,168 @@ data storage and prototyping for applications.
 '''
 
 
+import json
 import sqlite3
 from db import Database
 from table import Table
+from sql import build_insert_or_replace
+from query import InArray
+from schema import TableSchema
+from pool import connect_or_pool
+from config import TRANSACTION_MODE
+from exception import MonSQLException
+
+def has_json_functions():
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('SELECT json_array()')
+        return True
+    except sqlite3.Error:
+        return False
+    finally:
+        connection.close()
+
 
 class SQLite3Table(Table):
-    def fetch_columns(self):
-        sql = u"PRAGMA table_info(%s)" %(self.name)
-        self.cursor.execute(sql)
-        columns = []
 
-        for column in self.cursor.fetchall():
-            column = column[1]
-            columns.append(column)
-        self.columns = columns
+    PLACEHOLDER = u'?'
+
+    # SQLite versions before 3.32 accept at most 999 params in a statement
+    MAX_PARAMS = 999
+
+    # Long $in lists are passed as one JSON array read with json_each, because of
+    # MAX_PARAMS. Without the JSON functions they are split into chunks instead
+    if has_json_functions():
+        IN_ARRAY = InArray(u'IN (SELECT value FROM json_each(%s))', 256, json.dumps)
+    else:
+        IN_CHUNK_SIZE = 256
+
+    # Page cache used while loading rows, in KiB
+    LOAD_CACHE_KB = 64 * 1024
+
+    # ON CONFLICT ... DO UPDATE is available since SQLite 3.24. Before, build_upsert
+    # replaces whole rows
+    NATIVE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+    def build_upsert(self, columns, rows, conflict_keys, update_columns):
+        """
+        Older versions fall back to INSERT OR REPLACE, which replaces conflicting rows
+        as a whole (conflicts on any unique key) instead of updating update_columns
+        """
+        if self.NATIVE_UPSERT:
+            return Table.build_upsert(self, columns, rows, conflict_keys, update_columns)
+        return build_insert_or_replace(self.name, columns, rows, self.PLACEHOLDER)
+
+    def load(self, rows, columns=None, progress=None, progress_every=100000):
+        """
+        Table.load, with the database not waiting for the data to be written to disk
+        (synchronous=OFF) and a larger page cache until the load is committed. A crash of
+        the computer during a load can corrupt the database file. SQLite cannot change
+        this inside a transaction, so in a transaction block the settings are kept
+        """
+        if self.database.in_transaction:
+            return Table.load(self, rows, columns=columns, progress=progress, progress_every=progress_every)
+
+        cursor = self.cursor
+        fetch = lambda cursor: cursor.fetchone()[0]
+        synchronous = self.database.execute(cursor, 'PRAGMA synchronous', fetch=fetch)
+        cache_size = self.database.execute(cursor, 'PRAGMA cache_size', fetch=fetch)
+        self.database.execute(cursor, 'PRAGMA synchronous = OFF')
+        self.database.execute(cursor, 'PRAGMA cache_size = %d' %(-self.LOAD_CACHE_KB))
+        try:
+            return Table.load(self, rows, columns=columns, progress=progress, progress_every=progress_every)
+        finally:
+            self.database.execute(cursor, 'PRAGMA synchronous = %d' %(synchronous))
+            self.database.execute(cursor, 'PRAGMA cache_size = %d' %(cache_size))
+
+    def generated_ids(self, count):
+        """
+        SQLite reports the rowid of the last row of a multi-row INSERT. The rowids
+        it generates for the rows of one statement are consecutive
+        """
+        last_id = self.cursor.lastrowid
+        if last_id is None:
+            return [None] * count
+        return range(last_id - count + 1, last_id + 1)
 
 
 class SQLite3Database(Database):
 
-    def __init__(self, file_path=None):
+    def __init__(self, file_path=None, mode=TRANSACTION_MODE.DEFAULT,
+                 pool_size=None, pool_min_size=1, pool_timeout=30):
+        """
+        Pass pool_size to use a pool of at most pool_size connections, one per thread.
+        Only a file-backed database can be pooled: every connection to ":memory:"
+        would open a different database
+        """
         if file_path is None: file_path = ":memory:"
-        db = sqlite3.connect(file_path)
-        Database.__init__(self, db)
+        if pool_size is not None and file_path == ":memory:":
+            raise MonSQLException('AN IN-MEMORY SQLITE3 DATABASE CANNOT BE POOLED')
+
+        def connect():
+            # Pooled connections are handed from thread to thread, one thread at a time
+            return sqlite3.connect(file_path, check_same_thread=pool_size is None)
+
+        db = connect_or_pool(connect, pool_size, pool_min_size, pool_timeout)
+        Database.__init__(self, db, mode)
+
+    def begin_transaction(self):
+        """
+        The sqlite3 module commits the open transaction before a SAVEPOINT statement, so
+        inside transaction blocks it is put in autocommit mode and the transaction is
+        handled here
+        """
+        connection = self.db
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        self.execute(self.cursor, 'BEGIN')
+        return isolation_level
+
+    def commit_transaction(self, isolation_level):
+        try:
+            self.execute(self.cursor, 'COMMIT')
+        finally:
+            self.db.isolation_level = isolation_level
+
+    def rollback_transaction(self, isolation_level):
+        try:
+            self.execute(self.cursor, 'ROLLBACK')
+        finally:
+            self.db.isolation_level = isolation_level
+
+    def load_schema(self):
+        """
+        Read the columns of all tables at once by joining sqlite_master with the
+        pragma_table_info table-valued function (SQLite 3.16+). Older versions run
+        PRAGMA table_info once per table
+        """
+        tables = {}
+        if sqlite3.sqlite_version_info >= (3, 16, 0):
+            rows = self.execute(self.cursor, '''SELECT m.name, p.name, p.type, p.pk
+                                                FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p
+                                                WHERE m.type = 'table' ORDER BY m.name, p.cid''',
+                                fetch=lambda cursor: cursor.fetchall())
+        else:
+            rows = []
+            for tablename in self.list_tables():
+                columns = self.execute(self.cursor, 'PRAGMA table_info(%s)' %(tablename), fetch=lambda cursor: cursor.fetchall())
+                rows.extend([(tablename, ) + tuple(column[1:3]) + (column[5], ) for column in columns])
+
+        for tablename, column, type, pk in rows:
+            key = tablename.lower()
+            if key not in tables:
+                tables[key] = TableSchema(tablename)
+            tables[key].add_column(column, type, pk or None)
+        return tables
 
     def list_tables(self):
-        self.cursor.execute('''SELECT name FROM sqlite_master WHERE type = 'table' ''')
-        all_tablenames = [row[0].lower() for row in self.cursor.fetchall()]
+        rows = self.execute(self.cursor, '''SELECT name FROM sqlite_master WHERE type = 'table' ''',
+                            fetch=lambda cursor: cursor.fetchall())
+        all_tablenames = [row[0].lower() for row in rows]
         return all_tablenames
 
     def get_table_obj(self, name):
-        table = SQLite3Table(db=self.db, name=name, mode=self.mode)
+        table = SQLite3Table(db=None, name=name, mode=self.mode, database=self)
         return table
 
     def truncate_table(self, tablename):
@@ -43,7 +175,8 @@ class SQLite3Database(Database):
         SQLite3 doesn't support direct truncate, so we just use delete here
         """
         self.get(tablename).remove()
-        self.db.commit()
+        self.commit_schema_change()
+        self.refresh_schema()
 
     
         
\ No newline at end of file
@@ -0,0 +1,58 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from monsql import MonSQL, DB_TYPES, AsyncDatabase
+from monsql.exception import MonSQLException
+
+
+class AsyncDatabaseTest(unittest.TestCase):
+    """
+    Tested with a pooled, file-backed SQLite3 database, whatever DB_TYPE is
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        monsql = MonSQL(dbpath=os.path.join(self.directory, 'async.db'), dbtype=DB_TYPES.SQLITE3, pool_size=4)
+        monsql.create_table('numbers', ['number INT'])
+        self.async_db = AsyncDatabase(monsql)
+
+    def tearDown(self):
+        self.async_db.close()
+        shutil.rmtree(self.directory)
+
+    def test_operations(self):
+        table = self.async_db.get('numbers')
+        ids = table.insert([{'number': i} for i in range(20)]).get()
+        self.assertEqual(len(ids), 20)
+
+        pending = [table.count({'number': {'$lt': i}}) for i in range(10)]
+        self.assertEqual([p.get() for p in pending], range(10))
+
+        rows = table.find({'number': {'$gte': 15}}, sort=[('number', 1)]).get()
+        self.assertEqual([row.number for row in rows], range(15, 20))
+        table.remove({'number': {'$lt': 10}}).get()
+        self.assertEqual(table.count().get(), 10)
+
+    def test_failed_unit_of_work_is_rolled_back(self):
+        def work(db):
+            db.get('numbers').insert({'number': 1})
+            raise ValueError('failed')
+
+        self.assertRaises(ValueError, self.async_db.run(work).get)
+        self.assertEqual(self.async_db.get('numbers').count().get(), 0)
+
+    def test_operations_run_concurrently(self):
+        def slow_count(db):
+            time.sleep(0.2)
+            return db.get('numbers').count()
+
+        start = time.time()
+        pending = [self.async_db.run(slow_count) for i in range(4)]
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertEqual([p.get() for p in pending], [0] * 4)
+        self.assertTrue(time.time() - start < 0.6)
+
+    def test_requires_pool(self):
+        self.assertRaises(MonSQLException, AsyncDatabase, MonSQL(dbtype=DB_TYPES.SQLITE3))
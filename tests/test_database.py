@@ -1,9 +1,14 @@
 import unittest
+import os
+import shutil
+import sqlite3
 import sys
+import tempfile
 from datetime import *
 import time
 from base import *
 from monsql import MonSQL, DESCENDING, DB_TYPES
+from monsql.table import Table
 from monsql.exception import MonSQLException
 
 class MonSQLMetaOperationTest(BaseTestCase):
@@ -45,6 +50,51 @@ class MonSQLMetaOperationTest(BaseTestCase):
         self.assertFalse(self.monsql.is_table_existed(tablename))
 
 
+    def test_schema_cache(self):
+        tablename = 'test_table' + random_name()
+        self.monsql.create_table(tablename, ['id INT NOT NULL', 'name VARCHAR(50)', 'score DOUBLE PRECISION'],
+                                 primary_key=['id'])
+        version = self.monsql.schema_version
+
+        table_obj = self.monsql.get(tablename)
+        schema = self.monsql.table_schema(tablename.upper())
+        self.assertEqual(schema.columns, ['id', 'name', 'score'])
+        self.assertEqual(schema.primary_key, ['id'])
+        self.assertTrue(schema.types['name'].startswith('varchar'))
+        self.assertEqual(table_obj.columns, ['id', 'name', 'score'])
+
+        self.monsql.raw('ALTER TABLE %s ADD COLUMN extra INT' %tablename)
+        self.assertEqual(table_obj.columns, ['id', 'name', 'score', 'extra'])
+        self.assertTrue(self.monsql.schema_version > version)
+
+        self.monsql.drop_table(tablename)
+        self.assertTrue(self.monsql.table_schema(tablename) is None)
+        self.assertRaises(MonSQLException, lambda: table_obj.columns)
+        # Tables are only created by a Database
+        self.assertRaises(MonSQLException, Table, None, tablename)
+
+    def test_tables_created_elsewhere(self):
+        # With a file-backed SQLite3 database, whatever DB_TYPE is, to create the
+        # tables from another connection
+        directory = tempfile.mkdtemp()
+        dbpath = os.path.join(directory, 'schema.db')
+        monsql = MonSQL(dbpath=dbpath, dbtype=DB_TYPES.SQLITE3)
+        try:
+            monsql.create_table('a', ['id INT'])
+            self.assertFalse(monsql.is_table_existed('b'))
+
+            connection = sqlite3.connect(dbpath)
+            connection.execute('CREATE TABLE b(id INT)')
+            connection.execute('INSERT INTO b VALUES (1)')
+            connection.commit()
+            connection.close()
+
+            self.assertEqual([row.id for row in monsql.get('b').find()], [1])
+            self.assertRaises(MonSQLException, monsql.create_table, 'b', ['id INT'])
+        finally:
+            monsql.close()
+            shutil.rmtree(directory)
+
     def test_schema(self):
         if hasattr(self.monsql, 'create_schema'):
             schema_name = random_name()
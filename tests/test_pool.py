@@ -0,0 +1,122 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from monsql import MonSQL, DB_TYPES, TRANSACTION_MODE, ConnectionPool
+from monsql.exception import MonSQLException
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """
+    Pooling is tested with a file-backed SQLite3 database, whatever DB_TYPE is
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.directory, 'pool.db')
+        self.monsql = MonSQL(dbpath=self.dbpath, dbtype=DB_TYPES.SQLITE3, pool_size=3, pool_timeout=0.1)
+        self.monsql.create_table('numbers', ['number INT', 'thread VARCHAR(50)'])
+
+    def tearDown(self):
+        self.monsql.close()
+        shutil.rmtree(self.directory)
+
+    def test_threads_use_own_connections(self):
+        table = self.monsql.get('numbers')
+        connections = {}
+        errors = []
+
+        def work(name):
+            try:
+                with self.monsql.connection():
+                    connections[name] = self.monsql.db
+                    table.insert([{'number': i, 'thread': name} for i in range(10)])
+                    self.monsql.commit()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=('t%d' %i, )) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(table.count(), 60)
+        self.assertEqual(table.count({'thread': 't3'}), 10)
+        self.assertTrue(self.monsql.pool.size <= 3)
+
+    def test_parallel_scan(self):
+        self.monsql.create_table('events', ['id INTEGER PRIMARY KEY', 'name VARCHAR(20)'])
+        events = self.monsql.get('events')
+        events.insert([{'id': i, 'name': 'event%03d' % i} for i in range(1, 101)])
+        self.monsql.commit()
+
+        partitions = events.parallel_scan({'id': {'$gt': 10}}, partitions=4)
+        self.assertEqual(len(partitions), 4)
+        self.assertEqual(sorted([row.id for rows in partitions for row in rows]), range(11, 101))
+        self.assertEqual(max([row.id for row in partitions[0]]) < min([row.id for row in partitions[1]]), True)
+
+        batches = []
+        lock = threading.Lock()
+        def collect(partition, rows):
+            with lock:
+                batches.append((partition, len(rows)))
+        counts = events.parallel_scan(fields=['name'], key='name', partitions=3, workers=2, callback=collect,
+                                      batch_size=10)
+        self.assertEqual(sum(counts), 100)
+        self.assertTrue(max([size for partition, size in batches]) <= 10)
+        # The partition of NULL names is empty
+        self.assertEqual(counts[-1], 0)
+        self.assertEqual(sorted(set([partition for partition, size in batches])), range(len(counts) - 1))
+
+        self.assertEqual(events.parallel_scan({'id': 1000}), [])
+
+        # Rows whose key is NULL are scanned too
+        events.update({'id': {'$lte': 10}}, {'name': None})
+        self.monsql.commit()
+        partitions = events.parallel_scan(key='name', partitions=3)
+        self.assertEqual(sorted([row.id for rows in partitions for row in rows]), range(1, 101))
+        self.assertEqual(sorted([row.id for row in partitions[-1]]), range(1, 11))
+        events.update({}, {'name': None})
+        self.monsql.commit()
+        self.assertEqual(len(events.parallel_scan(key='name', partitions=3)[0]), 100)
+        self.assertRaises(MonSQLException, self.monsql.get('numbers').parallel_scan)
+
+    def test_release(self):
+        # Writes pending in GROUP mode are committed, others rolled back
+        for mode, expected in ((TRANSACTION_MODE.GROUP, 1), (TRANSACTION_MODE.MANUAL, 0)):
+            monsql = MonSQL(dbpath=self.dbpath, dbtype=DB_TYPES.SQLITE3, pool_size=1, mode=mode)
+            try:
+                monsql.raw('DELETE FROM numbers')
+                monsql.commit()
+                monsql.get('numbers').insert({'number': 1})
+                monsql.release()
+                self.assertFalse(monsql.has_uncommitted_writes)
+                self.assertEqual(monsql.get('numbers').count(), expected)
+            finally:
+                monsql.close()
+
+    def test_checkout_timeout(self):
+        pool = self.monsql.pool
+        self.monsql.release()
+        connections = [pool.checkout() for i in range(3)]
+        self.assertRaises(MonSQLException, pool.checkout)
+
+        pool.checkin(connections.pop())
+        connections.append(pool.checkout())
+        for connection in connections:
+            pool.checkin(connection)
+
+    def test_health_check_replaces_broken_connection(self):
+        pool = self.monsql.pool
+        self.monsql.release()
+        connection = pool.checkout()
+        pool.checkin(connection)
+        connection.close()
+
+        self.assertTrue(pool.checkout() is not connection)
+
+    def test_memory_database_cannot_be_pooled(self):
+        self.assertRaises(MonSQLException, MonSQL, dbtype=DB_TYPES.SQLITE3, pool_size=2)
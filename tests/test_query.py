@@ -0,0 +1,154 @@
+import unittest
+import pickle
+from datetime import *
+from monsql.query import Query, QueryCondition, condition_shape, InArray, bind_in_arrays, split_in_condition
+from monsql.queryset import row_class
+from monsql.sql import build_upsert_on_conflict, build_upsert_on_duplicate_key, build_insert_or_replace, unique_rows
+from monsql.load import copy_csv_line, tsv_line, LineStream
+from monsql.exception import MonSQLException
+
+
+class QueryConditionTest(unittest.TestCase):
+
+    FILTERS = [
+        {},
+        {'a': 1},
+        {'a': 1, 'b': 'x', 'c': None},
+        {'a': {'$gt': 1, '$lte': 10}},
+        {'a': {'$in': [1, 2, 3]}},
+        {'a': {'$in': []}},
+        {'name': {'$contains': 'de'}},
+        {'$not': {'a': {'$in': ['x', 'y']}}},
+        {'$or': [{'a': 1, 'b': 2}, {'$and': [{'c': {'$lt': date.today()}}, {'d': datetime.now()}]}]},
+    ]
+
+    def test_shape_params_match_compiled_params(self):
+        for filter in self.FILTERS:
+            sql, params = QueryCondition(filter).to_sql()
+            shape, shape_params = condition_shape(filter)
+            self.assertEqual(params, shape_params)
+
+    def test_same_shape_same_sql(self):
+        pairs = [
+            ({'a': 1, 'b': 2}, {'b': 3, 'a': 4}),
+            ({'a': {'$in': [1, 2, 3]}}, {'a': {'$in': [4, 5, 6, 7]}}),
+            ({'$or': [{'a': 1}, {'b': 'x'}]}, {'$or': [{'a': 2}, {'b': 'y'}]}),
+        ]
+        for first, second in pairs:
+            self.assertEqual(condition_shape(first)[0], condition_shape(second)[0])
+            self.assertEqual(QueryCondition(first).to_sql()[0], QueryCondition(second).to_sql()[0])
+
+        self.assertNotEqual(condition_shape({'a': {'$in': [1, 2]}})[0],
+                            condition_shape({'a': {'$in': [1, 2, 3]}})[0])
+        self.assertNotEqual(condition_shape({'a': 1})[0], condition_shape({'a': None})[0])
+
+    def test_null(self):
+        self.assertEqual(QueryCondition({'a': None}).to_sql(), (u'a IS NULL', []))
+        self.assertEqual(QueryCondition({'a': {'$eq': None}}).to_sql(), (u'a IS NULL', []))
+
+    def test_in_list_is_padded(self):
+        sql, params = QueryCondition({'a': {'$in': [1, 2, 3]}}, placeholder='?').to_sql()
+        self.assertEqual(sql, 'a IN (?,?,?,?) ')
+        self.assertEqual(params, [1, 2, 3, 3])
+
+    def test_long_in_list_as_one_param(self):
+        in_array = InArray(u'= ANY(%s)', 4)
+        condition = {'a': 1, '$or': [{'b': {'$in': range(10)}}, {'c': {'$in': [1, 2]}}]}
+        bound = bind_in_arrays(condition, in_array)
+        self.assertEqual(condition['$or'][0]['b']['$in'], range(10))
+        self.assertTrue(bound['$or'][1] is condition['$or'][1])
+
+        sql, params = QueryCondition(bound).to_sql()
+        self.assertEqual(sql, '((b = ANY(%s)  OR c IN (%s,%s) ) AND a =%s)')
+        self.assertEqual(params, [range(10), 1, 2, 1])
+        self.assertEqual(condition_shape(bound)[1], params)
+        self.assertTrue(bind_in_arrays({'b': {'$in': [1, 2]}}, in_array) == {'b': {'$in': [1, 2]}})
+
+        # Dates are formatted, unless the driver adapts them itself
+        days = [date(2015, 1, day) for day in range(1, 6)]
+        self.assertEqual(condition_shape(bind_in_arrays({'d': {'$in': days}}, in_array))[1],
+                         [['2015-01-0%d' %(day) for day in range(1, 6)]])
+        raw_array = InArray(u'= ANY(%s)', 4, convert=False)
+        self.assertEqual(condition_shape(bind_in_arrays({'d': {'$in': days}}, raw_array))[1], [days])
+
+    def test_split_long_in_list(self):
+        split = split_in_condition({'a': 1, '$and': [{'b': 2}, {'c': {'$in': [1, 2, 2, 3, 4, 5]}}]}, 2)
+        self.assertEqual(split, [{'a': 1, '$and': [{'b': 2}, {'c': {'$in': values}}]}
+                                 for values in ([1, 2], [3, 4], [5])])
+        self.assertEqual(split_in_condition({'c': {'$in': [1, 2]}}, 2), None)
+        self.assertEqual(split_in_condition({'$or': [{'c': {'$in': [1, 2, 3]}}, {'d': 1}]}, 2), None)
+
+    def test_add_filter_flattens_and(self):
+        query = Query(source='t', filter={'a': 1}, fields=['a', 'b'])
+        clone = query.clone().add_filter({'b': 2}).add_filter({'$and': [{'c': 3}, {'d': 4}]})
+        self.assertEqual(clone.filter, {'$and': [{'a': 1}, {'b': 2}, {'c': 3}, {'d': 4}]})
+        self.assertEqual(query.filter, {'a': 1})
+        self.assertTrue(clone.fields is query.fields)
+        self.assertEqual(Query(source='t').add_filter({'a': 1}).filter, {'a': 1})
+
+    def test_invalid_condition(self):
+        self.assertRaises(MonSQLException, condition_shape, {'$or': [{'a': 1}]})
+        self.assertRaises(MonSQLException, condition_shape, {'a': {'$regex': 'x'}})
+
+
+class UpsertSqlTest(unittest.TestCase):
+
+    def test_dialects(self):
+        rows = [[1, 'a'], [2, 'b']]
+        sql, params = build_upsert_on_conflict('t', ['id', 'name'], rows, ['id'], ['name'], '?')
+        self.assertEqual(sql, 'INSERT INTO t(id,name) VALUES(?,?),(?,?) ON CONFLICT (id) DO UPDATE SET name=excluded.name')
+        self.assertEqual(params, [1, 'a', 2, 'b'])
+        sql, params = build_upsert_on_conflict('t', ['id', 'name'], rows, ['id'], [])
+        self.assertTrue(sql.endswith('ON CONFLICT (id) DO NOTHING'))
+
+        sql, params = build_upsert_on_duplicate_key('t', ['id', 'name'], rows, ['name'])
+        self.assertTrue(sql.endswith('ON DUPLICATE KEY UPDATE name=VALUES(name)'))
+        sql, params = build_insert_or_replace('t', ['id', 'name'], rows, '?')
+        self.assertEqual(sql, 'INSERT OR REPLACE INTO t(id,name) VALUES(?,?),(?,?)')
+
+    def test_unique_rows_keeps_last(self):
+        rows = [[1, 'a'], [2, 'b'], [1, 'c']]
+        self.assertEqual(unique_rows(['id', 'name'], rows, ['id']), [[2, 'b'], [1, 'c']])
+        self.assertEqual(unique_rows(['id', 'name'], rows[:2], ['id']), rows[:2])
+
+
+class LoadFormatTest(unittest.TestCase):
+
+    def test_copy_csv(self):
+        line = copy_csv_line([None, 1, 1.5, True, u'a "b",\nc', '', date(2020, 1, 2)])
+        self.assertEqual(line, ',1,1.5,true,"a ""b"",\nc","",2020-01-02\n')
+
+    def test_tsv(self):
+        self.assertEqual(tsv_line([None, 2, 'a\tb\\c\n']), '\\N\t2\ta\\tb\\\\c\\n\n')
+
+    def test_line_stream(self):
+        stream = LineStream(['abc\n', 'de\n', 'f\n'])
+        self.assertEqual(stream.read(2), 'ab')
+        self.assertEqual(stream.read(5), 'c\nde\n')
+        self.assertEqual(stream.read(), 'f\n')
+        self.assertEqual(stream.read(10), '')
+
+
+class RowTest(unittest.TestCase):
+
+    def test_row_access(self):
+        cls = row_class(['id', 'name', 'index', 'data'])
+        self.assertTrue(cls is row_class(('id', 'name', 'index', 'data')))
+
+        row = cls((1, 'jude', 5, 'payload'))
+        self.assertEqual(row.id, 1)
+        self.assertEqual(row.name, 'jude')
+        self.assertEqual(row.index, 5)
+        self.assertEqual(row.data, {'id': 1, 'name': 'jude', 'index': 5, 'data': 'payload'})
+        self.assertRaises(AttributeError, getattr, row, 'missing')
+
+        copied = pickle.loads(pickle.dumps(row))
+        self.assertEqual(copied, row)
+        self.assertEqual(copied.name, 'jude')
+
+        # Columns hide the tuple methods of the same name
+        self.assertEqual(tuple.index(row, 'jude'), 1)
+
+        row = row_class([u'id', u'pr\xe9nom'])((1, u'Andr\xe9'))
+        self.assertEqual(repr(row), "Row(id=1, pr\xc3\xa9nom=u'Andr\\xe9')")
+        self.assertTrue(isinstance(str(row), str))
@@ -0,0 +1,84 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from monsql import MonSQL, DB_TYPES, TRANSACTION_MODE, RoutingDatabase, ROUTING_POLICY
+from monsql.exception import MonSQLException
+
+
+class RoutingDatabaseTest(unittest.TestCase):
+    """
+    Tested with SQLite3 files standing for the primary and two replicas, whatever
+    DB_TYPE is. Each holds its own name in the table servers, to see which one is read
+    """
+
+    NAMES = ['primary', 'replica0', 'replica1']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.databases = []
+        for name in self.NAMES:
+            database = MonSQL(dbpath=os.path.join(self.directory, name + '.db'), dbtype=DB_TYPES.SQLITE3)
+            database.create_table('servers', ['name VARCHAR(20)'])
+            database.get('servers').insert({'name': name})
+            database.commit()
+            self.databases.append(database)
+
+    def tearDown(self):
+        for database in self.databases:
+            database.close()
+        shutil.rmtree(self.directory)
+
+    def routing(self, **kwargs):
+        return RoutingDatabase(self.databases[0], self.databases[1:], **kwargs)
+
+    def read_from(self, routing):
+        return routing.get('servers').find_one().name
+
+    def test_round_robin(self):
+        routing = self.routing()
+        self.assertEqual([self.read_from(routing) for i in range(4)],
+                         ['replica0', 'replica1', 'replica0', 'replica1'])
+        self.assertEqual(routing.get('servers').count(), 1)
+        self.assertEqual([row.name for row in routing.raw('SELECT name FROM servers')], ['replica1'])
+        self.assertEqual(routing.get('servers').columns, ['name'])
+
+    def test_least_busy(self):
+        routing = self.routing(policy=ROUTING_POLICY.LEAST_BUSY)
+        routing.active_statements[0].active = 2
+        self.assertEqual([self.read_from(routing) for i in range(3)], ['replica1'] * 3)
+        routing.active_statements[0].active = 0
+        self.assertEqual(sorted([self.read_from(routing) for i in range(2)]), ['replica0', 'replica1'])
+        self.assertRaises(MonSQLException, self.routing, policy='random')
+
+    def test_reads_own_writes(self):
+        routing = self.routing(sticky_seconds=0.2)
+        servers = routing.get('servers')
+        servers.insert({'name': 'new'})
+        # Uncommitted, then committed less than sticky_seconds ago
+        self.assertEqual(servers.count(), 2)
+        routing.commit()
+        self.assertEqual(servers.count(), 2)
+        self.assertEqual(self.databases[0].get('servers').count(), 2)
+        time.sleep(0.3)
+        self.assertEqual(servers.count(), 1)
+
+        routing.raw("UPDATE servers SET name = 'main' WHERE name = 'primary'")
+        self.assertEqual(self.read_from(routing), 'main')
+        routing.commit()
+
+    def test_transaction_reads_from_primary(self):
+        routing = self.routing(sticky_seconds=0)
+        with routing.transaction():
+            self.assertEqual(self.read_from(routing), 'primary')
+            self.assertEqual(routing.raw('SELECT name FROM servers')[0].name, 'primary')
+        self.assertEqual(self.read_from(routing), 'replica0')
+
+    def test_committed_writes_without_sticky_window(self):
+        primary = MonSQL(dbpath=os.path.join(self.directory, 'primary.db'), dbtype=DB_TYPES.SQLITE3,
+                         mode=TRANSACTION_MODE.AUTO)
+        self.databases.append(primary)
+        routing = RoutingDatabase(primary, self.databases[1:3], sticky_seconds=0)
+        routing.get('servers').remove({'name': 'missing'})
+        self.assertEqual(self.read_from(routing), 'replica0')
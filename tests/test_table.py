@@ -3,8 +3,13 @@ import sys
 from datetime import *
 import uuid
 import time
+import json
+from StringIO import StringIO
+from collections import OrderedDict
 from base import *
-from monsql import MonSQL, DESCENDING, DB_TYPES
+from monsql import MonSQL, ASCENDING, DESCENDING, DB_TYPES
+from monsql.profiling import ExecutionHook, QueryProfiler
+from monsql import InsertOne, Upsert, UpdateMany, DeleteMany
 from monsql.exception import MonSQLException
 
 
@@ -66,6 +71,21 @@ class MonSQLBasicTest(BaseTestCase):
             self.assertEqual(len(self.table_a.find(filter)), row_num)
 
 
+    def test_parameterized_values(self):
+        self.table_a.insert([{"name": "o'neil", "number": 1}, {"name": "100%", "number": 2},
+                             {"name": "jude", "number": 3}])
+        self.monsql.commit()
+
+        self.assertEqual(self.table_a.find_one({"name": "o'neil"}).number, 1)
+        self.assertEqual(len(self.table_a.find({"name": {"$in": ["o'neil", "jude"]}})), 2)
+        self.assertEqual(len(self.table_a.find({"name": {"$contains": "'ne"}})), 1)
+        self.assertEqual(len(self.table_a.find({"number": {"$gt": 1, "$lt": 3}})), 1)
+        self.assertEqual(len(self.table_a.find({"$and": [{"$or": [{"number": 1}, {"number": 2}]},
+                                                         {"name": "jude"}]})), 0)
+
+        self.table_a.update({"name": "o'neil"}, {"name": "o'brien"})
+        self.assertEqual(self.table_a.count({"name": "o'brien"}), 1)
+
     def test_insert(self):
         # Test findall, findone
         self._insert_some_row_to_table_one(10)
@@ -83,6 +103,59 @@ class MonSQLBasicTest(BaseTestCase):
             result_conditioned = self.table_a.find({"number": i})
             self.assertTrue(len(result_conditioned) == 1)
 
+    def test_insert_batch(self):
+        rows = [{"name": "jude" + str(i), "number": i} for i in range(25)]
+        rows += [{"name": "andy", "number": 100, "double_number": 1.5}]
+        ids = self.table_a.insert(rows, batch_size=10)
+        self.monsql.commit()
+
+        self.assertEqual(len(ids), 26)
+        self.assertEqual(self.table_a.count(), 26)
+        self.assertEqual(self.table_a.count({'number': {'$lt': 25}}), 25)
+        self.assertEqual(self.table_a.find_one({'number': 100}).double_number, 1.5)
+
+        if os.environ['DB_TYPE'] == DB_TYPES.SQLITE3:
+            self.assertEqual(list(ids), range(ids[0], ids[0] + 26))
+
+    def test_insert_wide_rows(self):
+        name = 'test_wide_' + random_name()
+        columns = ['c%d' %(i) for i in range(30)]
+        self.monsql.create_table(name, ['id INT NOT NULL PRIMARY KEY'] + ['%s INT' %(column) for column in columns])
+        try:
+            table = self.monsql.get(name)
+            # As on SQLite before 3.32, whatever the database is
+            table.MAX_PARAMS = 999
+            rows = [dict([('id', i)] + [(column, i) for column in columns]) for i in range(100)]
+
+            class ParamsHook(ExecutionHook):
+                def __init__(self):
+                    self.counts = []
+                def after_execute(self, statement):
+                    self.counts.append(len(statement.params or []))
+
+            hook = ParamsHook()
+            self.monsql.add_hook(hook)
+            try:
+                # The ids are the primary keys given
+                self.assertEqual(table.insert(rows[:40]), range(40))
+                result = table.bulk_write([InsertOne(row) for row in rows[40:80]])
+                self.assertEqual(result.inserted_ids, range(40, 80))
+                # MySQL does not count the rows left unchanged
+                self.assertEqual(table.upsert(rows[60:]), 20 if os.environ['DB_TYPE'] == DB_TYPES.MYSQL else 40)
+            finally:
+                self.monsql.remove_hook(hook)
+            self.monsql.commit()
+
+            self.assertEqual(table.count(), 100)
+            self.assertEqual(table.find_one({'id': 99}).c29, 99)
+            self.assertEqual(table.insert([{'id': 205}, {'id': 203}, {'id': 210}]), [205, 203, 210])
+            self.assertTrue(max(hook.counts) <= 999)
+            # 32 rows of 31 values per statement
+            self.assertEqual(table.rows_per_statement(31), 32)
+            self.assertEqual(len([count for count in hook.counts if count == 32 * 31]), 3)
+        finally:
+            self.monsql.drop_table(name)
+
     def test_sorting(self):
         self._insert_some_row_to_table_one(10)
 
@@ -121,6 +194,20 @@ class MonSQLBasicTest(BaseTestCase):
         self.assertEqual(full_rows[: 5], rows_with_limit)
         self.assertEqual(full_rows[5: ], rows_with_limit_and_skip)
 
+    def test_chained_query_set(self):
+        self._insert_some_row_to_table_one(10)
+
+        query_set = self.table_a.find({'number': {'$gte': 2}})
+        top = query_set.sort('number', DESCENDING).skip(1).limit(3).only('number')
+        self.assertEqual([row.number for row in top], [8, 7, 6])
+        self.assertEqual([row.number for row in top.sort([('number', ASCENDING)])], [3, 4, 5])
+        self.assertEqual(len(query_set.filter({'number': {'$lt': 8}}).filter({'$not': {'number': 5}})), 5)
+
+        # The query sets chained from are unchanged
+        self.assertEqual(query_set.query.sort, None)
+        self.assertEqual(query_set.count, 8)
+        self.assertRaises(MonSQLException, query_set.sort, 'number', 0)
+
     def test_query_set(self):
         self._insert_some_row_to_table_one(10)
         self._insert_some_row_to_table_one(10)
@@ -136,6 +223,419 @@ class MonSQLBasicTest(BaseTestCase):
 
         self.assertEqual(self.table_a.find(fields=['date']).distinct().count, 1)
 
+    def test_count_without_fetching(self):
+        self._insert_some_row_to_table_one(10)
+        self._insert_some_row_to_table_one(10)
+
+        query_set = self.table_a.find({'number': {'$gte': 2}})
+        self.assertEqual(len(query_set), 16)
+        self.assertTrue(query_set._data is None)
+        self.assertEqual(query_set.distinct().count, 8)
+        self.assertEqual(self.table_a.find(limit=5, skip=18).count, 2)
+        self.assertEqual(self.table_a.find(fields=['number'], limit=100).distinct().count, 10)
+
+        self.assertTrue(query_set.exists())
+        self.assertFalse(self.table_a.find({'number': 100}).exists())
+        self.assertFalse(self.table_a.find(limit=5, skip=20).exists())
+        self.assertTrue(query_set._data is None)
+
+        rows = list(query_set)
+        self.assertEqual(query_set.count, len(rows))
+        self.assertEqual(self.table_a.find_one({'number': 100}), None)
+
+    def test_keyset_pagination(self):
+        self.table_a.insert([{"name": "jude" + str(i % 3), "number": i} for i in range(25)])
+        self.monsql.commit()
+
+        query_set = self.table_a.find({'number': {'$gte': 2}})
+        pages = list(query_set.pages(sort=[('number', DESCENDING)], page_size=10))
+        self.assertEqual([len(rows) for rows in pages], [10, 10, 3])
+        self.assertEqual([row.number for rows in pages for row in rows], range(24, 1, -1))
+
+        sort = [('name', ASCENDING), ('number', DESCENDING)]
+        expected = sorted(range(25), key=lambda i: ('jude' + str(i % 3), -i))
+        rows = [row for rows in self.table_a.find().pages(sort=sort, page_size=4) for row in rows]
+        self.assertEqual([row.number for row in rows], expected)
+
+        page = self.table_a.find().paginate(after={'name': 'jude1', 'number': 4}, sort=sort, page_size=3)
+        self.assertEqual([row.number for row in page], [1, 23, 20])
+        self.assertRaises(MonSQLException, self.table_a.find(limit=5).paginate, sort=sort)
+
+    def test_query_cache(self):
+        self._insert_some_row_to_table_one(10)
+        self.monsql.set_query_cache_size(10)
+
+        misses = self.monsql.query_cache_misses
+        hits = self.monsql.query_cache_hits
+        for i in range(5):
+            self.assertEqual(len(self.table_a.find({'number': {'$gte': i}}, limit=3)), 3)
+        self.assertEqual(self.monsql.query_cache_misses, misses + 1)
+        self.assertEqual(self.monsql.query_cache_hits, hits + 4)
+
+        self.assertEqual(len(self.table_a.find({'number': {'$in': [1, 2, 3]}})), 3)
+        self.assertEqual(len(self.table_a.find({'number': {'$in': [4, 5]}})), 2)
+
+        self.monsql.set_query_cache_size(0)
+        self.assertTrue(self.monsql.query_cache is None)
+        self.assertEqual(len(self.table_a.find({'number': 1})), 1)
+
+    def test_result_cache(self):
+        self._insert_some_row_to_table_one(10)
+        cache = self.monsql.enable_result_cache(max_entries=2)
+        try:
+            for i in range(3):
+                self.assertEqual(len(self.table_a.find({'number': {'$gte': 5}})), 5)
+                self.assertEqual(self.table_a.count(), 10)
+            self.assertEqual((cache.hits, cache.misses), (4, 2))
+            self.assertAlmostEqual(cache.hit_ratio, 4 / 6.0)
+
+            # Uncommitted writes are seen: the cache is bypassed until they are committed
+            self.table_a.insert({'number': 10})
+            self.assertEqual(self.table_a.count(), 11)
+            self.assertEqual(len(self.table_a.find({'number': {'$gte': 5}})), 6)
+            self.assertEqual(len(cache), 0)
+            self.monsql.commit()
+
+            self.assertEqual(self.table_a.count(), 11)
+            self.table_a.update({'number': 10}, {'number': 0})
+            self.monsql.commit()
+            self.assertEqual(self.table_a.count({'number': 0}), 2)
+            self.table_a.remove({'number': 0})
+            self.monsql.commit()
+            self.assertEqual(self.table_a.count({'number': 0}), 0)
+
+            # Least recently used results are evicted past max_entries
+            evictions = cache.evictions
+            self.table_a.count({'number': 1})
+            self.table_a.count({'number': 2})
+            self.assertEqual(cache.evictions, evictions + 1)
+            self.assertEqual(len(cache), 2)
+
+            # A result read before an invalidation of its table is not cached
+            version = cache.version([self.table_a.name])
+            cache.invalidate(self.table_a.name.upper())
+            cache.put('stale', [1], [self.table_a.name], version)
+            self.assertEqual(cache.get('stale'), (False, None))
+            cache.put('fresh', [1], [self.table_a.name], cache.version([self.table_a.name]))
+            self.assertEqual(cache.get('fresh'), (True, [1]))
+
+            cache.ttl = 0.01
+            time.sleep(0.02)
+            misses = cache.misses
+            self.table_a.count({'number': 2})
+            self.assertEqual(cache.misses, misses + 1)
+        finally:
+            self.monsql.disable_result_cache()
+        self.assertTrue(self.monsql.result_cache is None)
+
+    def test_columns(self):
+        self._insert_some_row_to_table_one(10)
+        self.table_a.insert({'name': 'null', 'double_number': 1.5})
+        self.monsql.commit()
+
+        query_set = self.table_a.find(fields=['number', 'double_number', 'name'], sort=[('name', ASCENDING)])
+        columns = query_set.to_columns(batch_size=3)
+        self.assertEqual(columns.keys(), ['number', 'double_number', 'name'])
+        self.assertEqual(columns['double_number'].typecode, 'd')
+        self.assertEqual(list(columns['double_number']), [4.33333] * 10 + [1.5])
+        # The NULL does not fit in an array of integers
+        self.assertEqual(columns['number'], range(10) + [None])
+        self.assertEqual(columns['name'][-1], 'null')
+
+        columns = self.table_a.find({'number': {'$lt': 5}}, fields=['number']).to_columns()
+        self.assertEqual(columns['number'].typecode, 'l')
+        self.assertEqual(sorted(columns['number']), range(5))
+
+        try:
+            import numpy
+        except ImportError:
+            self.assertRaises(MonSQLException, query_set.to_numpy)
+            return
+        columns = query_set.to_numpy()
+        self.assertEqual(columns['double_number'].dtype, numpy.float64)
+        self.assertEqual(columns['number'].dtype, numpy.float64)
+        self.assertTrue(numpy.isnan(columns['number'][-1]))
+        records = query_set.to_numpy(records=True)
+        self.assertEqual(list(records.number[:10]), range(10))
+
+    def test_load(self):
+        def rows():
+            for i in range(2500):
+                yield ('jude%d' % i, i, None)
+
+        reports = []
+        progress = self.table_a.load(rows(), columns=['name', 'number', 'double_number'],
+                                     progress=lambda progress: reports.append(progress.rows), progress_every=1000)
+        self.assertEqual(progress.rows, 2500)
+        self.assertTrue(progress.rows_per_second > 0)
+        self.assertEqual(reports, [1000, 2000, 2500])
+        self.assertEqual(self.table_a.count(), 2500)
+        self.assertEqual(self.table_a.find_one({'number': 2499}).name, 'jude2499')
+
+        self.table_a.load([{'number': 3000, 'date': date(2020, 1, 2)}, {'number': 3001}])
+        self.assertEqual(self.table_a.count({'number': {'$gte': 3000}}), 2)
+        self.assertEqual(self.table_a.find_one({'number': 3001}).date, None)
+        self.assertRaises(MonSQLException, self.table_a.load, [(1, 2)], columns=['number'])
+
+    def test_export(self):
+        self.table_a.insert([{'name': u'jud\xe9 "%d",' % i, 'number': i, 'date': date(2020, 1, 2)} for i in range(3)])
+        self.table_a.insert({'number': 3})
+        self.monsql.commit()
+        query_set = self.table_a.find(fields=['name', 'number', 'date', 'double_number'], sort=[('number', ASCENDING)])
+
+        output = StringIO()
+        self.assertEqual(query_set.export(output, batch_size=2, copy=True), 4)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'name,number,date,double_number')
+        self.assertEqual(lines[1], '"jud\xc3\xa9 ""0"",",0,2020-01-02,')
+        self.assertEqual(lines[4], ',3,,')
+
+        output = StringIO()
+        self.assertEqual(query_set.filter({'number': {'$gte': 2}}).export(output, format='jsonl'), 2)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[1], '{"name":null,"number":3,"date":null,"double_number":null}')
+        self.assertEqual(json.loads(lines[0])['name'], u'jud\xe9 "2",')
+        self.assertRaises(MonSQLException, query_set.export, output, format='xml')
+
+    def test_stream(self):
+        self._insert_some_row_to_table_one(10)
+
+        query_set = self.table_a.find(sort=[('number', DESCENDING)])
+        batches = list(query_set.iter_batches(batch_size=3))
+        self.assertEqual([len(rows) for rows in batches], [3, 3, 3, 1])
+        self.assertEqual([row.number for row in query_set.stream(batch_size=4)], range(9, -1, -1))
+        self.assertTrue(query_set._data is None)
+
+    def test_upsert(self):
+        name = 'test_upsert_' + random_name()
+        self.monsql.create_table(name, ['id INT NOT NULL PRIMARY KEY', 'name VARCHAR(50)', 'number INT'])
+        try:
+            table = self.monsql.get(name)
+            table.insert({'id': 1, 'name': 'a', 'number': 1})
+            self.monsql.commit()
+
+            # MySQL counts the updated row twice
+            self.assertEqual(table.upsert([{'id': 1, 'name': 'b', 'number': 2},
+                                           {'id': 2, 'name': 'c', 'number': 3},
+                                           {'id': 2, 'name': 'd', 'number': 4}]),
+                             3 if os.environ['DB_TYPE'] == DB_TYPES.MYSQL else 2)
+            self.monsql.commit()
+            self.assertEqual(sorted([tuple(row) for row in table.find({})]), [(1, 'b', 2), (2, 'd', 4)])
+
+            table.upsert({'id': 1, 'name': 'e', 'number': 5}, update_fields=['number'])
+            self.assertEqual(tuple(table.find_one({'id': 1})), (1, 'b', 5))
+
+            # update(upsert=True) on the primary key is a native upsert
+            self.assertEqual(table.update({'id': 3}, {'name': 'f'}, upsert=True), 1)
+            self.assertEqual(table.update({'id': 3}, {'number': 6}, upsert=True), 1)
+            self.monsql.commit()
+            self.assertEqual(tuple(table.find_one({'id': 3})), (3, 'f', 6))
+
+            # Rows left unchanged are not counted
+            self.assertEqual(table.upsert([{'id': 1, 'name': 'g', 'number': 7},
+                                           {'id': 4, 'name': 'g', 'number': 7}], update_fields=[]), 1)
+            self.assertEqual(tuple(table.find_one({'id': 1})), (1, 'b', 5))
+
+            # Without a native upsert, the columns not given are kept
+            table.NATIVE_UPSERT = False
+            table.update({'id': 1}, {'name': 'h'}, upsert=True)
+            self.monsql.commit()
+            self.assertEqual(tuple(table.find_one({'id': 1})), (1, 'h', 5))
+
+            self.assertRaises(MonSQLException, table.upsert, {'name': 'g'})
+        finally:
+            self.monsql.drop_table(name)
+
+    def test_bulk_write(self):
+        name = 'test_bulk_' + random_name()
+        self.monsql.create_table(name, ['id INT NOT NULL PRIMARY KEY', 'name VARCHAR(50)', 'number INT'])
+        try:
+            table = self.monsql.get(name)
+            operations = [InsertOne({'id': i, 'name': 'n%d' %i, 'number': i}) for i in range(1, 4)] + [
+                UpdateMany({'id': 1}, {'number': 10}),
+                UpdateMany({'id': 2}, {'number': 20}),
+                UpdateMany({'id': {'$in': [1, 2]}}, {'name': 'x'}),
+                DeleteMany({'id': 3}),
+                InsertOne({'id': 1, 'name': 'duplicate', 'number': 0}),
+                InsertOne({'id': 4, 'name': 'n4', 'number': 4}),
+                Upsert({'id': 4, 'name': 'n4', 'number': 40}),
+            ]
+
+            # Load the schema first, its query would be reported too
+            table.columns
+            profiler = QueryProfiler()
+            self.monsql.add_hook(profiler)
+            try:
+                result = table.bulk_write(operations, ordered=False)
+            finally:
+                self.monsql.remove_hook(profiler)
+            self.monsql.commit()
+
+            # MySQL counts the upserted row twice since it is updated
+            self.assertEqual((result.inserted_count, result.updated_count, result.deleted_count, result.upserted_count),
+                             (4, 4, 1, 2 if os.environ['DB_TYPE'] == DB_TYPES.MYSQL else 1))
+            self.assertEqual([error.index for error in result.errors], [7])
+            self.assertEqual(sorted([tuple(row) for row in table.find({})]),
+                             [(1, 'x', 10), (2, 'x', 20), (4, 'n4', 40)])
+            # inserts, the first two updates, the third update, the delete, the failed
+            # batch of inserts and its retries, the upsert
+            self.assertEqual(sum([summary.count for summary in profiler.report(top=100)
+                                  if 'SAVEPOINT' not in summary.sql]), 8)
+
+            result = self.monsql.bulk_write([(name, DeleteMany({'id': 1})),
+                                             (self.table_a.name, InsertOne({'name': 'a', 'number': 1})),
+                                             (name, InsertOne({'id': 2, 'name': 'duplicate', 'number': 0})),
+                                             (name, DeleteMany({'id': 2}))])
+            self.assertEqual([error.index for error in result.errors], [2])
+            self.assertEqual((result.deleted_count, result.inserted_count), (1, 1))
+            self.monsql.commit()
+            self.assertEqual(table.count(), 2)
+            self.assertEqual(self.table_a.count(), 1)
+        finally:
+            self.monsql.drop_table(name)
+
+    def test_long_in_list(self):
+        self._insert_some_row_to_table_one(20)
+        numbers = range(5, 3000)
+
+        self.assertEqual(len(self.table_a.find({'number': {'$in': numbers}})), 15)
+        self.assertEqual(self.table_a.count({'number': {'$in': numbers}}), 15)
+
+        # Split into queries on chunks of the list
+        self.table_a.IN_ARRAY = None
+        self.table_a.IN_CHUNK_SIZE = 4
+        query_set = self.table_a.find({'number': {'$in': numbers + [5, 6]}, 'name': {'$contains': 'jude'}})
+        self.assertEqual(sorted([row.number for row in query_set]), range(5, 20))
+        self.assertEqual(query_set.count, 15)
+        self.assertEqual(self.table_a.find({'number': {'$in': numbers}}).count, 15)
+        self.assertEqual([len(rows) for rows in query_set.iter_batches(batch_size=3)], [3, 1, 3, 1, 3, 1, 3])
+        self.assertTrue(self.table_a.find({'number': {'$in': range(100, 200)}}).exists() is False)
+
+        limited = self.table_a.find({'number': {'$in': numbers}}, skip=3, limit=7)
+        self.assertEqual(limited.count, 7)
+        self.assertEqual(len(list(limited)), 7)
+        self.assertEqual(self.table_a.find({'number': {'$in': numbers}}, skip=10, limit=7).count, 5)
+
+        # A sorted query cannot be merged and runs as one statement
+        sorted_set = self.table_a.find({'number': {'$in': range(5, 500)}}, sort=[('number', DESCENDING)], limit=3)
+        self.assertEqual([row.number for row in sorted_set], [19, 18, 17])
+
+        # So are count, update and remove, whose chunk results are added up
+        class ParamsHook(ExecutionHook):
+            def __init__(self):
+                self.counts = []
+            def after_execute(self, statement):
+                self.counts.append(len(statement.params or []))
+
+        hook = ParamsHook()
+        self.monsql.add_hook(hook)
+        try:
+            self.assertEqual(self.table_a.count({'number': {'$in': numbers}}), 15)
+            self.assertEqual(self.table_a.update({'number': {'$in': numbers}}, {'name': 'chunked'}), 15)
+            self.assertEqual(self.table_a.count({'name': 'chunked'}), 15)
+            self.assertEqual(self.table_a.remove({'number': {'$in': range(0, 10) + range(100, 200)}}), 10)
+        finally:
+            self.monsql.remove_hook(hook)
+        self.assertTrue(max(hook.counts) <= 5)
+        self.assertEqual(self.table_a.count(), 10)
+
+    def test_aggregate(self):
+        self.table_a.insert([{'name': 'group%d' %(i % 3), 'number': i} for i in range(10)])
+        self.monsql.commit()
+
+        rows = self.table_a.aggregate([{'$match': {'number': {'$gte': 1}}},
+                                       {'$group': {'_id': None, 'total': {'$sum': '$number'}, 'rows': {'$count': {}},
+                                                   'smallest': {'$min': '$number'}, 'largest': {'$max': '$number'}}}])
+        self.assertEqual([tuple(row) for row in rows], [(9, 9, 1, 45)])
+        self.assertEqual(rows[0]._fields, ('largest', 'rows', 'smallest', 'total'))
+
+        rows = self.table_a.aggregate([{'$group': {'_id': '$name', 'n': {'$sum': 1}, 'mean': {'$avg': '$number'}}},
+                                       {'$match': {'n': {'$gte': 3}}},
+                                       {'$sort': {'mean': -1}},
+                                       {'$skip': 1},
+                                       {'$project': {'_id': 1, 'count': '$n'}}])
+        self.assertEqual([tuple(row) for row in rows], [('group0', 4), ('group1', 3)])
+
+        rows = self.table_a.aggregate([{'$sort': [('number', DESCENDING)]}, {'$limit': 4},
+                                       {'$group': {'_id': {'name': '$name'}, 'low': {'$min': '$number'}}},
+                                       {'$sort': {'name': 1}}])
+        self.assertEqual([(row.name, row.low) for row in rows], [('group0', 6), ('group1', 7), ('group2', 8)])
+
+        # Several sort fields are taken in the given order, not alphabetically
+        group = {'$group': {'_id': '$name', 'size': {'$sum': 1}, 'top': {'$max': '$number'}}}
+        for sort in (OrderedDict([('top', 1), ('size', -1)]), [('top', ASCENDING), ('size', DESCENDING)]):
+            rows = self.table_a.aggregate([group, {'$sort': sort}])
+            self.assertEqual([row._id for row in rows], ['group1', 'group2', 'group0'])
+        self.assertRaises(MonSQLException, self.table_a.aggregate, [group, {'$sort': {'top': 1, 'size': -1}}])
+
+        self.assertRaises(MonSQLException, self.table_a.aggregate, [{'$unwind': '$name'}])
+        self.assertRaises(MonSQLException, self.table_a.aggregate, [{'$group': {'_id': '$missing'}}])
+
+    def test_projection(self):
+        self._insert_some_row_to_table_one(3)
+
+        query_set = self.table_a.find({'number': {'$lt': 2}}, sort=[('number', ASCENDING)])
+        self.assertEqual([tuple(row) for row in query_set.only('number', 'name')], [(0, 'jude0'), (1, 'jude1')])
+        self.assertEqual(query_set.exclude('datetime', 'date', 'double_number')[1]._fields, ('name', 'number'))
+        self.assertEqual(query_set.project({'name': 1})[0]._fields, ('name', ))
+        self.assertEqual(self.table_a.find({}, fields={'datetime': 0, 'date': 0}).query.fields,
+                         ['name', 'number', 'double_number'])
+        self.assertTrue(query_set._data is None)
+
+        self.assertEqual(query_set.values_list('number', flat=True), [0, 1])
+        self.assertEqual(query_set.values_list('number', 'name'), [(0, 'jude0'), (1, 'jude1')])
+        self.assertEqual(query_set.only('name').values_list(), [('jude0', ), ('jude1', )])
+        list(query_set)
+        self.assertEqual(query_set.values_list('name', flat=True), ['jude0', 'jude1'])
+
+        self.assertRaises(MonSQLException, query_set.only('name').only, 'number')
+        self.assertRaises(MonSQLException, query_set.project, {'name': 1, 'number': 0})
+        self.assertRaises(MonSQLException, query_set.values_list, 'name', 'number', flat=True)
+
+    def test_profiling_hooks(self):
+        self._insert_some_row_to_table_one(10)
+
+        class RecordingHook(ExecutionHook):
+            def __init__(self):
+                self.before, self.after = [], []
+            def before_execute(self, statement):
+                self.before.append(statement)
+            def after_execute(self, statement):
+                self.after.append(statement)
+
+        # Load the schema first, its query would be reported too
+        self.table_a.columns
+        hook, profiler = RecordingHook(), QueryProfiler()
+        self.monsql.add_hook(hook)
+        self.monsql.add_hook(profiler)
+        try:
+            for i in range(5):
+                self.assertEqual(len(self.table_a.find({'number': {'$lt': 3}}).values()), 3)
+            self.table_a.count()
+        finally:
+            self.monsql.remove_hook(hook)
+            self.monsql.remove_hook(profiler)
+
+        self.assertEqual(len(hook.before), 6)
+        self.assertEqual(hook.before, hook.after)
+        statement = hook.after[0]
+        self.assertEqual(statement.params, [3])
+        self.assertEqual(statement.row_count, 3)
+        self.assertTrue(statement.execute_time >= 0 and statement.fetch_time >= 0 and statement.compile_time >= 0)
+
+        report = profiler.report(top=10)
+        self.assertEqual(len(report), 2)
+        find_summary = [summary for summary in report if summary.count == 5][0]
+        self.assertEqual(find_summary.sql, statement.sql)
+        self.assertEqual(find_summary.rows, 15)
+        self.assertTrue(find_summary.p50 <= find_summary.p99)
+        self.assertEqual(len(profiler.report(top=1)), 1)
+        self.assertTrue(statement.sql in profiler.format_report())
+
+        # Removed hooks are not called any more
+        self.table_a.count()
+        self.assertEqual(len(hook.after), 6)
+
     def test_raw(self):
         self._insert_some_row_to_table_one(10)
         rows = self.monsql.raw('select * from %s' %self.table_a.name)
@@ -0,0 +1,150 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from monsql import MonSQL, DB_TYPES, TRANSACTION_MODE, InsertOne, DeleteMany
+from monsql.exception import MonSQLException
+
+
+class TransactionTest(unittest.TestCase):
+    """
+    Transactions are tested with a file-backed SQLite3 database, whatever DB_TYPE is,
+    so what is committed can be checked from another connection
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.directory, 'transaction.db')
+        self.monsql = self.connect(TRANSACTION_MODE.MANUAL)
+
+    def tearDown(self):
+        self.monsql.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self, mode):
+        monsql = MonSQL(dbpath=self.dbpath, dbtype=DB_TYPES.SQLITE3, mode=mode)
+        if not monsql.is_table_existed('numbers'):
+            monsql.create_table('numbers', ['number INT'])
+        return monsql
+
+    def committed_numbers(self):
+        connection = sqlite3.connect(self.dbpath)
+        try:
+            return sorted([row[0] for row in connection.execute('SELECT number FROM numbers')])
+        finally:
+            connection.close()
+
+    def test_transaction_block(self):
+        numbers = self.monsql.get('numbers')
+        with self.monsql.transaction():
+            numbers.insert({'number': 1})
+            self.assertTrue(self.monsql.in_transaction)
+            self.assertRaises(MonSQLException, self.monsql.commit)
+        self.assertFalse(self.monsql.in_transaction)
+        self.assertEqual(self.committed_numbers(), [1])
+
+        # Uncommitted changes are committed when a block starts, and kept if it fails
+        numbers.insert({'number': 0})
+        try:
+            with self.monsql.transaction():
+                numbers.insert({'number': 2})
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.committed_numbers(), [0, 1])
+        self.assertEqual(numbers.count(), 2)
+
+    def test_nested_savepoints(self):
+        numbers = self.monsql.get('numbers')
+        with self.monsql.transaction():
+            numbers.insert({'number': 1})
+            try:
+                with self.monsql.transaction():
+                    numbers.insert({'number': 2})
+                    with self.monsql.transaction():
+                        numbers.insert({'number': 3})
+                    raise ValueError()
+            except ValueError:
+                pass
+            with self.monsql.transaction():
+                numbers.insert({'number': 4})
+            self.assertEqual(self.committed_numbers(), [])
+        self.assertEqual(self.committed_numbers(), [1, 4])
+
+    def test_load_in_transaction(self):
+        numbers = self.monsql.get('numbers')
+        numbers.load([(1, ), (2, )])
+        self.assertEqual(self.committed_numbers(), [1, 2])
+
+        try:
+            with self.monsql.transaction():
+                numbers.load((i, ) for i in range(3, 100))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.committed_numbers(), [1, 2])
+
+    def test_bulk_write_is_a_write(self):
+        cache = self.monsql.enable_result_cache()
+        numbers = self.monsql.get('numbers')
+        numbers.bulk_write([InsertOne({'number': 1}), InsertOne({'number': 2})])
+        self.assertTrue(self.monsql.has_uncommitted_writes)
+        self.assertEqual(numbers.count(), 2)
+        self.assertEqual(len(cache), 0)
+
+        # Committed when a block starts, and kept if it fails
+        try:
+            with self.monsql.transaction():
+                numbers.bulk_write([DeleteMany({'number': 1})])
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.committed_numbers(), [1, 2])
+
+    def test_schema_changes_in_transaction(self):
+        try:
+            with self.monsql.transaction():
+                self.monsql.create_table('letters', ['letter VARCHAR(1)'])
+                self.assertTrue(self.monsql.is_table_existed('letters'))
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(self.monsql.is_table_existed('letters'))
+
+    def test_auto_mode(self):
+        monsql = self.connect(TRANSACTION_MODE.AUTO)
+        try:
+            monsql.get('numbers').insert({'number': 1})
+            self.assertEqual(self.committed_numbers(), [1])
+            monsql.raw('UPDATE numbers SET number = 2')
+            self.assertEqual(self.committed_numbers(), [2])
+        finally:
+            monsql.close()
+
+    def test_group_mode(self):
+        monsql = self.connect(TRANSACTION_MODE.GROUP)
+        monsql.set_group_commit(writes=3, milliseconds=60 * 1000)
+        numbers = monsql.get('numbers')
+        try:
+            numbers.insert({'number': 1})
+            numbers.insert({'number': 2})
+            self.assertEqual(self.committed_numbers(), [])
+            numbers.insert({'number': 3})
+            self.assertEqual(self.committed_numbers(), [1, 2, 3])
+
+            monsql.set_group_commit(milliseconds=20)
+            numbers.insert({'number': 4})
+            self.assertEqual(self.committed_numbers(), [1, 2, 3])
+            time.sleep(0.03)
+            numbers.insert({'number': 5})
+            self.assertEqual(self.committed_numbers(), [1, 2, 3, 4, 5])
+
+            numbers.insert({'number': 6})
+        finally:
+            monsql.close()
+        self.assertEqual(self.committed_numbers(), [1, 2, 3, 4, 5, 6])
+
+    def test_unknown_mode(self):
+        self.assertRaises(MonSQLException, self.connect, 'sometimes')